@@ -1,8 +1,7 @@
+import constants
 import gadget
 import math
 import os
-from astropy import units as u
-from astropy.constants import G as G_u
 
 # Translation table between GADGET and ChaNGa parameter names
 gadget_trans_table = {
@@ -23,10 +22,15 @@ def get_input_file(file_name):
     input_file_basename, _ = os.path.splitext(input_name)
     return input_file_basename
 
-def convert_parameter_file(gadget_params, args, do_gas):
-    """Convert parameter values"""
+def get_tipsy_file(file_name, output_directory):
+    return output_directory + '/' + get_input_file(file_name) + '.tipsy'
+
+def convert_parameter_file(gadget_params, args, do_gas, gadget_file=None):
+    """Convert parameter values for the snapshot `gadget_file` (args.gadget_file if None)"""
     
-    gadget_file, output_directory = args.gadget_file, args.out_dir
+    if gadget_file is None:
+        gadget_file = args.gadget_file
+    output_directory = args.out_dir
     
     if not isinstance(gadget_params, gadget.parameter_file):
         raise TypeError("parameter file is not a 'gadget.parameter_file'")
@@ -38,7 +42,7 @@ def convert_parameter_file(gadget_params, args, do_gas):
             changa_params[gadget_trans_table[k]] = v
     
     changa_params['achOutName'] = output_directory + '/' + gadget_params['SnapshotFileBase'] + '.out'
-    changa_params['achInFile']  = output_directory + '/' + get_input_file(gadget_file) + '.tipsy'
+    changa_params['achInFile']  = get_tipsy_file(gadget_file, output_directory)
     
     # wall runtime limit seconds to minutes
     changa_params['iWallRunTime'] = int(float(gadget_params['TimeLimitCPU']) / 60.0)
@@ -71,15 +75,15 @@ def convert_parameter_file(gadget_params, args, do_gas):
     changa_params['bDoDensity'] = 0
 
     # convert cm to kpc
-    unitlength = float(gadget_params['UnitLength_in_cm']) * u.cm
-    changa_params['dKpcUnit'] = float(unitlength.to(u.kpc) / u.kpc)
+    unitlength = float(gadget_params['UnitLength_in_cm'])
+    changa_params['dKpcUnit'] = unitlength / constants.kpc
         
-    # convert mass to solar masses
-    unitvelocity = float(gadget_params['UnitVelocity_in_cm_per_s']) * u.cm / u.s
+    # convert mass to solar masses (G = 1 in ChaNGa units)
+    unitvelocity = float(gadget_params['UnitVelocity_in_cm_per_s'])
     unittime = unitlength / unitvelocity
-    G_factor = (unitlength.to(u.m) ** 3 / unittime ** 2 / G_u).to(u.Msun)
-    unitmass = float((float(gadget_params['UnitMass_in_g']) * u.g).to(u.Msun) / u.Msun)
-    changa_params['dMsolUnit'] = unitmass / float(G_factor / u.Msun)
+    G_factor = unitlength ** 3 / unittime ** 2 / constants.G / constants.M_sun
+    unitmass = float(gadget_params['UnitMass_in_g']) / constants.M_sun
+    changa_params['dMsolUnit'] = unitmass / G_factor
     
     if int(gadget_params['ComovingIntegrationOn']) == 1:
         changa_params['bComove'] = gadget_params['ComovingIntegrationOn']
@@ -0,0 +1,42 @@
+"""
+    Time importing the Python modules in fresh interpreters
+
+    Scripts converting or analysing a snapshot start a new interpreter each
+    time, so the modules should import little more than NumPy. Exits with
+    status 1 if any of them pulls in astropy or h5py.
+
+    Usage: python benchmarks/import_time.py [--repeat REPEAT]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+parser = argparse.ArgumentParser(description='Time importing the Python modules in fresh interpreters')
+parser.add_argument('--repeat', type=int, default=5, help='Number of timings; the best is reported (default: %(default)s)')
+args = parser.parse_args()
+
+# Modules only some functions need, loaded on first use
+heavy = ['astropy', 'h5py']
+
+code = '''
+import sys, time
+start = time.perf_counter()
+import {0:s}
+print(time.perf_counter() - start, *[m for m in {1!r} if m in sys.modules])
+'''
+
+failed = False
+for module in ['numpy', 'tipsy', 'gadget', 'ChaNGa']:
+    best = None
+    for _ in range(args.repeat):
+        out = subprocess.run([sys.executable, '-c', code.format(module, heavy)], cwd=root, check=True,
+                             stdout=subprocess.PIPE, universal_newlines=True).stdout.split()
+        best = float(out[0]) if best is None else min(best, float(out[0]))
+        loaded = out[1:]
+    print('{0:8s} {1:8.1f} ms{2:s}'.format(module, 1e3 * best, ' (imports ' + ', '.join(loaded) + ')' if loaded else ''))
+    failed = failed or bool(loaded)
+
+sys.exit(1 if failed else 0)
@@ -0,0 +1,285 @@
+"""
+    Throughput of reading and writing Tipsy and GADGET files
+
+    Synthetic snapshots of each size (a quarter gas, half dark matter, and a
+    quarter stars) are generated in a scratch directory. Each case then runs in
+    a fresh interpreter, so that the peak RSS reported is its own, and the best
+    of several timings is kept. gadget2changa.py runs in that interpreter too,
+    so its timings don't include starting Python. Cold-cache cases evict the
+    files from the page cache before every timing (posix_fadvise, so they are
+    skipped where that isn't available). Particles are moved `--chunk-size` at
+    a time.
+
+    The results are written as JSON together with the commit and versions they
+    were measured with. --compare prints the change between two such files.
+
+    Usage: python benchmarks/io_throughput.py [--sizes N [N ...]] [--repeat REPEAT] [--output FILE]
+           python benchmarks/io_throughput.py --compare OLD.json NEW.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+import numpy as np
+import tipsy
+
+parser = argparse.ArgumentParser(description='Throughput of reading and writing Tipsy and GADGET files')
+parser.add_argument('--sizes', type=float, nargs='+', default=[1e4, 1e5, 1e6], help='Numbers of particles (default: %(default)s)')
+parser.add_argument('--repeat', type=int, default=3, help='Number of timings; the best is reported (default: %(default)s)')
+parser.add_argument('--chunk-size', type=int, default=2**20, help='Number of particles moved at a time (default: %(default)s)')
+parser.add_argument('--dir', help='Directory for the synthetic files (default: a temporary directory)')
+parser.add_argument('--output', help='File to write the results to (default: standard output)')
+parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two result files instead of measuring')
+parser.add_argument('--run', nargs=5, help=argparse.SUPPRESS)
+
+# The parameters of the converted snapshots
+gadget_params = {
+    'SnapshotFileBase': 'snap', 'TimeLimitCPU': 3600, 'TimeBegin': 0, 'TimeMax': 1.0, 'MaxSizeTimestep': 0.01,
+    'TimeBetSnapshot': 0.1, 'TimeBetStatistics': 0.05, 'ErrTolIntAccuracy': 0.025, 'ErrTolTheta': 0.5,
+    'InitCondFile': 'ics', 'UnitLength_in_cm': 3.085678e21, 'UnitMass_in_g': 1.989e43,
+    'UnitVelocity_in_cm_per_s': 1e5, 'ComovingIntegrationOn': 0, 'DesNumNgb': 32, 'CoolingOn': 0,
+    'StarformationOn': 0, 'MinGasHsmlFractional': 0.1, 'CourantFac': 0.15, 'InitGasTemp': 1000,
+    'MinGasTemp': 10, 'SofteningHalo': 0.1, 'SofteningDisk': 0.05, 'SofteningBulge': 0.05,
+    'SofteningStars': 0.02, 'SofteningBndry': 0.3, 'Omega0': 0.3, 'OmegaLambda': 0.7,
+    'OmegaBaryon': 0.04, 'HubbleParam': 0.7, 'BoxSize': 100, 'PeriodicBoundariesOn': 0
+}
+
+# The GADGET fields written and read for each particle type
+gadget_fields = {
+    0: ['Coordinates', 'Velocities', 'Masses', 'Potential', 'InternalEnergy', 'Density', 'SmoothingLength',
+        'ElectronAbundance', 'Metallicity'],
+    1: ['Coordinates', 'Velocities', 'Masses', 'Potential'],
+    4: ['Coordinates', 'Velocities', 'Masses', 'Potential', 'StellarFormationTime', 'Metallicity']
+}
+read_fields = ['positions', 'velocities', 'mass', 'potential', 'internal_energy', 'density', 'hsml',
+               'electron_density', 'metals', 't_form']
+
+def counts(n):
+    return n // 4, n - 2 * (n // 4), n // 4
+
+def filenames(tmp, n):
+    base = os.path.join(tmp, 'snap_{0:d}'.format(n))
+    return {'xdr': base + '.tipsy', 'native': base + '.native', 'hdf5': base + '.hdf5'}
+
+def chunks(size, chunk_size):
+    for start in range(0, size, chunk_size):
+        yield start, min(start + chunk_size, size)
+
+def drop_cache(filename):
+    """Evict `filename` from the page cache"""
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+def tipsy_columns(n, chunk_size):
+    """One chunk of random data per family, reused for every chunk written"""
+    ngas, ndark, nstar = counts(n)
+    size = min(chunk_size, max(ngas, ndark, nstar))
+    rand = lambda *shape: np.random.rand(size, *shape).astype(np.float32)
+    return {
+        'gas': [rand(), rand(3), rand(3), rand(), rand(), rand(), rand(), rand()],
+        'darkmatter': [rand(), rand(3), rand(3), rand(), rand()],
+        'stars': [rand(), rand(3), rand(3), rand(), rand(), rand(), rand()]
+    }
+
+def write_tipsy(filename, n, is_xdr, chunk_size, columns):
+    """Write `n` particles from the chunks of `columns` (see tipsy_columns)"""
+    ngas, ndark, nstar = counts(n)
+    with tipsy.streaming_writer(filename, is_xdr=is_xdr) as f:
+        f.header(0.0, ngas, ndark, nstar)
+        for family, count in zip(['gas', 'darkmatter', 'stars'], [ngas, ndark, nstar]):
+            for start, stop in chunks(count, chunk_size):
+                getattr(f, family)(*[c[:stop - start] for c in columns[family]], stop - start)
+
+def read_tipsy(filename, is_xdr, chunk_size):
+    with tipsy.File(filename, is_xdr=is_xdr) as f:
+        hdr = f.header
+        for read, count in [(f.read_gas, hdr.ngas), (f.read_darkmatter, hdr.ndark), (f.read_stars, hdr.nstar)]:
+            for start, stop in chunks(count, chunk_size):
+                read(start, stop)
+
+def write_gadget(filename, n, chunk_size):
+    import h5py
+    numpart = [0] * 6
+    numpart[0], numpart[1], numpart[4] = counts(n)
+    with h5py.File(filename, 'w') as f:
+        hdr = f.create_group('Header')
+        hdr.attrs['NumPart_ThisFile'] = np.array(numpart, dtype=np.uint32)
+        hdr.attrs['NumPart_Total'] = np.array(numpart, dtype=np.uint32)
+        hdr.attrs['NumPart_Total_HighWord'] = np.zeros(6, dtype=np.uint32)
+        hdr.attrs['MassTable'] = np.zeros(6)
+        for name, value in [('Time', 0.0), ('Redshift', 0.0), ('BoxSize', 100.0), ('NumFilesPerSnapshot', 1),
+                            ('Omega0', 0.3), ('OmegaLambda', 0.7), ('HubbleParam', 0.7)]:
+            hdr.attrs[name] = value
+        for flag in ['Flag_Sfr', 'Flag_Cooling', 'Flag_StellarAge', 'Flag_Metals', 'Flag_Feedback',
+                     'Flag_DoublePrecision']:
+            hdr.attrs[flag] = 0
+
+        for index, fields in gadget_fields.items():
+            group = f.create_group('PartType{0:d}'.format(index))
+            for field in fields:
+                shape = (numpart[index], 3) if field in ['Coordinates', 'Velocities'] else (numpart[index],)
+                data = group.create_dataset(field, shape, dtype=np.float32)
+                for start, stop in chunks(numpart[index], chunk_size):
+                    data[start:stop] = np.random.rand(stop - start, *shape[1:]) + 0.5
+
+def read_gadget(filename, chunk_size):
+    import gadget
+    with gadget.File(filename, fields=read_fields) as f:
+        for part_type in ['gas', 'halo', 'stars']:
+            for _ in f.chunks(part_type, chunk_size):
+                pass
+
+def peak_rss():
+    """The peak resident set size of this process in MB"""
+    # On Linux, ru_maxrss keeps the parent's peak across exec but VmHWM doesn't
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    scale = 1.0 if sys.platform == 'darwin' else 1024.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20
+
+def convert(argv):
+    """Run gadget2changa.py with the arguments `argv` in this process"""
+    import contextlib
+    import runpy
+    sys.argv = ['gadget2changa.py'] + argv
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        runpy.run_path(os.path.join(root, 'gadget2changa.py'), run_name='__main__')
+
+def run_case(benchmark, fmt, cache, n, tmp):
+    """Time one case in this process and return its results"""
+    files = filenames(tmp, n)
+    is_xdr = fmt == 'xdr'
+
+    if benchmark == 'tipsy.streaming_writer':
+        output = os.path.join(tmp, 'out.' + fmt)
+        # The random data are made before timing so that only the write is measured
+        columns = tipsy_columns(n, args.chunk_size)
+        inputs, run = [], lambda: write_tipsy(output, n, is_xdr, args.chunk_size, columns)
+    elif benchmark == 'tipsy.File':
+        inputs, output = [files[fmt]], files[fmt]
+        run = lambda: read_tipsy(files[fmt], is_xdr, args.chunk_size)
+    elif benchmark == 'gadget.File':
+        inputs, output = [files['hdf5']], files['hdf5']
+        run = lambda: read_gadget(files['hdf5'], args.chunk_size)
+    else:
+        out_dir = os.path.join(tmp, 'changa')
+        os.makedirs(out_dir, exist_ok=True)
+        inputs, output = [files['hdf5']], os.path.join(out_dir, os.path.basename(files['xdr']))
+        argv = ['--no-param-list', '--force', '--chunk-size', str(args.chunk_size), files['hdf5'],
+                os.path.join(tmp, 'params'), out_dir]
+        run = lambda: convert(argv)
+
+    if cache == 'warm':
+        run()
+    best = None
+    for _ in range(args.repeat):
+        for f in inputs:
+            if cache == 'cold':
+                drop_cache(f)
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    size = os.path.getsize(output)
+    return {
+        'benchmark': benchmark, 'format': fmt, 'cache': cache, 'particles': n, 'bytes': size, 'seconds': best,
+        'mb_per_s': size / best / 1e6, 'particles_per_s': n / best, 'peak_rss_mb': peak_rss()
+    }
+
+def cases():
+    caches = ['cold', 'warm'] if hasattr(os, 'posix_fadvise') else ['warm']
+    for fmt in ['xdr', 'native']:
+        yield 'tipsy.streaming_writer', fmt, None
+        for cache in caches:
+            yield 'tipsy.File', fmt, cache
+    for cache in caches:
+        yield 'gadget.File', 'hdf5', cache
+    for cache in caches:
+        yield 'gadget2changa', 'xdr', cache
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit, 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+        'cpus': os.cpu_count(), 'repeat': args.repeat, 'chunk_size': args.chunk_size
+    }
+
+def measure(tmp):
+    with open(os.path.join(tmp, 'params'), 'w') as f:
+        for k, v in gadget_params.items():
+            f.write('{0:s} {1:s}\n'.format(k, str(v)))
+
+    results = []
+    for n in [int(n) for n in args.sizes]:
+        files = filenames(tmp, n)
+        columns = tipsy_columns(n, args.chunk_size)
+        write_tipsy(files['xdr'], n, True, args.chunk_size, columns)
+        write_tipsy(files['native'], n, False, args.chunk_size, columns)
+        write_gadget(files['hdf5'], n, args.chunk_size)
+
+        for benchmark, fmt, cache in cases():
+            command = [sys.executable, __file__, '--repeat', str(args.repeat), '--chunk-size', str(args.chunk_size),
+                       '--run', benchmark, fmt, str(cache), str(n), tmp]
+            out = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+            results.append(json.loads(out))
+            r = results[-1]
+            print('{0:22s} {1:6s} {2:4s} {3:10d} {4:10.1f} MB/s {5:12.3g} particles/s {6:8.1f} MB'.format(
+                  benchmark, fmt, cache or '', n, r['mb_per_s'], r['particles_per_s'], r['peak_rss_mb']),
+                  file=sys.stderr)
+
+        for f in files.values():
+            os.unlink(f)
+    return results
+
+def compare(old, new):
+    key = lambda r: (r['benchmark'], r['format'], r['cache'], r['particles'])
+    before = {key(r): r for r in old['results']}
+    print('{0:s} -> {1:s}'.format(str(old['metadata']['commit']), str(new['metadata']['commit'])))
+    for r in new['results']:
+        if key(r) in before:
+            b = before[key(r)]
+            print('{0:22s} {1:6s} {2:4s} {3:10d} {4:10.1f} -> {5:10.1f} MB/s ({6:+6.1f}%)'.format(
+                  r['benchmark'], r['format'], r['cache'] or '', r['particles'], b['mb_per_s'], r['mb_per_s'],
+                  100.0 * (r['mb_per_s'] / b['mb_per_s'] - 1.0)))
+
+args = parser.parse_args()
+
+if args.run is not None:
+    benchmark, fmt, cache, n, tmp = args.run
+    print(json.dumps(run_case(benchmark, fmt, None if cache == 'None' else cache, int(n), tmp)))
+elif args.compare is not None:
+    with open(args.compare[0]) as old, open(args.compare[1]) as new:
+        compare(json.load(old), json.load(new))
+else:
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        report = {'metadata': metadata(), 'results': measure(tmp)}
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
@@ -0,0 +1,41 @@
+"""
+    Time opening and closing a small Tipsy file
+
+    Batch analyses open thousands of snapshots, so the fixed cost of
+    opening one (library setup, fopen, reading the header) matters.
+
+    Usage: python benchmarks/open_latency.py [-n NUMBER] [--repeat REPEAT]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import tipsy
+
+parser = argparse.ArgumentParser(description='Time opening and closing a small Tipsy file')
+parser.add_argument('-n', '--number', type=int, default=10000, help='Opens per timing (default: %(default)s)')
+parser.add_argument('--repeat', type=int, default=5, help='Number of timings; the best is reported (default: %(default)s)')
+args = parser.parse_args()
+
+with tempfile.TemporaryDirectory() as tmp:
+    filename = os.path.join(tmp, 'small.tipsy')
+    
+    for is_xdr in [True, False]:
+        with tipsy.streaming_writer(filename, is_xdr=is_xdr) as f:
+            f.header(0.0, 0, 1, 0)
+            f.darkmatter(1.0, tipsy.constant((0, 0, 0)), tipsy.constant((0, 0, 0)), 0.0, 0.0, 1)
+        
+        def read():
+            with tipsy.File(filename, is_xdr=is_xdr) as f:
+                f.header
+        
+        def write():
+            with tipsy.streaming_writer(filename, is_xdr=is_xdr):
+                pass
+        
+        for name, func in [('open', read), ('create', write)]:
+            best = min(timeit.repeat(func, number=args.number, repeat=args.repeat))
+            print('{0:6s} {1:6s} {2:8.2f} us'.format('xdr' if is_xdr else 'native', name, 1e6 * best / args.number))
@@ -0,0 +1,139 @@
+import numpy as np
+
+"""
+    Streaming 2D binning of particles
+
+    Particles are read from a Tipsy or GADGET file a chunk at a time and
+    their weights are summed on a fixed grid, so that memory use depends
+    on the number of bins rather than on the number of particles. The
+    particles can be split across worker processes, each summing its own
+    part of the file.
+"""
+
+class grid():
+    """Sums of particle weights on a regular `nbins` x `nbins` grid over [-x_lim, x_lim] x [-y_lim, y_lim]"""
+    def __init__(self, limits, nbins):
+        self.limits = tuple(float(x) for x in limits)
+        self.nbins = int(nbins)
+        self.sums = {}
+
+    def add(self, pos, **weights):
+        """Add the weights of the particles at `pos` (only x and y are used) to the sums of the same name"""
+        pos = np.asarray(pos)
+        x, y = pos[:, 0], pos[:, 1]
+        x_lim, y_lim = self.limits
+        inside = (np.abs(x) <= x_lim) & (np.abs(y) <= y_lim)
+        x, y = x[inside].astype(np.float64), y[inside].astype(np.float64)
+
+        # The bin of each particle, with the upper limits in the last bins
+        n = self.nbins
+        i = np.minimum(((x + x_lim) * (n / (2.0 * x_lim))).astype(np.intp), n - 1)
+        j = np.minimum(((y + y_lim) * (n / (2.0 * y_lim))).astype(np.intp), n - 1)
+        bins = i * n + j
+
+        for name, w in weights.items():
+            w = np.broadcast_to(w, inside.shape)[inside]
+            total = np.bincount(bins, weights=w, minlength=n * n)
+            if name in self.sums:
+                self.sums[name] += total
+            else:
+                self.sums[name] = total
+        return self
+
+    def __iadd__(self, other):
+        for name, total in other.sums.items():
+            if name in self.sums:
+                self.sums[name] += total
+            else:
+                self.sums[name] = total.copy()
+        return self
+
+    def __getitem__(self, name):
+        """The sums of `name`, indexed by the x and then the y bin (as np.histogram2d)"""
+        if name not in self.sums:
+            return np.zeros((self.nbins, self.nbins))
+        return self.sums[name].reshape(self.nbins, self.nbins)
+
+    @property
+    def bin_area(self):
+        return (2.0 * self.limits[0]) * (2.0 * self.limits[1]) / (self.nbins * self.nbins)
+
+    def centers(self):
+        """The x and y coordinates of the bin centers as (y, x)-indexed meshes"""
+        x_edges = np.linspace(-self.limits[0], self.limits[0], self.nbins + 1)
+        y_edges = np.linspace(-self.limits[1], self.limits[1], self.nbins + 1)
+        x_grid, y_grid = np.meshgrid(x_edges, y_edges)
+        return (x_grid[1:, 1:] + x_grid[:-1, :-1]) / 2.0, (y_grid[1:, 1:] + y_grid[:-1, :-1]) / 2.0
+
+class tipsy_source():
+    """The particles of `family` ('gas', 'darkmatter', or 'stars') of a Tipsy file
+
+        `kwargs` are passed to tipsy.File.
+    """
+    def __init__(self, filename, family, **kwargs):
+        self.filename = filename
+        self.family = family
+        self.kwargs = kwargs
+
+    def __len__(self):
+        import tipsy
+        with tipsy.File(self.filename, **self.kwargs) as f:
+            return {'gas': f.header.ngas, 'darkmatter': f.header.ndark, 'stars': f.header.nstar}[self.family]
+
+    def chunks(self, chunk_size, start, stop):
+        """Iterate over the particles [start, stop) in blocks of at most `chunk_size` particles"""
+        import tipsy
+        with tipsy.File(self.filename, **self.kwargs) as f:
+            read = getattr(f, 'read_' + self.family)
+            for first in range(start, stop, chunk_size):
+                yield read(first, min(first + chunk_size, stop))
+
+class gadget_source():
+    """The particles of `part_type` of a GADGET HDF5 file, reading `fields` up front"""
+    def __init__(self, filename, part_type, fields=None):
+        self.filename = filename
+        self.part_type = part_type
+        self.fields = fields
+
+    def __len__(self):
+        import gadget
+        with gadget.File(self.filename) as f:
+            return f.num_particles(self.part_type)
+
+    def chunks(self, chunk_size, start, stop):
+        """Iterate over the particles [start, stop) in blocks of at most `chunk_size` particles"""
+        import gadget
+        with gadget.File(self.filename, fields=self.fields) as f:
+            for chunk in f.chunks(self.part_type, chunk_size, start, stop):
+                yield chunk
+
+def _bin_range(source, weights, limits, nbins, chunk_size, start, stop):
+    """Bin the particles [start, stop) of `source`; this runs in the worker processes of bin_particles"""
+    g = grid(limits, nbins)
+    for chunk in source.chunks(chunk_size, start, stop):
+        g.add(chunk.pos, **{name: getattr(chunk, field) for name, field in weights.items()})
+    return g
+
+def bin_particles(source, weights, limits, nbins, chunk_size=2**20, nworkers=1):
+    """
+        Sum the fields of the particles of `source` on a grid
+
+        `weights` maps the name of each sum to the particle field summed
+        (e.g., {'mass': 'mass', 'temp': 'temp'}), so that every field is
+        binned in the same pass over the file. The particles are read
+        `chunk_size` at a time and split across `nworkers` processes.
+    """
+    size = len(source)
+    nworkers = max(1, min(int(nworkers), (size + chunk_size - 1) // chunk_size))
+    if nworkers == 1:
+        return _bin_range(source, weights, limits, nbins, chunk_size, 0, size)
+
+    import concurrent.futures as cf
+    bounds = np.linspace(0, size, nworkers + 1).astype(np.int64)
+    total = grid(limits, nbins)
+    with cf.ProcessPoolExecutor(max_workers=nworkers) as pool:
+        parts = [pool.submit(_bin_range, source, weights, limits, nbins, chunk_size, int(a), int(b))
+                 for a, b in zip(bounds[:-1], bounds[1:])]
+        for part in parts:
+            total += part.result()
+    return total
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import numpy as np
+import os
+import shutil
+import tempfile
+
+"""
+    A cache of data derived from snapshots
+
+    Each entry is a directory holding one .npy file per array and the scalars
+    in meta.json. Entries are keyed on the identity of the source file (its
+    path, size, and modification time) and on the parameters used to derive
+    them, so changing either misses the cache instead of returning stale data.
+    Arrays are memory-mapped when first accessed. Once the entries exceed the
+    size limit, the least recently used ones are removed.
+"""
+
+# Bumped when the layout of the entries changes
+_version = 1
+
+class entry():
+    """A cached entry whose arrays are memory-mapped on first access"""
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+    def __getstate__(self):
+        # Pickled without the mapped arrays, which are mapped again when used
+        return {'path': self.path, 'meta': self.meta}
+
+    def __getattr__(self, name):
+        # Only called for names that aren't regular attributes
+        meta = self.__dict__.get('meta')
+        if meta is None or name not in meta['fields']:
+            raise AttributeError("'entry' object has no attribute '{0:s}'".format(name))
+        if name in meta['arrays']:
+            value = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+        else:
+            value = meta['fields'][name]
+        setattr(self, name, value)
+        return value
+
+class cache():
+    """Derived data stored in `directory`, keeping at most `max_bytes` (unlimited if None)"""
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, source, params):
+        """The key of the data derived from the file `source` with `params` (a JSON-serializable dict)"""
+        st = os.stat(source)
+        identity = {'version': _version, 'source': os.path.realpath(source), 'size': st.st_size,
+                    'mtime': st.st_mtime_ns, 'params': params}
+        return hashlib.sha1(json.dumps(identity, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, source, params):
+        """The entry derived from `source` with `params`, or None if it isn't cached"""
+        path = os.path.join(self.directory, self.key(source, params))
+        try:
+            e = entry(path)
+        except FileNotFoundError:
+            return None
+        # The modification time of meta.json orders the entries by last use
+        os.utime(os.path.join(path, 'meta.json'))
+        return e
+
+    def put(self, source, params, fields):
+        """
+            Store `fields` (a dict of arrays and JSON-serializable values) as derived from `source` with `params`
+
+            Returns the stored entry. Entries are written to a temporary directory
+            first, so a concurrent or interrupted put never leaves a partial entry.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, self.key(source, params))
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix='.tmp')
+        try:
+            meta = {'source': os.path.realpath(source), 'params': params, 'arrays': [], 'fields': {}}
+            for name, value in fields.items():
+                if isinstance(value, np.ndarray):
+                    np.save(os.path.join(tmp, name + '.npy'), value)
+                    meta['arrays'].append(name)
+                    meta['fields'][name] = None
+                else:
+                    meta['fields'][name] = value
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.rename(tmp, path)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        self.evict(keep=path)
+        return entry(path)
+
+    def _entries(self):
+        """The (last use, size, path) of each entry"""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                used = os.path.getmtime(os.path.join(path, 'meta.json'))
+                size = sum(e.stat().st_size for e in os.scandir(path))
+            except FileNotFoundError:
+                continue
+            entries.append((used, size, path))
+        return entries
+
+    def size(self):
+        """The total size in bytes of the entries"""
+        return sum(size for _, size, _ in self._entries()) if os.path.isdir(self.directory) else 0
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries (other than `keep`) until the cache fits in max_bytes"""
+        if self.max_bytes is None or not os.path.isdir(self.directory):
+            return
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
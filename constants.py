@@ -0,0 +1,15 @@
+"""
+    Physical constants and units in cgs
+
+    These are the values used by astropy.constants (CODATA 2022 and IAU 2015)
+    and astropy.units, kept here so that converting GADGET units doesn't
+    import astropy. tipsy_test.py checks them against astropy.
+"""
+
+k_B = 1.380649e-16             # Boltzmann constant (erg / K)
+m_p = 1.67262192595e-24        # proton mass (g)
+G = 6.6743e-08                 # gravitational constant (cm^3 / g / s^2)
+M_sun = 1.988409870698051e+33  # solar mass (g)
+
+kpc = 3.0856775814913673e+21   # kiloparsec (cm)
+km = 1e5                       # kilometer (cm)
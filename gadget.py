@@ -1,142 +1,256 @@
-import h5py
+import glob
 import numpy as np
-import astropy.units as apu
-import astropy.constants as apc
+import os
+import re
+import collections
+import constants
+import functools
 
-def convert_U_to_temperature(gas_data, params=None):
-    units = {}
+@functools.lru_cache(maxsize=16)
+def _temperature_constants(units):
+    """The scalar factors used by convert_U_to_temperature
     
-    if params is not None:
-        units['length'] = float(params['UnitLength_in_cm']) * apu.cm
-        units['mass'] = float(params['UnitMass_in_g']) * apu.g
-        units['velocity'] = float(params['UnitVelocity_in_cm_per_s']) * apu.cm / apu.s
+        `units` is (UnitLength_in_cm, UnitMass_in_g, UnitVelocity_in_cm_per_s,
+        InitGasTemp, MinGasTemp) or None for the default GADGET units. Returns
+        the unit pressure and density in cgs, the mean weight without metals,
+        and the minimum temperature (None if there isn't one).
+    """
+    # In cgs
+    if units is not None:
+        length, mass, velocity = units[:3]
     else:
-        units['length'] = (1.0 * apu.kpc).to(apu.cm)
-        units['mass'] = (1e10 * apu.Msun).to(apu.g)
-        units['velocity'] = 1.0 * apu.km / apu.s
+        length = constants.kpc
+        mass = 1e10 * constants.M_sun
+        velocity = constants.km
 
-    units['time'] = units['length'] / units['velocity']
-    units['density'] = units['mass'] / units['length'] ** 3.0
-    units['pressure'] = units['mass'] / units['length'] / units['time'] ** 2.0
+    time = length / velocity
+    density = mass / length ** 3.0
+    pressure = mass / length / time ** 2.0
 
-    boltzmann = apc.k_B.cgs.value
-    protonmass = apc.m_p.cgs.value
-    gamma_minus1 = (5.0 / 3.0) - 1.0
     h_massfrac = 0.76
     
     # Neutral gas
     mean_weight = 4.0 / (1.0 + 3.0 * h_massfrac)
     
     # Fully ionized gas
-    if params is not None and float(params['InitGasTemp']) >= 1e4:
+    if units is not None and units[3] >= 1e4:
         mean_weight = 4.0 / (8.0 - 5.0 * (1.0 - h_massfrac))
 
-    # Gas with metals
-    if gas_data.metals is not None and gas_data.electron_density is not None:
-        X = gas_data.metals / gas_data.mass
-        mask = X > 0.0
-        Y = np.zeros(X.shape)
-        Y[mask] = (1.0 - X[mask]) / (4.0 * X[mask])
-        mean_weight = (1.0 + 4.0 * Y) / (1.0 + Y + gas_data.electron_density)
+    min_temp = units[4] if units is not None else None
+    return pressure, density, mean_weight, min_temp
 
-    p = float(units['pressure'] / (apu.g / (apu.cm * apu.s ** 2.0)))
-    d = float(units['density'] / (apu.g / apu.cm ** 3.0))
-    u = gas_data.internal_energy * p / d
-    temp = gamma_minus1 / boltzmann * u * protonmass * mean_weight
+# Number of particles per block in convert_U_to_temperature
+_temperature_block = 65536
 
-    # Enforce minimum temperature
+def convert_U_to_temperature(gas_data, params=None):
+    """The temperature of `gas_data` from its internal energy
+    
+        The units are taken from `params` or are the default GADGET units if None.
+    """
+    units = None
     if params is not None:
-        temp[temp < float(params['MinGasTemp'])] = float(params['MinGasTemp'])
+        units = tuple(float(params[k]) for k in ['UnitLength_in_cm', 'UnitMass_in_g', 'UnitVelocity_in_cm_per_s',
+                                                 'InitGasTemp', 'MinGasTemp'])
+    pressure, density, mean_weight, min_temp = _temperature_constants(units)
+    gamma_minus1 = (5.0 / 3.0) - 1.0
+    
+    U = gas_data.internal_energy
+    temp = np.empty(U.shape, dtype=np.float64)
+    
+    # Gas with metals have the mean weight (1 + 4Y) / (1 + Y + Ne) with Y = (1 - X) / 4X
+    # and X = metals / mass (Y = 0 for X <= 0).
+    #
+    # Computed in place, a block at a time, so the only temporaries are two
+    # block-sized buffers and a mask reused for every block. The specific energy
+    # u (and X and Y) are rounded to the precision of the particle fields, as in
+    # the original unblocked formula, and the rest is done in float64 in the same
+    # order, so that the temperatures are bit-for-bit those it gave.
+    has_metals = gas_data.metals is not None and gas_data.electron_density is not None
+    if has_metals:
+        metals, mass, Ne = gas_data.metals, gas_data.mass, gas_data.electron_density
+        x_type = np.result_type(metals.dtype, mass.dtype)
+        n = min(_temperature_block, temp.shape[0])
+        buf1, buf2, mask = np.empty(n), np.empty(n), np.empty(n, dtype=bool)
+    for start in range(0, temp.shape[0], _temperature_block):
+        block = slice(start, start + _temperature_block)
+        t = temp[block]
+        np.multiply(U[block], pressure, out=t, dtype=U.dtype)
+        np.divide(t, density, out=t, dtype=U.dtype)
+        t *= gamma_minus1 / constants.k_B
+        t *= constants.m_p
+        if not has_metals:
+            t *= mean_weight
+            continue
+        
+        x, y, positive = buf1[:t.shape[0]], buf2[:t.shape[0]], mask[:t.shape[0]]
+        np.divide(metals[block], mass[block], out=x, dtype=x_type)
+        np.greater(x, 0.0, out=positive)
+        np.multiply(4.0, x, out=y, where=positive, dtype=x_type)
+        np.subtract(1.0, x, out=x, where=positive, dtype=x_type)
+        np.divide(x, y, out=y, where=positive, dtype=x_type)
+        np.logical_not(positive, out=positive)
+        np.copyto(y, 0.0, where=positive)
+        
+        # The mean weight
+        np.add(1.0, y, out=x)
+        x += Ne[block]
+        y *= 4.0
+        y += 1.0
+        y /= x
+        t *= y
+
+    # Enforce minimum temperature
+    if min_temp is not None:
+        np.maximum(temp, min_temp, out=temp)
 
     return temp
 
+class _dataset():
+    """A particle field read from the HDF5 dataset `name` on first access
+    
+        The value is None if the dataset isn't in the file.
+    """
+    def __init__(self, name):
+        self.name = name
+    
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return obj._load(self.name)
+    
+    def __set__(self, obj, value):
+        obj._cache[self.name] = value
+
 class basic_particle():
-    def __init__(self, data, mass):
-        self.positions = np.empty(data['Coordinates'].shape, data['Coordinates'].dtype)
-        data['Coordinates'].read_direct(self.positions)
-        
-        self.velocities = np.empty(data['Velocities'].shape, data['Velocities'].dtype)
-        data['Velocities'].read_direct(self.velocities)
-        
-        self.size = self.positions.shape[0]
-        
-        if (float(mass) <= 0.0):
-            self.mass = np.empty(data['Masses'].shape, data['Masses'].dtype)
-            data['Masses'].read_direct(self.mass)
-        else:
-            self.mass = float(mass) * np.ones(self.size, dtype=np.float32)
+    """The particles [start, stop) of one GADGET particle type
+    
+        Each field is read from the file the first time it is used. The
+        fields named in `fields` are read immediately.
+    """
+    fields = ['positions', 'velocities', 'mass', 'potential', 'ids']
+    
+    positions = _dataset('Coordinates')
+    velocities = _dataset('Velocities')
+    potential = _dataset('Potential')
+    ids = _dataset('ParticleIDs')
+    
+    # Some useful aliases
+    pos = positions
+    vel = velocities
+    pot = potential
+    
+    def __init__(self, data, mass, start=0, stop=None, fields=None):
+        self._data = data
+        self._sel = slice(start, stop)
+        self._mass = float(mass)
+        self._cache = {}
+        self.size = len(range(*self._sel.indices(data['Coordinates'].shape[0])))
         
-        self.potential = None
-        if 'Potential' in data.keys():
-            self.potential = np.empty(data['Potential'].shape, data['Potential'].dtype)
-            data['Potential'].read_direct(self.potential)
+        if fields is not None:
+            self.load(fields)
+    
+    def _load(self, name):
+        if name not in self._cache:
+            if self._data is None:
+                raise KeyError("The field '{0:s}' wasn't read with the particles; add it to fields".format(
+                               self._field_name(name)))
+            value = None
+            if name in self._data.keys():
+                value = self._data[name][self._sel]
+            self._cache[name] = value
+        return self._cache[name]
+    
+    def _field_name(self, name):
+        """The name in `fields` of the dataset `name`"""
+        if name == 'Masses':
+            return 'mass'
+        for f in self.fields:
+            attr = getattr(type(self), f)
+            if isinstance(attr, _dataset) and attr.name == name:
+                return f
+        return name
+    
+    def load(self, fields=None):
+        """Read `fields` (or all of them, if None) now
         
-        # Some useful aliases
-        self.pos = self.positions
-        self.vel = self.velocities
-        self.pot = self.potential
+            Fields this particle type doesn't have are skipped so that the
+            same list can be used for every type.
+        """
+        for f in (self.fields if fields is None else fields):
+            if hasattr(type(self), f):
+                getattr(self, f)
+        return self
+    
+    def detach(self):
+        """Drop the file, keeping only the fields that have been read (the others then raise a KeyError)"""
+        self._data = None
+        return self
+    
+    def __getstate__(self):
+        # Only the fields that have been read can be pickled
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+    
+    @property
+    def mass(self):
+        if 'Masses' not in self._cache and self._mass > 0.0:
+            self._cache['Masses'] = self._mass * np.ones(self.size, dtype=np.float32)
+        return self._load('Masses')
+    
+    @mass.setter
+    def mass(self, value):
+        self._cache['Masses'] = value
 
 class star_particle(basic_particle):
-    def __init__(self, data, mass):
-        super().__init__(data, mass)
-
-        self.t_form = None
-        if 'StellarFormationTime' in data.keys():
-            self.t_form = np.empty(data['StellarFormationTime'].shape, data['StellarFormationTime'].dtype)
-            data['StellarFormationTime'].read_direct(self.t_form)
-        
-        self.metals = None
-        if 'Metallicity' in data.keys():
-            self.metals = np.empty(data['Metallicity'].shape, data['Metallicity'].dtype)
-            data['Metallicity'].read_direct(self.metals)
+    fields = basic_particle.fields + ['t_form', 'metals']
+    
+    t_form = _dataset('StellarFormationTime')
+    metals = _dataset('Metallicity')
 
 class gas_particle(basic_particle):
-    def __init__(self, data, mass):
-        super().__init__(data, mass)
-
-        self.internal_energy = np.empty(data['InternalEnergy'].shape, data['InternalEnergy'].dtype)
-        data['InternalEnergy'].read_direct(self.internal_energy)
-
-        self.density = None   
-        if 'Density' in data.keys():
-            self.density = np.empty(data['Density'].shape, data['Density'].dtype)
-            data['Density'].read_direct(self.density)
-
-        self.hsml = None        
-        if 'SmoothingLength' in data.keys():
-            self.hsml = np.empty(data['SmoothingLength'].shape, data['SmoothingLength'].dtype)
-            data['SmoothingLength'].read_direct(self.hsml)
-
-        self.electron_density = None
-        if 'ElectronAbundance' in data.keys():
-            self.electron_density = np.empty(data['ElectronAbundance'].shape, data['ElectronAbundance'].dtype)
-            data['ElectronAbundance'].read_direct(self.electron_density)
-        
-        self.sfr = None
-        if 'StarFormationRate' in data.keys():
-            self.sfr = np.empty(data['StarFormationRate'].shape, data['StarFormationRate'].dtype)
-            data['StarFormationRate'].read_direct(self.sfr)
-        
-        self.metals = None
-        if 'Metallicity' in data.keys():
-            self.metals = np.empty(data['Metallicity'].shape, data['Metallicity'].dtype)
-            data['Metallicity'].read_direct(self.metals)
+    fields = basic_particle.fields + ['internal_energy', 'density', 'hsml', 'electron_density', 'sfr', 'metals', 'temperature']
+    
+    internal_energy = _dataset('InternalEnergy')
+    density = _dataset('Density')
+    hsml = _dataset('SmoothingLength')
+    electron_density = _dataset('ElectronAbundance')
+    sfr = _dataset('StarFormationRate')
+    metals = _dataset('Metallicity')
+    
+    # Set temperature from internal energy when it is first used. This uses the
+    # default GADGET units; call convert_U_to_temperature directly for others.
+    @property
+    def temperature(self):
+        if 'temperature' not in self._cache:
+            self._cache['temperature'] = convert_U_to_temperature(self)
+        return self._cache['temperature']
+    
+    # Some useful aliases
+    temp = temperature
+    U = internal_energy
+    rho = density
+    Ne = electron_density
 
-        # Set temperature from internal energy
-        # NOTE: This must be done _after_ reading metals and electron density
-        self.temperature = convert_U_to_temperature(self)
-        
-        # Some useful aliases
-        self.temp = self.temperature
-        self.U = self.internal_energy
-        self.rho = self.density
-        self.Ne = self.electron_density
+# The HDF5 group index and particle class of each GADGET particle type
+particle_types = {
+    'gas'     : (0, gas_particle),
+    'halo'    : (1, basic_particle),
+    'disk'    : (2, basic_particle),
+    'bulge'   : (3, star_particle),
+    'stars'   : (4, star_particle),
+    'boundary': (5, basic_particle)
+}
 
 class Header():
     def __init__(self, attrs):
         self.numpart_thisfile = attrs['NumPart_ThisFile'][()]
         self.numpart_total = attrs['NumPart_Total'][()]
         self.numpart_total_highword = attrs['NumPart_Total_HighWord'][()]
+        
+        # Number of particles of each type across all files of the snapshot
+        self.total_numpart = self.numpart_total.astype(np.uint64) + \
+                             (self.numpart_total_highword.astype(np.uint64) << np.uint64(32))
         self.masstable = attrs['MassTable'][()]
         self.time = float(attrs['Time'])
         self.redshift = float(attrs['Redshift'])
@@ -166,6 +280,7 @@ class parameter_file():
 
     @classmethod
     def from_hdf5(cls, hdf5_file):
+        import h5py
         c = cls()
         if not isinstance(hdf5_file, h5py.File):
             with h5py.File(hdf5_filename) as f:
@@ -179,6 +294,7 @@ class parameter_file():
             self.data[x[0].decode('ascii')] = x[1].decode('ascii')
     
     def write_to_hdf5(self, hdf5_file):
+        import h5py
         dt = h5py.special_dtype(vlen=bytes)
         params = [[str(k).encode('ascii'), str(v).encode('ascii')] for k, v in self.data.items()]
         hdf5_file.create_dataset('parameters', (len(params), 2), dtype=dt, data=params)
@@ -207,8 +323,16 @@ class parameter_file():
         return '\n'.join(['{0:s} => {1:s}'.format(k, str(v)) for k, v in self.data.items()])
 
 class File:
-    def __init__(self, fname, mode='r'):
+    """A single GADGET HDF5 file
+    
+        Particle fields are read from the file when they are first used. If
+        `fields` is given (e.g., ['pos', 'mass']), those fields are read as
+        soon as a particle type is accessed and the others only on demand.
+    """
+    def __init__(self, fname, mode='r', fields=None):
+        import h5py
         self.file = h5py.File(fname, mode)
+        self.fields = fields
         self.header = Header(self.file['Header'].attrs)
         self.gas_particles = None
         self.halo_particles = None
@@ -241,39 +365,216 @@ class File:
     def params(self, p):
         self._params = p
     
+    def _group(self, part_type):
+        name = 'PartType{0:d}'.format(particle_types[part_type][0])
+        return self.file[name] if name in self.file.keys() else None
+    
+    def num_particles(self, part_type):
+        """The number of particles of `part_type` in this file"""
+        data = self._group(part_type)
+        return 0 if data is None else data['Coordinates'].shape[0]
+    
+    def chunks(self, part_type, chunk_size, start=None, stop=None):
+        """Iterate over the particles [start, stop) of `part_type` in blocks of at most `chunk_size` particles
+        
+            Only one block is held in memory at a time.
+        """
+        data = self._group(part_type)
+        if data is None:
+            return
+        index, particle = particle_types[part_type]
+        start, stop, _ = slice(start, stop).indices(data['Coordinates'].shape[0])
+        for first in range(start, stop, chunk_size):
+            yield particle(data, self.header.masstable[index], first, min(first + chunk_size, stop), self.fields)
+    
     @property
     def gas(self):
         if self.gas_particles is None and 'PartType0' in self.file.keys():
-            self.gas_particles = gas_particle(self.file['PartType0'], self.header.masstable[0])
+            self.gas_particles = gas_particle(self.file['PartType0'], self.header.masstable[0], fields=self.fields)
         return self.gas_particles
 
     @property
     def halo(self):
         if self.halo_particles is None and 'PartType1' in self.file.keys():
-            self.halo_particles = basic_particle(self.file['PartType1'], self.header.masstable[1])
+            self.halo_particles = basic_particle(self.file['PartType1'], self.header.masstable[1], fields=self.fields)
         return self.halo_particles
     
     @property
     def disk(self):
         if self.disk_particles is None and 'PartType2' in self.file.keys():
-            self.disk_particles = basic_particle(self.file['PartType2'], self.header.masstable[2])
+            self.disk_particles = basic_particle(self.file['PartType2'], self.header.masstable[2], fields=self.fields)
         return self.disk_particles
         
     @property
     def bulge(self):
         if self.bulge_particles is None and 'PartType3' in self.file.keys():
-            self.bulge_particles = star_particle(self.file['PartType3'], self.header.masstable[3])
+            self.bulge_particles = star_particle(self.file['PartType3'], self.header.masstable[3], fields=self.fields)
         return self.bulge_particles
     
     @property
     def stars(self):
         if self.star_particles is None and 'PartType4' in self.file.keys():
-            self.star_particles = star_particle(self.file['PartType4'], self.header.masstable[4])
+            self.star_particles = star_particle(self.file['PartType4'], self.header.masstable[4], fields=self.fields)
         return self.star_particles
 
     @property
     def boundary(self):
         if self.boundary_particles is None and 'PartType5' in self.file.keys():
-            self.boundary_particles = basic_particle(self.file['PartType5'], self.header.masstable[5])
+            self.boundary_particles = basic_particle(self.file['PartType5'], self.header.masstable[5], fields=self.fields)
         return self.boundary_particles
 
+
+def _snapshot_files(fname):
+    """Find all of the files of the snapshot containing `fname`
+    
+        `fname` is either one of the files of a multi-file snapshot (snap_000.3.hdf5),
+        its base name (snap_000 or snap_000.hdf5), or a single-file snapshot.
+    """
+    match = re.match(r'^(.*)\.(\d+)\.hdf5$', fname)
+    if match is not None:
+        base = match.group(1)
+    elif os.path.isfile(fname):
+        return [fname]
+    else:
+        base = fname[:-len('.hdf5')] if fname.endswith('.hdf5') else fname
+    
+    first = base + '.0.hdf5'
+    if not os.path.isfile(first):
+        if os.path.isfile(fname):
+            return [fname]
+        raise IOError('Unable to find GADGET snapshot {0:s}'.format(fname))
+    
+    import h5py
+    with h5py.File(first, 'r') as f:
+        nfiles = int(f['Header'].attrs['NumFilesPerSnapshot'])
+    
+    # A single-file snapshot that happens to have a numeric suffix
+    if nfiles == 1 and os.path.isfile(fname) and fname != first:
+        return [fname]
+    
+    files = ['{0:s}.{1:d}.hdf5'.format(base, i) for i in range(nfiles)]
+    missing = [f for f in files if not os.path.isfile(f)]
+    if missing:
+        raise IOError('Snapshot {0:s} is missing {1:d} of {2:d} files (e.g., {3:s})'.format(base, len(missing), nfiles, missing[0]))
+    return files
+
+def find_snapshots(patterns):
+    """The distinct snapshots named by `patterns`, each as the list of its files
+    
+        Each pattern is a file or base name as accepted by Snapshot, or a glob
+        pattern (e.g., output/snap_*.hdf5). A multi-file snapshot matched by
+        several of its files is listed once, where it was first matched.
+    """
+    snapshots = collections.OrderedDict()
+    for pattern in patterns:
+        names = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not names:
+            raise IOError('No GADGET snapshots match {0:s}'.format(pattern))
+        for name in names:
+            files = _snapshot_files(name)
+            snapshots.setdefault(tuple(files), files)
+    return list(snapshots.values())
+
+def _read_chunk(filename, part_type, start, stop, fields):
+    """Read `fields` of the particles [start, stop) of `part_type` from one file of a snapshot
+    
+        This runs in the worker processes of a Snapshot, so it opens its own file.
+        All fields are read if `fields` is None.
+    """
+    import h5py
+    index, particle = particle_types[part_type]
+    with h5py.File(filename, 'r') as f:
+        masstable = f['Header'].attrs['MassTable'][()]
+        p = particle(f['PartType{0:d}'.format(index)], masstable[index], start, stop)
+        # The file is closed on return, so whether or not the particles are sent
+        # back from a worker, only the fields read here are available.
+        return p.load(fields).detach()
+
+class Snapshot():
+    """A GADGET snapshot that may be split over several HDF5 files
+    
+        The particles of each type are read from the files in order and handed
+        out in blocks of at most `chunk_size` particles. When `nworkers` > 1, the
+        blocks are read concurrently by a pool of processes (or threads, if
+        `use_threads` is True), but are still returned in snapshot order.
+        
+        Only the `fields` of each block (all fields if None) are read.
+    """
+    def __init__(self, fname, nworkers=1, use_threads=False, fields=None):
+        import h5py
+        self.filenames = _snapshot_files(fname)
+        self.fields = fields
+        
+        # The name of the snapshot without the file number (e.g., snap_000)
+        self.name = self.filenames[0]
+        if len(self.filenames) > 1:
+            self.name = self.filenames[0][:-len('.0.hdf5')]
+        
+        self.numpart_thisfile = []
+        for name in self.filenames:
+            with h5py.File(name, 'r') as f:
+                hdr = Header(f['Header'].attrs)
+                self.numpart_thisfile.append(hdr.numpart_thisfile)
+                if name == self.filenames[0]:
+                    self.header = hdr
+        
+        self.nworkers = int(nworkers)
+        self.executor = None
+        if self.nworkers > 1:
+            import concurrent.futures as cf
+            pool = cf.ThreadPoolExecutor if use_threads else cf.ProcessPoolExecutor
+            self.executor = pool(max_workers=self.nworkers)
+    
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False  # always re-raise exceptions
+    
+    def num_particles(self, part_type):
+        """The number of particles of `part_type` in the whole snapshot"""
+        return int(self.header.total_numpart[particle_types[part_type][0]])
+    
+    def dataset_dtype(self, part_type, name):
+        """The type of the dataset `name` of `part_type`, or None if the particles don't have it"""
+        import h5py
+        index = particle_types[part_type][0]
+        for filename, counts in zip(self.filenames, self.numpart_thisfile):
+            if int(counts[index]) > 0:
+                with h5py.File(filename, 'r') as f:
+                    group = f['PartType{0:d}'.format(index)]
+                    return group[name].dtype if name in group else None
+        return None
+    
+    def chunks(self, part_type, chunk_size, fields=None):
+        """Iterate over the particles of `part_type` in blocks of at most `chunk_size` particles
+        
+            `fields` replaces the fields given to the snapshot, if not None.
+        """
+        index = particle_types[part_type][0]
+        fields = self.fields if fields is None else fields
+        tasks = []
+        for name, counts in zip(self.filenames, self.numpart_thisfile):
+            size = int(counts[index])
+            tasks.extend((name, part_type, start, min(start + chunk_size, size), fields)
+                         for start in range(0, size, chunk_size))
+        
+        if self.executor is None:
+            for t in tasks:
+                yield _read_chunk(*t)
+            return
+        
+        # Keep only a few blocks in flight so that memory use stays bounded
+        pending = collections.deque()
+        for t in tasks:
+            pending.append(self.executor.submit(_read_chunk, *t))
+            if len(pending) > self.nworkers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -10,136 +10,206 @@ import gadget
 import ChaNGa
 import tipsy
 import argparse
+import concurrent.futures
+import contextlib
 import math
 import numpy as np
+import os
+import pipeline
 
 parser = argparse.ArgumentParser(description='Convert GADGET2 files to ChaNGa files')
-parser.add_argument('gadget_file', metavar='GADGET', help='GADGET2 HDF5 file to convert')
+parser.add_argument('gadget_files', metavar='GADGET', nargs='+', help='GADGET2 HDF5 files or glob patterns to convert (for multi-file snapshots, any of the files or their base name)')
 parser.add_argument('param_file', metavar='Parameter', help='GADGET2 parameter file to convert')
 parser.add_argument('out_dir', metavar='out_dir', help='Location of output')
 parser.add_argument('--preserve-boundary-softening', action='store_true', help='Preserve softening lengths for boundary particles')
 parser.add_argument('--no-param-list', action='store_true', help='Do not store a complete list ChaNGa parameters in "param_file"')
 parser.add_argument('--generations', type=int, help='Number of generations of stars each gas particle can spawn (see GENERATIONS in Gadget)')
 parser.add_argument('--viscosity', action='store_true', help='Use artificial bulk viscosity')
-args = parser.parse_args()
+parser.add_argument('--jobs', type=int, default=1, help='Number of processes converting snapshots at the same time (default: %(default)s)')
+parser.add_argument('--force', action='store_true', help='Convert snapshots whose outputs are already up to date')
+parser.add_argument('--sort', action='store_true', help='Sort the particles along a space-filling curve and write a spatial index of the Tipsy file')
+parser.add_argument('--read-workers', type=int, default=1, help='Number of processes reading the GADGET files (default: %(default)s)')
+parser.add_argument('--write-threads', type=int, default=1, help='Number of threads encoding the Tipsy file (default: %(default)s)')
+parser.add_argument('--chunk-size', type=int, default=2**20, help='Number of particles to convert at a time (default: %(default)s)')
+parser.add_argument('--queue-depth', type=int, default=2, help='Number of chunks buffered between reading, converting, and writing (default: %(default)s)')
 
-print("Converting {0:s}".format(args.gadget_file))
+# Only the fields written to the Tipsy file are read
+fields = ['positions', 'velocities', 'mass', 'potential', 'internal_energy', 'density', 'hsml',
+          'electron_density', 'metals', 't_form']
 
-try:
-    gadget_params = gadget.parameter_file(args.param_file)
-except Exception as e:
-    print('\nERROR: {0:s}\n\n'.format(str(e)))
-    parser.print_help()
-    exit()
+# The ChaNGa parameters with and without gas, converted once per process
+_changa_params = {}
+
+def changa_parameters(gadget_params, args, snapshot, has_gas):
+    """The ChaNGa parameters of the snapshot named `snapshot`"""
+    # Only achInFile depends on the snapshot
+    if has_gas not in _changa_params:
+        _changa_params[has_gas] = ChaNGa.convert_parameter_file(gadget_params, args, has_gas, snapshot)
+    changa_params = dict(_changa_params[has_gas])
+    changa_params['achInFile'] = ChaNGa.get_tipsy_file(snapshot, args.out_dir)
+    return changa_params
+
+def up_to_date(basename, inputs, size, indexed, has_ids):
+    """Whether the Tipsy file `basename` has `size` bytes and it and its parameter file (and index and IDs) are newer than `inputs`"""
+    try:
+        outputs = [os.stat(basename), os.stat(basename + '.ChaNGa.params')]
+        if indexed:
+            outputs.append(os.stat(basename + '.index'))
+        if has_ids:
+            outputs.append(os.stat(basename + '.iord'))
+    except FileNotFoundError:
+        return False
+    newest = max(os.path.getmtime(f) for f in inputs)
+    return outputs[0].st_size == size and all(s.st_mtime >= newest for s in outputs)
+
+def convert_snapshot(filename, gadget_params, args):
+    """Convert the snapshot containing `filename` unless its outputs are up to date"""
+    with gadget.Snapshot(filename, args.read_workers, fields=fields) as gadget_file:
+        # Name the outputs after the snapshot rather than one of its files
+        snapshot = gadget_file.name
+        basename = ChaNGa.get_tipsy_file(snapshot, args.out_dir)
+
+        time = float(gadget_file.header.time)
+        is_cosmological = int(gadget_params['ComovingIntegrationOn']) == 1
+
+        # The Gadget particle types in the order of the Tipsy file, with the Tipsy family
+        # and the softening parameter each is written with.
+        families = [('gas', 'gas', None), ('halo', 'darkmatter', 'SofteningHalo')]
+
+        # In ChaNGa, cosmological simulations treat disk and bulge particles
+        # as dark matter particles
+        if is_cosmological:
+            families += [('disk', 'darkmatter', 'SofteningDisk'), ('bulge', 'darkmatter', 'SofteningBulge')]
+
+        # Convert boundary particles to dark matter particles
+        eps = 'SofteningBndry' if args.preserve_boundary_softening else 'SofteningHalo'
+        families.append(('boundary', 'darkmatter', eps))
+
+        if not is_cosmological:
+            families += [('disk', 'stars', 'SofteningDisk'), ('bulge', 'stars', 'SofteningBulge')]
+        families.append(('stars', 'stars', 'SofteningStars'))
+
+        def count(family):
+            return sum(gadget_file.num_particles(p) for p, f, _ in families if f == family)
+
+        counts = count('gas'), count('darkmatter'), count('stars')
+
+        # The particle IDs are written to the auxiliary array basename.iord when every type has them
+        id_types = [gadget_file.dataset_dtype(p, 'ParticleIDs') for p, _, _ in families if gadget_file.num_particles(p) > 0]
+        has_ids = len(id_types) > 0 and all(t is not None for t in id_types)
+        chunk_fields = fields + ['ids'] if has_ids else fields
+
+        inputs = gadget_file.filenames + [args.param_file]
+        if not args.force and up_to_date(basename, inputs, tipsy.file_size(*counts), args.sort, has_ids):
+            print("Skipping {0:s} (up to date)".format(snapshot))
+            return
+
+        print("Converting {0:s}".format(snapshot))
+        changa_params = changa_parameters(gadget_params, args, snapshot, gadget_file.num_particles('gas') > 0)
+
+        # Output the parameter file
+        with open(basename + '.ChaNGa.params', 'w') as f:
+            for k in sorted(changa_params):
+                 f.write('{0:20s} = {1:s}\n'.format(k, str(changa_params[k])))
+
+            if not args.no_param_list:
+                f.write('\n# Complete parameter list below\n')
+                f.write(ChaNGa.all_parameters)
+
+        # Gadget units have an extra sqrt(a) in the internal velocities
+        velocity_scale = math.sqrt(1.0 + float(gadget_file.header.redshift))
+
+        def scale(particles):
+            particles.mass *= changa_params['dMsolUnit']
+            particles.velocities *= velocity_scale
+
+        def read():
+            """Read each particle type args.chunk_size particles at a time"""
+            for part_type, family, softening in families:
+                for chunk in gadget_file.chunks(part_type, args.chunk_size, chunk_fields):
+                    yield family, softening, chunk
+
+        def convert(item):
+            """Convert a chunk to ChaNGa units and the columns of its Tipsy family"""
+            family, softening, p = item
+            # Absent fields are written as constants without allocating placeholder arrays
+            def column(x):
+                return x if x is not None else tipsy.constant(0.0)
+
+            def particle_ids(p):
+                return p.ids if has_ids else None
+
+            if family == 'gas':
+                # Computed once here in the simulation's units (gas.temperature would use the defaults)
+                temp = gadget.convert_U_to_temperature(p, gadget_params)
+                scale(p)
+                return family, (p.mass, p.positions, p.velocities, p.density, temp, p.hsml, column(p.metals),
+                                column(p.potential), p.size), particle_ids(p)
+
+            scale(p)
+            if family == 'darkmatter':
+                return family, (p.mass, p.positions, p.velocities, float(gadget_params[softening]), column(p.potential),
+                                p.size), particle_ids(p)
+            return family, (p.mass, p.positions, p.velocities, column(getattr(p, 'metals', None)),
+                            column(getattr(p, 't_form', None)), float(gadget_params[softening]), column(p.potential),
+                            p.size), particle_ids(p)
+
+        if not has_ids and os.path.exists(basename + '.iord'):
+            # Don't leave the IDs of a previous conversion next to the new file
+            os.unlink(basename + '.iord')
+
+        with contextlib.ExitStack() as outputs:
+            file = outputs.enter_context(tipsy.streaming_writer(basename, nthreads=args.write_threads))
+            # Size the output from the snapshot totals. If fewer particles
+            # are written, the writer corrects the header when it is closed.
+            file.header(time, *counts)
+
+            iord = None
+            if has_ids:
+                iord = tipsy.aux_writer(basename + '.iord', sum(counts), np.result_type(*id_types))
+                outputs.enter_context(iord)
+
+            # Reading the snapshot, converting units, and encoding the Tipsy file
+            # overlap, with at most args.queue_depth chunks waiting between them.
+            def write(item):
+                family, columns, ids = item
+                getattr(file, family)(*columns)
+                if iord is not None:
+                    iord.write(ids)
+
+            pipeline.run(read(), [convert], write, args.queue_depth)
+
+    if args.sort:
+        tipsy.spatial_sort(basename, chunk_size=args.chunk_size, aux=['.iord'] if has_ids else [])
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    try:
+        gadget_params = gadget.parameter_file(args.param_file)
+        snapshots = gadget.find_snapshots(args.gadget_files)
+    except Exception as e:
+        print('\nERROR: {0:s}\n\n'.format(str(e)))
+        parser.print_help()
+        exit()
+
+    # A failed snapshot is reported without stopping the others
+    failed = []
+    def report(filename, error):
+        print('ERROR: converting {0:s}: {1:s}'.format(filename, str(error)))
+        failed.append(filename)
 
-gadget_file = gadget.File(args.gadget_file)
-changa_params = ChaNGa.convert_parameter_file(gadget_params, args, gadget_file.gas is not None)
-basename = args.out_dir + '/' + ChaNGa.get_input_file(args.gadget_file) + '.tipsy'
-
-# Output the parameter file
-with open(basename + '.ChaNGa.params', 'w') as f:
-    for k in sorted(changa_params):
-         f.write('{0:20s} = {1:s}\n'.format(k, str(changa_params[k])))
-
-    if not args.no_param_list:
-        f.write('\n# Complete parameter list below\n')
-        f.write(ChaNGa.all_parameters)
-
-##################################################################################
-time = float(gadget_file.header.time)
-is_cosmological = int(gadget_params['ComovingIntegrationOn']) == 1
-
-# Gadget units have an extra sqrt(a) in the internal velocities
-velocity_scale = math.sqrt(1.0 + float(gadget_file.header.redshift))
-
-with tipsy.streaming_writer(basename) as file:
-    ngas = ndark = nstar = 0
-    
-    # just a placeholder
-    file.header(time, ngas, ndark, nstar)
-    
-    if gadget_file.gas is not None:
-        gas = gadget_file.gas
-        ngas += gas.size
-        temp = gadget.convert_U_to_temperature(gas, gadget_params)
-        gas.mass *= changa_params['dMsolUnit']
-        gas.velocities *= velocity_scale
-        metals = gas.metals if gas.metals is not None else np.zeros(gas.size)
-        pot = gas.potential if gas.potential is not None else np.zeros(gas.size)
-        file.gas(gas.mass, gas.positions, gas.velocities, gas.density, temp, gas.hsml, metals, pot, gas.size)
-    
-    if gadget_file.halo is not None:
-        halo = gadget_file.halo
-        ndark += halo.size
-        halo.mass *= changa_params['dMsolUnit']
-        halo.velocities *= velocity_scale
-        pot = halo.potential if halo.potential is not None else np.zeros(halo.size)
-        file.darkmatter(halo.mass, halo.positions, halo.velocities, gadget_params['SofteningHalo'], pot, halo.size)
-        
-    # In ChaNGa, cosmological simulations treat disk and bulge particles
-    # as dark matter particles
-    if is_cosmological:
-        if gadget_file.disk is not None:
-            disk = gadget_file.disk
-            ndark += disk.size
-            disk.mass *= changa_params['dMsolUnit']
-            disk.velocities *= velocity_scale
-            pot = disk.potential if disk.potential is not None else np.zeros(disk.size)
-            file.darkmatter(disk.mass, disk.positions, disk.velocities, gadget_params['SofteningDisk'], pot, disk.size)
-        
-        if gadget_file.bulge is not None:
-            bulge = gadget_file.bulge
-            ndark += bulge.size
-            bulge.mass *= changa_params['dMsolUnit']
-            bulge.velocities *= velocity_scale
-            pot = bulge.potential if bulge.potential is not None else np.zeros(bulge.size)
-            file.darkmatter(bulge.mass, bulge.positions, bulge.velocities, gadget_params['SofteningBulge'], pot, bulge.size)
-    
-    # Convert boundary particles to dark matter particles
-    if gadget_file.boundary is not None:
-        boundary = gadget_file.boundary
-        ndark += boundary.size
-        boundary.mass *= changa_params['dMsolUnit']
-        boundary.velocities *= velocity_scale
-        eps = gadget_params['SofteningBndry'] if args.preserve_boundary_softening else gadget_params['SofteningHalo']
-        pot = boundary.potential if boundary.potential is not None else np.zeros(boundary.size)
-        file.darkmatter(boundary.mass, boundary.positions, boundary.velocities, eps, pot, boundary.size)
-        
-    if not is_cosmological:
-        if gadget_file.disk is not None:
-            disk = gadget_file.disk
-            nstar += disk.size
-            disk.mass *= changa_params['dMsolUnit']
-            disk.velocities *= velocity_scale
-            metals = np.zeros(disk.size)
-            tform = np.zeros(disk.size)
-            pot = disk.potential if disk.potential is not None else np.zeros(disk.size)
-            file.stars(disk.mass, disk.positions, disk.velocities, metals, tform, gadget_params['SofteningDisk'],
-                       pot, disk.size)
-            metals = tform = None
-        
-        if gadget_file.bulge is not None:
-            bulge = gadget_file.bulge
-            nstar += bulge.size
-            bulge.mass *= changa_params['dMsolUnit']
-            bulge.velocities *= velocity_scale
-            metals = bulge.metals if bulge.metals is not None else np.zeros(bulge.size)
-            tform = bulge.t_form if bulge.t_form is not None else np.zeros(bulge.size)
-            pot = bulge.potential if bulge.potential is not None else np.zeros(bulge.size)
-            file.stars(bulge.mass, bulge.positions, bulge.velocities, metals, tform,
-                       gadget_params['SofteningBulge'], pot, bulge.size)
-
-    if gadget_file.stars is not None:
-        star = gadget_file.stars
-        nstar += star.size
-        star.mass *= changa_params['dMsolUnit']
-        star.velocities *= velocity_scale
-        metals = star.metals if star.metals is not None else np.zeros(star.size)
-        tform = star.t_form if star.t_form is not None else np.zeros(star.size)
-        pot = star.potential if star.potential is not None else np.zeros(star.size)
-        file.stars(star.mass, star.positions, star.velocities, metals, tform,
-                   gadget_params['SofteningStars'], pot, star.size)
-
-# update the header
-with tipsy.streaming_writer(basename, 'r+b') as file:
-    file.header(time, ngas, ndark, nstar)
+    if args.jobs > 1 and len(snapshots) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = {pool.submit(convert_snapshot, files[0], gadget_params, args): files[0] for files in snapshots}
+            for future in concurrent.futures.as_completed(futures):
+                if future.exception() is not None:
+                    report(futures[future], future.exception())
+    else:
+        for files in snapshots:
+            try:
+                convert_snapshot(files[0], gadget_params, args)
+            except Exception as e:
+                report(files[0], e)
+    if failed:
+        exit(1)
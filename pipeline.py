@@ -0,0 +1,94 @@
+import queue
+import threading
+
+"""
+    A pipeline of stages connected by bounded queues
+
+    Each stage runs in its own thread, so a stage that waits on I/O (or
+    calls into C code that releases the GIL) overlaps with the others.
+"""
+
+# Sent down the pipeline after the last item
+_done = object()
+
+class _failure():
+    """An exception raised by a stage, passed on so that the caller can re-raise it"""
+    def __init__(self, exc):
+        self.exc = exc
+
+def run(source, stages, sink, depth=2):
+    """
+        Feed the items of the iterable `source` through each function of `stages` into `sink`
+
+        The source and every stage run in their own threads, and the sink runs in
+        the caller's. At most `depth` items wait between two neighbouring stages, so
+        a slow stage stalls the ones before it instead of accumulating items. Items
+        reach the sink in the order of the source. The first exception raised by
+        any stage is re-raised here once the pipeline has stopped.
+    """
+    if depth < 1:
+        raise ValueError('The pipeline depth must be at least 1')
+
+    queues = [queue.Queue(maxsize=depth) for _ in range(len(stages) + 1)]
+    stop = threading.Event()
+
+    # Blocking calls give up once the pipeline is stopped (e.g., the sink failed)
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _done
+
+    def produce():
+        try:
+            for item in source:
+                if not put(queues[0], item):
+                    return
+        except BaseException as e:
+            put(queues[0], _failure(e))
+        else:
+            put(queues[0], _done)
+
+    def transform(func, inq, outq):
+        while True:
+            item = get(inq)
+            if item is _done or isinstance(item, _failure):
+                put(outq, item)
+                return
+            try:
+                item = func(item)
+            except BaseException as e:
+                put(outq, _failure(e))
+                return
+            if not put(outq, item):
+                return
+
+    threads = [threading.Thread(target=produce, daemon=True)]
+    for func, inq, outq in zip(stages, queues, queues[1:]):
+        threads.append(threading.Thread(target=transform, args=(func, inq, outq), daemon=True))
+    for t in threads:
+        t.start()
+
+    try:
+        while True:
+            item = get(queues[-1])
+            if item is _done:
+                break
+            if isinstance(item, _failure):
+                raise item.exc
+            sink(item)
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
@@ -6,7 +6,7 @@ use File::Copy qw(copy);
 die "Usage: $0 input.hdf5\n" if (@ARGV != 1);
 my $input_file = $ARGV[0];
 
-if (! -e '../libtipsy.so') {
+if (! glob('../_tipsy*.so')) {
 	execute(qq(
 		cd ..
 		make
@@ -1,5 +1,7 @@
 import os
-import pickle
+import binning
+import cache
+import constants
 import gadget
 import tipsy
 import numpy as np
@@ -13,21 +15,6 @@ def get_output_file(file_name):
     
     return input_dir + input_file_basename
 
-def bin2d(x, y, nbins, weights=None, center=True):
-    hist, X, Y = np.histogram2d(x, y, bins=nbins, weights=weights)
-    x_grid, y_grid = np.meshgrid(X, Y)
-    
-    if center:
-        x_grid = (x_grid[1:, 1:] + x_grid[:-1, :-1]) / 2.0
-        y_grid = (y_grid[1:, 1:] + y_grid[:-1, :-1]) / 2.0
-
-    return hist, x_grid, y_grid
-
-def select_slab2D(pos, x_lim, y_lim):
-    x_mask = (np.abs(pos[:, 0]) <= x_lim)
-    y_mask = (np.abs(pos[:, 1]) <= y_lim)
-    return x_mask & y_mask
-
 class processed_data:
     def __init__(self):
         self.time = None
@@ -37,65 +24,85 @@ class processed_data:
         self.gas_smd = None
         self.temp_grid = None
 
-def load_snapshot(filename):
-    with open(filename, 'rb') as f:
-        disk = pickle.load(f)
-        return disk
+# The maps of each snapshot, keyed on the snapshot and the parameters they were made with.
+# Bump _version when the processing changes.
+_cache = cache.cache(os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache'), max_bytes=2**30)
+_version = 1
 
-def _process_snapshot(stars, gas, mass_factor, nbins, limits):
+def _process_snapshot(stars, gas, mass_factor, nbins, limits, nworkers=1):
     disk = processed_data()
-   
-    slab_mask = select_slab2D(stars.pos, *limits)
-    x, y = stars.pos[:, 0][slab_mask], stars.pos[:, 1][slab_mask]
-    mass, disk.x_grid, disk.y_grid = bin2d(x, y, nbins, weights=stars.mass[slab_mask])
-    mass *= mass_factor
-    bin_area = 1.0e6 * (2.0 * limits[0]) * (2.0 * limits[1]) / (1.0 * nbins * nbins)  # pc^2
-    disk.stellar_smd = mass / bin_area
     
-    if gas:
-        slab_mask = select_slab2D(gas.pos, *limits)
-        x, y = gas.pos[:, 0][slab_mask], gas.pos[:, 1][slab_mask]
-        mass = bin2d(x, y, nbins, weights=gas.mass[slab_mask])[0]
-        mass *= mass_factor
-        disk.gas_smd = mass / bin_area
-        
-        temp = bin2d(x, y, nbins, weights=gas.temp[slab_mask])[0]
-        disk.temp_grid = temp / bin_area
+    # Each family is read once, a chunk at a time, for all of its maps
+    stellar = binning.bin_particles(stars, {'mass': 'mass'}, limits, nbins, nworkers=nworkers)
+    disk.x_grid, disk.y_grid = stellar.centers()
+    bin_area = 1.0e6 * stellar.bin_area  # pc^2
+    disk.stellar_smd = stellar['mass'] * mass_factor / bin_area
+    
+    if gas is not None:
+        grid = binning.bin_particles(gas, {'mass': 'mass', 'temp': 'temp'}, limits, nbins, nworkers=nworkers)
+        disk.gas_smd = grid['mass'] * mass_factor / bin_area
+        disk.temp_grid = grid['temp'] / bin_area
     
     return disk
 
-def process_changa_snapshot(input_file, output_file, limits, nbins=512, is_xdr=True):
-    if os.path.isfile(output_file):
-        return load_snapshot(output_file)
+def process_changa_snapshot(input_file, limits, nbins=512, is_xdr=True, nworkers=1):
+    params = {'version': _version, 'type': 'changa', 'limits': list(limits), 'nbins': nbins, 'is_xdr': is_xdr}
+    disk = _cache.get(input_file, params)
+    if disk is not None:
+        return disk
 
-    from astropy import units as u
-    from astropy.constants import G as G_u
-    unitlength = 1.0 * u.kpc
-    unitvelocity = 1.0 * u.km / u.s
-    unittime = (unitlength / unitvelocity).to(u.s)
-    mass_factor = float((unitlength.to(u.m) ** 3 / unittime ** 2 / G_u).to(u.Msun) / u.Msun)
+    # The mass unit (in Msun) of ChaNGa's kpc and km/s units with G = 1
+    unittime = constants.kpc / constants.km
+    mass_factor = constants.kpc ** 3 / unittime ** 2 / constants.G / constants.M_sun
 
     with tipsy.File(input_file, is_xdr=is_xdr) as snap:
-        disk = _process_snapshot(snap.stars, snap.gas, mass_factor, nbins, limits)
-        disk.time = snap.header.time
+        time, has_gas = snap.header.time, snap.header.ngas > 0
     
-    with open(output_file, 'wb') as f:
-        pickle.dump(disk, f, pickle.HIGHEST_PROTOCOL)
+    stars = binning.tipsy_source(input_file, 'stars', is_xdr=is_xdr)
+    gas = binning.tipsy_source(input_file, 'gas', is_xdr=is_xdr) if has_gas else None
+    disk = _process_snapshot(stars, gas, mass_factor, nbins, limits, nworkers)
+    disk.time = float(time)
     
-    return disk
+    return _cache.put(input_file, params, vars(disk))
 
-def process_gadget_snapshot(input_file, output_file, limits, nbins=512):
-    if os.path.isfile(output_file):
-        return load_snapshot(output_file)
+def process_gadget_snapshot(input_file, limits, nbins=512, nworkers=1):
+    params = {'version': _version, 'type': 'gadget', 'limits': list(limits), 'nbins': nbins}
+    disk = _cache.get(input_file, params)
+    if disk is not None:
+        return disk
     
     mass_factor = 1e10
     
     with gadget.File(input_file) as snap:
-        disk = _process_snapshot(snap.disk, snap.gas, mass_factor, nbins, limits)
-        disk.time = snap.header.time
+        time, has_gas = snap.header.time, snap.num_particles('gas') > 0
     
-    with open(output_file, 'wb') as f:
-        pickle.dump(disk, f, pickle.HIGHEST_PROTOCOL)
+    stars = binning.gadget_source(input_file, 'disk', fields=['pos', 'mass'])
+    gas = binning.gadget_source(input_file, 'gas', fields=['pos', 'mass', 'temp']) if has_gas else None
+    disk = _process_snapshot(stars, gas, mass_factor, nbins, limits, nworkers)
+    disk.time = float(time)
     
-    return disk
+    return _cache.put(input_file, params, vars(disk))
+
+def _process(process, input_file, limits, nbins):
+    # Runs in the worker processes of process_snapshots. The maps are passed back through the cache.
+    process(input_file, limits, nbins)
+
+def process_snapshots(changa_snaps, gadget_snaps, limits, nbins=512, nworkers=None):
+    """
+        The maps of every snapshot by name, made in a pool of `nworkers` processes (one per core if None)
+        
+        The maps are memory-mapped from the cache, so they are read once and shared by all of the plots.
+    """
+    import concurrent.futures as cf
+    jobs = [(process_changa_snapshot, f) for f in changa_snaps] + [(process_gadget_snapshot, f) for f in gadget_snaps]
+    with cf.ProcessPoolExecutor(max_workers=nworkers) as pool:
+        for future in [pool.submit(_process, process, f, limits, nbins) for process, f in jobs]:
+            future.result()
+    return {f: process(f, limits, nbins) for process, f in jobs}
 
+def render(figures, nworkers=None):
+    """Call each (function, args) of `figures` in a pool of `nworkers` processes (one per core if None)"""
+    import concurrent.futures as cf
+    with cf.ProcessPoolExecutor(max_workers=nworkers) as pool:
+        for future in [pool.submit(func, *args) for func, args in figures]:
+            future.result()
@@ -24,12 +24,6 @@ gadget_snaps = [
     'Gadget3/nogas/nogas_010.hdf5'
 ]
 
-for f in changa_snaps:
-    helpers.process_changa_snapshot(f, f+'.pickle', limits)
-
-for f in gadget_snaps:
-    helpers.process_gadget_snapshot(f, f+'.pickle', limits)
-
 snapshots = [x for p in zip(changa_snaps, gadget_snaps) for x in p]
 
 def titles(i):
@@ -42,22 +36,24 @@ def titles(i):
 dims = (len(changa_snaps), 2)
 figure_size = (1.8, 1.8)
 
-fig, grid = plotting.make_fig_grid(x=dims[1], y=dims[0], size=figure_size, cbar_location='right',
-                                   share_all=True, add_all=True, direction='row', cbar_mode='edge',
-                                   cbar_pad='2.5%')
-plotting.text_sizes['label'] *= 1.2
-
-cmap = mpl.cm.get_cmap('Greys')
-vrange = (0.1, 200.0)
-cmap.set_under(cmap(vrange[0]))
-cmap.set_over(cmap(vrange[1]))
-
-for i in range(0, len(snapshots)):
-    file = '{0:s}.pickle'.format(snapshots[i])
-    disk = helpers.load_snapshot(file)
-    plotting.mesh(grid[i], disk.x_grid, disk.y_grid, disk.stellar_smd, vrange, cmap=cmap, cbar_ax=grid.cbar_axes[i],
-                  xlabel=r'$x/R_s$', ylabel=r'$y/R_s$', cbar_label=r'$\Sigma_*$', norm=colors.LogNorm(),
-                  title=titles(i) if i < 2 else None)
-    grid[i].text(-5.0, 15.0, r'$t=' + '{0:.2f}'.format(disk.time) + r'\,\rm{Gyrs}$', fontsize=9)
-
-plotting.save_fig(fig, 'nogas.png')
+if __name__ == '__main__':
+    disks = helpers.process_snapshots(changa_snaps, gadget_snaps, limits)
+
+    fig, grid = plotting.make_fig_grid(x=dims[1], y=dims[0], size=figure_size, cbar_location='right',
+                                       share_all=True, add_all=True, direction='row', cbar_mode='edge',
+                                       cbar_pad='2.5%')
+    plotting.text_sizes['label'] *= 1.2
+
+    cmap = mpl.cm.get_cmap('Greys')
+    vrange = (0.1, 200.0)
+    cmap.set_under(cmap(vrange[0]))
+    cmap.set_over(cmap(vrange[1]))
+
+    for i in range(0, len(snapshots)):
+        disk = disks[snapshots[i]]
+        plotting.mesh(grid[i], disk.x_grid, disk.y_grid, disk.stellar_smd, vrange, cmap=cmap, cbar_ax=grid.cbar_axes[i],
+                      xlabel=r'$x/R_s$', ylabel=r'$y/R_s$', cbar_label=r'$\Sigma_*$', norm=colors.LogNorm(),
+                      title=titles(i) if i < 2 else None)
+        grid[i].text(-5.0, 15.0, r'$t=' + '{0:.2f}'.format(disk.time) + r'\,\rm{Gyrs}$', fontsize=9)
+
+    plotting.save_fig(fig, 'nogas.png')
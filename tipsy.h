@@ -1,14 +1,16 @@
 #pragma once
 
 #include <stddef.h>
+#include <stdint.h>
 
+/* The counts are 64-bit; see tipsyio_header.h for how they are stored on disk */
 typedef struct {
-	double       time;
-	unsigned int nbodies;
-	int	  ndim;
-	unsigned int ngas;
-	unsigned int ndark;
-	unsigned int nstar;
+	double   time;
+	uint64_t nbodies;
+	int      ndim;
+	uint64_t ngas;
+	uint64_t ndark;
+	uint64_t nstar;
 } tipsy_header;
 
 typedef struct {
@@ -40,6 +42,12 @@ typedef struct {
 	float phi;
 } tipsy_star_particle;
 
+/*
+ * Particle data stored as one array per field.
+ *
+ * When writing, a NULL field pointer means every particle has the value
+ * of that field in 'constant'.
+ */
 typedef struct {
 	float* mass;
 	float (*pos)[3];
@@ -50,6 +58,7 @@ typedef struct {
 	float* metals;
 	float* phi;
 	size_t size;
+	tipsy_gas_particle constant;
 } tipsy_gas_data;
 
 typedef struct {
@@ -59,6 +68,7 @@ typedef struct {
 	float* soft;
 	float* phi;
 	size_t size;
+	tipsy_dark_particle constant;
 } tipsy_dark_data;
 
 typedef struct {
@@ -70,4 +80,5 @@ typedef struct {
 	float* soft;
 	float* phi;
 	size_t size;
+	tipsy_star_particle constant;
 } tipsy_star_data;
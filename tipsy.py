@@ -1,13 +1,31 @@
 import tipsy_xdr
 import tipsy_native
+import tipsy_mmap
+from tipsy_aux import File as aux_file, streaming_writer as aux_writer
+from tipsy_c import constant
+from tipsy_index import sort as spatial_sort
+
+def file_size(ngas, ndark, nstar):
+    """The size in bytes of a Tipsy file (XDR or native) holding these numbers of particles"""
+    header, gas, dark, star = tipsy_mmap._xdr_dtypes
+    return header.itemsize + ngas * gas.itemsize + ndark * dark.itemsize + nstar * star.itemsize
 
 class File():
-    """A simple wrapper around a read-only Tipsy file."""
-    def __init__(self, filename, is_xdr=True):
-        if is_xdr:
-            self.file = tipsy_xdr.File(filename)
+    """A simple wrapper around a read-only Tipsy file.
+    
+        If `mmap` is True, the file is memory-mapped and the particle
+        families are returned as zero-copy views of the file's records.
+        
+        `block_size` is the number of particles moved per read (default: 8192).
+        XDR files read with the block codec use up to `nthreads` threads.
+    """
+    def __init__(self, filename, is_xdr=True, xdr_codec='block', mmap=False, block_size=None, nthreads=1):
+        if mmap:
+            self.file = tipsy_mmap.File(filename, is_xdr)
+        elif is_xdr:
+            self.file = tipsy_xdr.File(filename, xdr_codec, block_size, nthreads)
         else:
-            self.file = tipsy_native.File(filename)
+            self.file = tipsy_native.File(filename, block_size)
 
     def close(self):
         self.file.close()
@@ -20,17 +38,21 @@ class File():
         return False  # always re-raise exceptions
 
 class streaming_writer():
-    """A simple wrapper around a write-only Tipsy file."""
-    def __init__(self, filename, mode='wb', is_xdr=True):
+    """A simple wrapper around a write-only Tipsy file.
+    
+        `block_size` is the number of particles moved per write (default: 8192).
+        XDR files written with the block codec use up to `nthreads` threads.
+    """
+    def __init__(self, filename, mode='wb', is_xdr=True, xdr_codec='block', block_size=None, nthreads=1):
         if not 'b' in mode:
             raise ValueError('Files must be binary')
         if not mode in ['wb', 'r+b']:
             raise ValueError("Mode must be one of 'wb' or 'r+b'")
         
         if is_xdr:
-            self.file = tipsy_xdr.streaming_writer(filename, mode)
+            self.file = tipsy_xdr.streaming_writer(filename, mode, xdr_codec, block_size, nthreads)
         else:
-            self.file = tipsy_native.streaming_writer(filename, mode)
+            self.file = tipsy_native.streaming_writer(filename, mode, block_size)
 
     def close(self):
         self.file.close()
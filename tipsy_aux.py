@@ -0,0 +1,153 @@
+import numpy as np
+import os
+
+"""
+    Auxiliary arrays of Tipsy files
+
+    ChaNGa keeps per-particle quantities that aren't in the Tipsy records
+    (e.g., particle IDs in 'file.iord' or densities in 'file.den') in
+    auxiliary files holding one value per particle in the order of the Tipsy
+    file: gas, then dark matter, then stars. The files are either ASCII (the
+    number of particles on the first line, then one value per line) or XDR
+    (a big-endian 32-bit count followed by the big-endian values).
+
+    Binary files are written a chunk at a time without copying data that is
+    already big-endian, and are memory-mapped when read.
+"""
+
+def _xdr_dtype(dtype):
+    """
+        The big-endian type of the values of an XDR file holding `dtype`
+
+        Integers are stored signed. Unsigned 32-bit integers (e.g., GADGET's
+        ParticleIDs) are widened to 64 bits so that every value fits; unsigned
+        64-bit values must be below 2**63.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return np.dtype('>f{0:d}'.format(dtype.itemsize))
+    if dtype.kind == 'u' and dtype.itemsize >= 4:
+        return np.dtype('>i8')
+    if dtype.kind in 'iub':
+        return np.dtype('>i{0:d}'.format(max(dtype.itemsize, 4)))
+    raise ValueError("Unsupported type '{0:s}' for an auxiliary array".format(str(dtype)))
+
+def _format(dtype):
+    """The printf format of the values of an ASCII file holding `dtype`"""
+    if dtype.kind == 'f':
+        return '%.9g' if dtype.itemsize <= 4 else '%.17g'
+    return '%d'
+
+class File():
+    """
+        A read-only auxiliary array holding values of `dtype`
+
+        XDR files are memory-mapped, so only the values that are used are
+        read. ASCII files are read in full when opened. The type of the
+        values isn't stored in the files, so it must be given for integer or
+        double precision arrays.
+    """
+    def __init__(self, filename, dtype=np.float32, ascii=False):
+        self.filename = os.fspath(filename)
+        if ascii:
+            with open(self.filename, 'r') as f:
+                self.size = int(f.readline())
+                self.data = np.loadtxt(f, dtype=dtype, ndmin=1)
+            if self.data.shape[0] != self.size:
+                raise IOError('{0:s} holds {1:d} values, but its header says {2:d}'.format(
+                              self.filename, self.data.shape[0], self.size))
+            return
+
+        dtype = _xdr_dtype(dtype)
+        self.size = int(np.fromfile(self.filename, dtype='>i4', count=1)[0])
+        expected = 4 + self.size * dtype.itemsize
+        if os.path.getsize(self.filename) != expected:
+            raise IOError('{0:s} should have {1:d} bytes for {2:d} values of {3:s}, but has {4:d}'.format(
+                          self.filename, expected, self.size, str(dtype), os.path.getsize(self.filename)))
+        if self.size == 0:
+            self.data = np.empty(0, dtype=dtype)
+        else:
+            self.data = np.memmap(self.filename, dtype=dtype, mode='r', offset=4, shape=(self.size,))
+
+    def __len__(self):
+        return self.size
+
+    def read(self, start=0, stop=None):
+        """The values of the particles [start, stop) (a view of the file for XDR files)"""
+        return self.data[start:stop]
+
+    def chunks(self, chunk_size, start=0, stop=None):
+        """Iterate over the values of the particles [start, stop) in blocks of at most `chunk_size` values"""
+        stop = self.size if stop is None else min(stop, self.size)
+        for first in range(start, stop, chunk_size):
+            yield self.data[first:min(first + chunk_size, stop)]
+
+    def close(self):
+        self.data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False  # always re-raise exceptions
+
+class streaming_writer():
+    """
+        A write-only auxiliary array of `nbodies` values of `dtype`
+
+        The values are written in chunks with `write`, in the order of the
+        Tipsy file. Closing the file before all `nbodies` values are written
+        raises an IOError.
+    """
+    def __init__(self, filename, nbodies, dtype=np.float32, ascii=False):
+        self.filename = os.fspath(filename)
+        self.nbodies = int(nbodies)
+        self.ascii = ascii
+        self.count = 0
+        if ascii:
+            self.dtype = np.dtype(dtype)
+            self.file = open(self.filename, 'w')
+            self.file.write('{0:d}\n'.format(self.nbodies))
+        else:
+            self.dtype = _xdr_dtype(dtype)
+            self.file = open(self.filename, 'wb')
+            self.file.write(np.array(self.nbodies, dtype='>i4').tobytes())
+
+    def write(self, values):
+        """Append `values`, converting them to the type of the file"""
+        values = np.asarray(values).ravel()
+        if self.count + values.shape[0] > self.nbodies:
+            raise IOError('Writing more than {0:d} values to {1:s}'.format(self.nbodies, self.filename))
+        if self.dtype.kind == 'i' and values.shape[0] > 0 and values.dtype.kind in 'iu':
+            info = np.iinfo(self.dtype)
+            low, high = values.min(), values.max()
+            if high > info.max or low < info.min:
+                raise ValueError('{0:s} holds {1:s} values in [{2:d}, {3:d}], but [{4:d}, {5:d}] were written'.format(
+                                 self.filename, str(self.dtype), int(info.min), int(info.max), int(low), int(high)))
+
+        # Big-endian values of the right type are written without a copy
+        values = np.ascontiguousarray(values, dtype=self.dtype)
+        if self.ascii:
+            np.savetxt(self.file, values, fmt=_format(self.dtype))
+        else:
+            self.file.write(memoryview(values).cast('B'))
+        self.count += values.shape[0]
+
+    def close(self, check=True):
+        if self.file:
+            try:
+                if check and self.count != self.nbodies:
+                    raise IOError('{0:s} should have {1:d} values, but {2:d} were written'.format(
+                                  self.filename, self.nbodies, self.count))
+            finally:
+                self.file.close()
+                self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # A short file is expected if writing failed
+        self.close(check=exc_type is None)
+        return False  # always re-raise exceptions
@@ -1,6 +1,5 @@
-import ctypes
+import numbers
 import numpy as np
-import numpy.ctypeslib as npct
 
 """
     The mapping between the C and Python type interfaces for Tipsy.
@@ -9,15 +8,68 @@ import numpy.ctypeslib as npct
 """
 
 _native_float32_dtype = np.dtype('=f')
-_array_1d_float32 = npct.ndpointer(dtype=_native_float32_dtype, ndim=1, flags=('C','O','W','A'))
-_array_2d_float32 = npct.ndpointer(dtype=_native_float32_dtype, ndim=2, flags=('C','O','W','A'))
 
-def _convert_array(x, name):
+def _convert_array(x, name, size, ndims=1):
+    """
+        View 'x' as a C-contiguous float32 array without copying, if possible.
+        Any object exporting the buffer protocol (e.g., a memoryview) is accepted.
+        Raw byte buffers are reinterpreted as float32.
+    """
     if x is None:
         raise ValueError(name + ' cannot be None')
     if not isinstance(x, np.ndarray):
-        raise TypeError(name + ' is not a numpy array')
-    return np.require(x, dtype=_native_float32_dtype, requirements=['C_CONTIGUOUS', 'ALIGNED', 'WRITEABLE', 'OWNDATA', 'ENSUREARRAY'])
+        try:
+            view = memoryview(x)
+        except TypeError:
+            raise TypeError(name + ' is not a numpy array or buffer') from None
+        x = np.frombuffer(view, dtype=_native_float32_dtype) if view.format in ('B', 'b', 'c') else np.asarray(view)
+    x = np.require(x, dtype=_native_float32_dtype, requirements=['C_CONTIGUOUS', 'ALIGNED', 'ENSUREARRAY'])
+    if ndims == 2 and x.ndim == 1:
+        x = x.reshape(-1, 3)
+    if x.ndim != ndims:
+        raise ValueError('{0:s} must be {1:d}-dimensional'.format(name, ndims))
+    if x.shape[0] < size:
+        raise ValueError('{0:s} has {1:d} particles, but {2:d} are needed'.format(name, x.shape[0], size))
+    return x
+
+class constant():
+    """A column with the same value for every particle (a scalar or, for pos/vel, a 3-vector)
+
+        The value is written by the C library directly, so no array is allocated.
+        Scalars passed in place of an array are shorthand for this.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return 'constant({0:s})'.format(str(self.value))
+
+def _convert_column(x, name, size, ndims=1):
+    """Like _convert_array, but scalars and constants are kept to be broadcast by the C library"""
+    if isinstance(x, constant):
+        return x
+    # np.isscalar would also accept memoryviews and strings
+    if isinstance(x, numbers.Real):
+        return constant(x)
+    return _convert_array(x, name, size, ndims)
+
+def _c_column(x, ndims=1):
+    """The argument passed to the C module for a column: the array itself or the value of a constant"""
+    if not isinstance(x, constant):
+        return x
+    if ndims == 2:
+        return tuple(np.broadcast_to(np.asarray(x.value, dtype=np.float32), (3,)).tolist())
+    return float(x.value)
+
+def _range(start, stop, size):
+    """The particles [start, stop) of a family of 'size', with Python's slicing rules"""
+    start, stop, _ = slice(start, stop).indices(size)
+    return start, max(start, stop)
+
+def _check_slice(key):
+    """Raise an IndexError unless `key` is a contiguous slice of a family"""
+    if not isinstance(key, slice) or key.step not in (None, 1):
+        raise IndexError('Particle families can only be sliced contiguously (e.g., f.gas[10:20]), not ' + repr(key))
 
 def _make_array(size, ndims=1, zero=False):
     if ndims == 1:
@@ -33,115 +85,72 @@ def _pretty_print(obj, attrs):
         repr.append('{0:10s}: {1:s}'.format(k, str(a.shape) if isinstance(a, np.ndarray) else str(a)))
     return '\n'.join(repr)
 
-class header():
-    class struct(ctypes.Structure):
-        _fields_ = [
-            ('time'   , ctypes.c_double),
-            ('nbodies', ctypes.c_uint),
-            ('ndim'   , ctypes.c_int),
-            ('ngas'   , ctypes.c_uint),
-            ('ndark'  , ctypes.c_uint),
-            ('nstar'  , ctypes.c_uint)
-        ]
-
-        @classmethod
-        def from_external(cls, hdr):
-            self = cls()
-            self.time = hdr.time
-            self.nbodies = hdr.nbodies
-            self.ndim = hdr.ndim
-            self.ngas = hdr.ngas
-            self.ndark = hdr.ndark
-            self.nstar = hdr.nstar
-            return self
+class family():
+    """
+        A particle family of a Tipsy file that is read on demand
+        
+        The whole family is read the first time one of its fields is accessed.
+        Slicing (e.g., file.gas[1000:2000]) reads only the requested particles.
+    """
+    def __init__(self, size, read):
+        self.size = size
+        self._read = read
+        self._data = None
+    
+    def __len__(self):
+        return self.size
+    
+    def __getitem__(self, key):
+        _check_slice(key)
+        return self._read(key.start, key.stop)
+    
+    def __getattr__(self, name):
+        # Only called for names that aren't regular attributes
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self._data is None:
+            self._data = self._read()
+        return getattr(self._data, name)
+    
+    def __str__(self):
+        if self._data is None:
+            self._data = self._read()
+        return str(self._data)
 
-    def __init__(self):
-        self.c_data = header.struct()
+class header():
+    def __init__(self, time=0.0, nbodies=0, ndim=3, ngas=0, ndark=0, nstar=0):
+        self.time = time
+        self.nbodies = nbodies
+        self.ndim = ndim
+        self.ngas = ngas
+        self.ndark = ndark
+        self.nstar = nstar
 
     def __str__(self):
         return _pretty_print(self, ['time','nbodies','ngas','ndark','nstar'])
-    
-    @property
-    def time(self):
-        return self.c_data.time
-    @time.setter
-    def time(self, rhs):
-        self.c_data.time = rhs
-    @property
-    def nbodies(self):
-        return self.c_data.nbodies
-    @nbodies.setter
-    def nbodies(self, rhs):
-        self.c_data.nbodies = rhs
-    @property
-    def ngas(self):
-        return self.c_data.ngas
-    @ngas.setter
-    def ngas(self, rhs):
-        self.c_data.ngas = rhs
-    @property
-    def ndark(self):
-        return self.c_data.ndark
-    @ndark.setter
-    def ndark(self, rhs):
-        self.c_data.ndark = rhs
-    @property
-    def nstar(self):
-        return self.c_data.nstar
-    @nstar.setter
-    def nstar(self, rhs):
-        self.c_data.nstar = rhs
+
+    def astuple(self):
+        """The fields in the order taken by the C module"""
+        return (self.time, self.nbodies, self.ndim, self.ngas, self.ndark, self.nstar)
 
     @classmethod
     def from_external(cls, time, ngas, ndark, nstar):
-        self = cls()
-        self.time = float(time)
-        self.nbodies = int(ngas) + int(ndark) + int(nstar)
-        self.ndim = 3
-        self.ngas = int(ngas)
-        self.ndark = int(ndark)
-        self.nstar = int(nstar)
-        self.c_data = header.struct.from_external(self)
-        return self
+        ngas, ndark, nstar = int(ngas), int(ndark), int(nstar)
+        return cls(float(time), ngas + ndark + nstar, 3, ngas, ndark, nstar)
 
 class gas_data():
-    class struct(ctypes.Structure):
-        _fields_ = [
-            ('mass'   , _array_1d_float32),
-            ('pos'    , _array_2d_float32),
-            ('vel'    , _array_2d_float32),
-            ('rho'    , _array_1d_float32),
-            ('temp'   , _array_1d_float32),
-            ('hsmooth', _array_1d_float32),
-            ('metals' , _array_1d_float32),
-            ('phi'    , _array_1d_float32),
-            ('size'   , ctypes.c_size_t)
-        ]
-        
-        def __init__(self):
-            super().__init__()
-    
-        @classmethod
-        def from_external(cls, other):
-            self = cls()
-            self.mass = other.mass.ctypes.data_as(_array_1d_float32)
-            self.pos = other.pos.ctypes.data_as(_array_2d_float32)
-            self.vel = other.vel.ctypes.data_as(_array_2d_float32)
-            self.rho = other.rho.ctypes.data_as(_array_1d_float32)
-            self.temp = other.temp.ctypes.data_as(_array_1d_float32)
-            self.metals = other.metals.ctypes.data_as(_array_1d_float32)
-            self.hsmooth = other.hsmooth.ctypes.data_as(_array_1d_float32)
-            self.phi = other.phi.ctypes.data_as(_array_1d_float32)
-            self.size = other.size
-            return self
+    fields = ['mass', 'pos', 'vel', 'rho', 'temp', 'hsmooth', 'metals', 'phi']
 
     def __init__(self):
         self.size = 0
-        self.c_data = None
     
     def __str__(self):
-        if self.c_data is not None:
-            return _pretty_print(self, [k[0] for k in self.c_data._fields_])
+        return _pretty_print(self, gas_data.fields + ['size'])
+
+    def columns(self):
+        """The columns in the order taken by the C module"""
+        return (_c_column(self.mass), _c_column(self.pos, 2), _c_column(self.vel, 2), _c_column(self.rho),
+                _c_column(self.temp), _c_column(self.hsmooth), _c_column(self.metals), _c_column(self.phi))
 
     @classmethod
     def from_size(cls, size):
@@ -155,56 +164,35 @@ class gas_data():
         self.hsmooth = _make_array(size)
         self.phi = _make_array(size)
         self.size = size
-        self.c_data = gas_data.struct.from_external(self)
         return self
 
     @classmethod
     def from_external(cls, mass, pos, vel, rho, temp, hsmooth, metals, phi, size):
         self = cls()
-        self.mass = _convert_array(mass, 'mass')
-        self.pos = _convert_array(pos, 'pos')
-        self.vel = _convert_array(vel, 'vel')
-        self.rho = _convert_array(rho, 'rho')
-        self.temp = _convert_array(temp, 'temp')
-        self.hsmooth = _convert_array(hsmooth, 'hsmooth')
-        self.metals = _convert_array(metals, 'metals')
-        self.phi = _convert_array(phi, 'phi')
+        self.mass = _convert_column(mass, 'mass', size)
+        self.pos = _convert_column(pos, 'pos', size, ndims=2)
+        self.vel = _convert_column(vel, 'vel', size, ndims=2)
+        self.rho = _convert_column(rho, 'rho', size)
+        self.temp = _convert_column(temp, 'temp', size)
+        self.hsmooth = _convert_column(hsmooth, 'hsmooth', size)
+        self.metals = _convert_column(metals, 'metals', size)
+        self.phi = _convert_column(phi, 'phi', size)
         self.size = size
-        self.c_data = gas_data.struct.from_external(self)
         return self
 
 class dark_data():
-    class struct(ctypes.Structure):
-        _fields_ = [
-            ('mass', _array_1d_float32),
-            ('pos' , _array_2d_float32),
-            ('vel' , _array_2d_float32),
-            ('soft', _array_1d_float32),
-            ('phi' , _array_1d_float32),
-            ('size', ctypes.c_size_t)
-        ]
-    
-        def __init__(self):
-            super().__init__()
-    
-        @classmethod
-        def from_external(cls, other):
-            self = cls()
-            self.mass = other.mass.ctypes.data_as(_array_1d_float32)
-            self.pos = other.pos.ctypes.data_as(_array_2d_float32)
-            self.vel = other.vel.ctypes.data_as(_array_2d_float32)
-            self.phi = other.phi.ctypes.data_as(_array_1d_float32)
-            self.soft = other.soft.ctypes.data_as(_array_1d_float32)
-            self.size = other.size
-            return self
+    fields = ['mass', 'pos', 'vel', 'soft', 'phi']
 
     def __init__(self):
         self.size = 0
-        self.c_data = None
     
     def __str__(self):
-        if self.c_data is not None:
-            return _pretty_print(self, [k[0] for k in self.c_data._fields_])
+        return _pretty_print(self, dark_data.fields + ['size'])
+
+    def columns(self):
+        """The columns in the order taken by the C module"""
+        return (_c_column(self.mass), _c_column(self.pos, 2), _c_column(self.vel, 2), _c_column(self.soft),
+                _c_column(self.phi))
     
     @classmethod
     def from_size(cls, size):
@@ -215,63 +203,32 @@ class dark_data():
         self.phi = _make_array(size)
         self.soft = _make_array(size)
         self.size = size
-        self.c_data = dark_data.struct.from_external(self)
         return self
     
     @classmethod
     def from_external(cls, mass, pos, vel, soft, phi, size):
         self = cls()
-        self.mass = _convert_array(mass, 'mass')
-        self.pos = _convert_array(pos, 'pos')
-        self.vel = _convert_array(vel, 'vel')
-        self.phi = _convert_array(phi, 'phi')
-        
-        if soft is not None and np.isscalar(soft):
-            self.soft = _make_array(size, zero=True)
-            self.soft += np.asscalar(np.array(soft, dtype=_native_float32_dtype))
-        else:
-            self.soft = _convert_array(soft, 'soft')
-        
+        self.mass = _convert_column(mass, 'mass', size)
+        self.pos = _convert_column(pos, 'pos', size, ndims=2)
+        self.vel = _convert_column(vel, 'vel', size, ndims=2)
+        self.phi = _convert_column(phi, 'phi', size)
+        self.soft = _convert_column(soft, 'soft', size)
         self.size = size
-        self.c_data = dark_data.struct.from_external(self)
         return self
 
 class star_data():
-    class struct(ctypes.Structure):
-        _fields_ = [
-            ('mass'  , _array_1d_float32),
-            ('pos'   , _array_2d_float32),
-            ('vel'   , _array_2d_float32),
-            ('metals', _array_1d_float32),
-            ('tform' , _array_1d_float32),
-            ('soft'  , _array_1d_float32),
-            ('phi'   , _array_1d_float32),
-            ('size'  , ctypes.c_size_t)
-        ]
-        
-        def __init__(self):
-            super().__init__()
-
-        @classmethod
-        def from_external(cls, other):
-            self = cls()
-            self.mass = other.mass.ctypes.data_as(_array_1d_float32)
-            self.pos = other.pos.ctypes.data_as(_array_2d_float32)
-            self.vel = other.vel.ctypes.data_as(_array_2d_float32)
-            self.metals = other.metals.ctypes.data_as(_array_1d_float32)
-            self.tform = other.tform.ctypes.data_as(_array_1d_float32)
-            self.phi = other.phi.ctypes.data_as(_array_1d_float32)
-            self.soft = other.soft.ctypes.data_as(_array_1d_float32)
-            self.size = other.size
-            return self
+    fields = ['mass', 'pos', 'vel', 'metals', 'tform', 'soft', 'phi']
 
     def __init__(self):
         self.size = 0
-        self.c_data = None
     
     def __str__(self):
-        if self.c_data is not None:
-            return _pretty_print(self, [k[0] for k in self.c_data._fields_])
+        return _pretty_print(self, star_data.fields + ['size'])
+
+    def columns(self):
+        """The columns in the order taken by the C module"""
+        return (_c_column(self.mass), _c_column(self.pos, 2), _c_column(self.vel, 2), _c_column(self.metals),
+                _c_column(self.tform), _c_column(self.soft), _c_column(self.phi))
     
     @classmethod
     def from_size(cls, size):
@@ -284,26 +241,17 @@ class star_data():
         self.phi = _make_array(size)
         self.soft = _make_array(size)
         self.size = size
-        self.c_data = star_data.struct.from_external(self)
         return self
 
     @classmethod
     def from_external(cls, mass, pos, vel, metals, tform, soft, phi, size):
         self = cls()
-        self.mass = _convert_array(mass, 'mass')
-        self.pos = _convert_array(pos, 'pos')
-        self.vel = _convert_array(vel, 'vel')
-        self.metals = _convert_array(metals, 'metals')
-        self.tform = _convert_array(tform, 'tform')
-        self.phi = _convert_array(phi, 'phi')
-        
-        if soft is not None and np.isscalar(soft):
-            self.soft = _make_array(size, zero=True)
-            self.soft += np.asscalar(np.array(soft, dtype=_native_float32_dtype))
-        else:
-            self.soft = _convert_array(soft, 'soft')
-        
+        self.mass = _convert_column(mass, 'mass', size)
+        self.pos = _convert_column(pos, 'pos', size, ndims=2)
+        self.vel = _convert_column(vel, 'vel', size, ndims=2)
+        self.metals = _convert_column(metals, 'metals', size)
+        self.tform = _convert_column(tform, 'tform', size)
+        self.phi = _convert_column(phi, 'phi', size)
+        self.soft = _convert_column(soft, 'soft', size)
         self.size = size
-        self.c_data = star_data.struct.from_external(self)
         return self
-
@@ -0,0 +1,207 @@
+import numpy as np
+import os
+import tipsy_mmap
+
+"""
+    A spatial index for Tipsy files
+
+    sort() reorders the particles of each family along a Morton (Z-order)
+    curve, so that particles close in space are close in the file, and saves
+    the bounding box of every block of consecutive particles in a sidecar file
+    (the Tipsy file's name + '.index'). Box and sphere queries then read only
+    the blocks that overlap the region.
+"""
+
+# Bits per dimension of the Morton keys
+_bits = 21
+
+# The families in the order of the file, with the name of their reader
+families = ['gas', 'darkmatter', 'stars']
+_readers = {'gas': 'read_gas', 'darkmatter': 'read_darkmatter', 'stars': 'read_stars'}
+
+_version = 1
+
+def _spread(x):
+    """Insert two zero bits between each of the low 21 bits of `x`"""
+    x = x & np.uint64(0x1fffff)
+    for shift, mask in [(32, 0x1f00000000ffff), (16, 0x1f0000ff0000ff), (8, 0x100f00f00f00f00f),
+                        (4, 0x10c30c30c30c30c3), (2, 0x1249249249249249)]:
+        x = (x | (x << np.uint64(shift))) & np.uint64(mask)
+    return x
+
+def morton_keys(pos, lo, size):
+    """The Morton keys of the positions `pos` in the cube of side `size` with its lowest corner at `lo`"""
+    cells = (np.asarray(pos, dtype=np.float64) - lo) * (2**_bits / size)
+    cells = np.clip(cells, 0, 2**_bits - 1).astype(np.uint64)
+    return _spread(cells[:, 0]) | (_spread(cells[:, 1]) << np.uint64(1)) | (_spread(cells[:, 2]) << np.uint64(2))
+
+def _bounds(parts, chunk_size):
+    """The cube enclosing the positions of all of the memory-mapped families in `parts`"""
+    lo, hi = np.full(3, np.inf), np.full(3, -np.inf)
+    for data in parts:
+        for start in range(0, data.shape[0], chunk_size):
+            pos = data['pos'][start:start + chunk_size]
+            lo = np.minimum(lo, pos.min(axis=0))
+            hi = np.maximum(hi, pos.max(axis=0))
+    if not np.all(lo <= hi):
+        return np.zeros(3), 1.0
+    # Keep the largest positions inside the last cell
+    size = float(np.max(hi - lo))
+    return lo, np.nextafter(size, np.inf) if size > 0.0 else 1.0
+
+def _aux_records(filename, nbodies):
+    """The values of the XDR auxiliary array `filename` as opaque records, whatever their type"""
+    width, extra = divmod(os.path.getsize(filename) - 4, max(nbodies, 1))
+    if extra != 0 or int(np.fromfile(filename, dtype='>i4', count=1)[0]) != nbodies:
+        raise IOError('{0:s} is not an auxiliary array of {1:d} particles'.format(filename, nbodies))
+    return np.memmap(filename, dtype='V{0:d}'.format(width), mode='r', offset=4, shape=(nbodies,))
+
+def sort(filename, output=None, is_xdr=True, block_size=1024, chunk_size=2**20, aux=()):
+    """
+        Sort the particles of each family of a Tipsy file along a Morton curve and index them
+
+        The sorted file is written to `output` (the input is replaced if None)
+        together with its index, output + '.index', holding the bounding box of
+        every `block_size` consecutive particles. The particles are reordered
+        `chunk_size` at a time; only their keys are held in memory at once.
+
+        The XDR auxiliary arrays filename + suffix for each suffix in `aux`
+        (e.g., ['.iord']) are reordered to match and written to output + suffix.
+    """
+    filename = os.fspath(filename)
+    output = filename if output is None else os.fspath(output)
+    f = tipsy_mmap.File(filename, is_xdr)
+    header_t = (tipsy_mmap._xdr_dtypes if is_xdr else tipsy_mmap._native_dtypes)[0]
+    parts = [d.data for d in [f.read_gas(), f.read_darkmatter(), f.read_stars()]]
+    lo, size = _bounds(parts, chunk_size)
+    aux = [(output + suffix, _aux_records(filename + suffix, f.hdr.nbodies)) for suffix in aux]
+
+    # Whole blocks per chunk so that no block straddles two chunks
+    chunk_size = max(block_size, chunk_size // block_size * block_size)
+    index = {'version': _version, 'lo': lo, 'size': size, 'block_size': block_size,
+             'counts': np.array([f.hdr.ngas, f.hdr.ndark, f.hdr.nstar], dtype=np.uint64)}
+    tmp = output + '.sorting'
+    aux_out = [open(a + '.sorting', 'wb') for a, _ in aux]
+    try:
+        with open(filename, 'rb') as src, open(tmp, 'wb') as dst:
+            dst.write(src.read(header_t.itemsize))
+            for out, (_, records) in zip(aux_out, aux):
+                out.write(np.array(records.shape[0], dtype='>i4').tobytes())
+            offset = 0
+            for name, data in zip(families, parts):
+                keys = np.empty(data.shape[0], dtype=np.uint64)
+                for start in range(0, data.shape[0], chunk_size):
+                    keys[start:start + chunk_size] = morton_keys(data['pos'][start:start + chunk_size], lo, size)
+                order = np.argsort(keys, kind='stable')
+                del keys
+
+                starts = np.arange(0, data.shape[0], block_size)
+                block_lo = np.empty((starts.shape[0], 3), dtype=np.float32)
+                block_hi = np.empty((starts.shape[0], 3), dtype=np.float32)
+                for start in range(0, data.shape[0], chunk_size):
+                    records = data[order[start:start + chunk_size]]
+                    dst.write(records.tobytes())
+                    for out, (_, values) in zip(aux_out, aux):
+                        out.write(values[offset + order[start:start + chunk_size]].tobytes())
+                    pos = records['pos']
+                    blocks = slice(start // block_size, (start + records.shape[0] + block_size - 1) // block_size)
+                    block_lo[blocks] = np.minimum.reduceat(pos, starts[blocks] - start, axis=0)
+                    block_hi[blocks] = np.maximum.reduceat(pos, starts[blocks] - start, axis=0)
+                index[name + '_lo'] = block_lo
+                index[name + '_hi'] = block_hi
+                offset += data.shape[0]
+        for out in aux_out:
+            out.close()
+        f.close()
+        del parts, aux
+        index['file_size'] = os.path.getsize(tmp)
+        with open(output + '.index', 'wb') as out:
+            np.savez(out, **index)
+        for out in aux_out:
+            os.replace(out.name, out.name[:-len('.sorting')])
+        os.replace(tmp, output)
+    except BaseException:
+        for path in [tmp] + [out.name for out in aux_out]:
+            if os.path.exists(path):
+                os.unlink(path)
+        raise
+    finally:
+        for out in aux_out:
+            out.close()
+
+class index():
+    """The spatial index of a sorted Tipsy file"""
+    def __init__(self, filename, header):
+        filename = os.fspath(filename)
+        with np.load(filename + '.index') as data:
+            if int(data['version']) != _version:
+                raise IOError('Unsupported version of the spatial index of {0:s}'.format(filename))
+            counts = [int(c) for c in data['counts']]
+            if counts != [header.ngas, header.ndark, header.nstar] or \
+               int(data['file_size']) != os.path.getsize(filename):
+                raise IOError('The spatial index of {0:s} is out of date'.format(filename))
+            self.block_size = int(data['block_size'])
+            self.counts = dict(zip(families, counts))
+            self.blocks = {f: (data[f + '_lo'], data[f + '_hi']) for f in families}
+
+    def _ranges(self, family, overlaps):
+        """The particle ranges [start, stop) of the consecutive blocks of `family` selected by `overlaps`"""
+        blocks = np.flatnonzero(overlaps)
+        if blocks.shape[0] == 0:
+            return []
+        # Merge runs of neighbouring blocks into one read
+        breaks = np.flatnonzero(np.diff(blocks) > 1)
+        first = np.concatenate([blocks[:1], blocks[breaks + 1]])
+        last = np.concatenate([blocks[breaks], blocks[-1:]])
+        size = self.counts[family]
+        return [(int(a) * self.block_size, min(size, (int(b) + 1) * self.block_size)) for a, b in zip(first, last)]
+
+    def box(self, family, lo, hi):
+        """The particle ranges of `family` that may have particles in the box [lo, hi]"""
+        block_lo, block_hi = self.blocks[family]
+        return self._ranges(family, np.all((block_lo <= hi) & (block_hi >= lo), axis=1))
+
+    def sphere(self, family, center, radius):
+        """The particle ranges of `family` that may have particles within `radius` of `center`"""
+        block_lo, block_hi = self.blocks[family]
+        d = np.maximum(np.maximum(block_lo - center, center - block_hi), 0.0)
+        return self._ranges(family, np.sum(d.astype(np.float64) ** 2, axis=1) <= radius ** 2)
+
+def _select(data, mask):
+    """The particles of `data` (as returned by a reader) selected by `mask`"""
+    if isinstance(data, tipsy_mmap.family):
+        return tipsy_mmap.family(data.data[mask])
+    out = type(data)()
+    for name in data.fields:
+        setattr(out, name, getattr(data, name)[mask])
+    out.size = int(np.count_nonzero(mask))
+    return out
+
+def _concatenate(parts):
+    if isinstance(parts[0], tipsy_mmap.family):
+        return tipsy_mmap.family(np.concatenate([p.data for p in parts]))
+    out = type(parts[0])()
+    for name in out.fields:
+        setattr(out, name, np.concatenate([getattr(p, name) for p in parts]))
+    out.size = sum(p.size for p in parts)
+    return out
+
+def query(file, family, ranges, contains):
+    """Read the particle `ranges` of `family` from the open Tipsy `file`, keeping those whose position `contains` accepts"""
+    read = getattr(file, _readers[family])
+    parts = []
+    for start, stop in ranges:
+        data = read(start, stop)
+        parts.append(_select(data, contains(np.asarray(data.pos, dtype=np.float64))))
+    return _concatenate(parts) if parts else read(0, 0)
+
+def box(file, family, lo, hi):
+    """The particles of `family` in the box [lo, hi] of the open, sorted Tipsy `file`"""
+    lo, hi = np.asarray(lo, dtype=np.float64), np.asarray(hi, dtype=np.float64)
+    return query(file, family, file.index.box(family, lo, hi), lambda pos: np.all((pos >= lo) & (pos <= hi), axis=1))
+
+def sphere(file, family, center, radius):
+    """The particles of `family` within `radius` of `center` in the open, sorted Tipsy `file`"""
+    center, radius = np.asarray(center, dtype=np.float64), float(radius)
+    return query(file, family, file.index.sphere(family, center, radius),
+                 lambda pos: np.sum((pos - center) ** 2, axis=1) <= radius ** 2)
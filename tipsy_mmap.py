@@ -0,0 +1,194 @@
+import numpy as np
+import os
+import tipsy_c
+import tipsy_index
+
+"""
+    A zero-copy, read-only view of a Tipsy file. The particle families are
+    memory-mapped as structured arrays laid out exactly as the records on disk
+    so that no data are read until a field is accessed.
+"""
+
+def _dtypes(byteorder):
+    f = byteorder + 'f4'
+    header = np.dtype([
+        ('time'   , byteorder + 'f8'),
+        ('nbodies', byteorder + 'u4'),
+        ('ndim'   , byteorder + 'i4'),
+        ('ngas'   , byteorder + 'u4'),
+        ('ndark'  , byteorder + 'u4'),
+        ('nstar'  , byteorder + 'u4'),
+        ('pad'    , byteorder + 'i4')
+    ])
+    gas = np.dtype([
+        ('mass'   , f),
+        ('pos'    , f, 3),
+        ('vel'    , f, 3),
+        ('rho'    , f),
+        ('temp'   , f),
+        ('hsmooth', f),
+        ('metals' , f),
+        ('phi'    , f)
+    ])
+    dark = np.dtype([
+        ('mass', f),
+        ('pos' , f, 3),
+        ('vel' , f, 3),
+        ('soft', f),
+        ('phi' , f)
+    ])
+    star = np.dtype([
+        ('mass'  , f),
+        ('pos'   , f, 3),
+        ('vel'   , f, 3),
+        ('metals', f),
+        ('tform' , f),
+        ('soft'  , f),
+        ('phi'   , f)
+    ])
+    return header, gas, dark, star
+
+# XDR files are big-endian. Native files use the host byte order and the
+# padding of the C header struct, which happens to also be 32 bytes.
+_xdr_dtypes = _dtypes('>')
+_native_dtypes = _dtypes('=')
+
+class family():
+    """The particles of one type as fields of a memory-mapped structured array"""
+    def __init__(self, data):
+        self.data = data
+        self.size = data.shape[0]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        # A view of the selected records; nothing is read
+        tipsy_c._check_slice(key)
+        return family(self.data[key])
+
+    def __getattr__(self, name):
+        # Only called for names that aren't regular attributes
+        data = self.__dict__.get('data')
+        if data is not None and name in data.dtype.names:
+            return data[name]
+        raise AttributeError("'family' object has no attribute '{0:s}'".format(name))
+
+    def __str__(self):
+        return tipsy_c._pretty_print(self, self.data.dtype.names)
+
+class File():
+    """A read-only, memory-mapped Tipsy file."""
+    def __init__(self, filename, is_xdr=True):
+        self.filename = filename
+        header_t, self._gas_t, self._dark_t, self._star_t = _xdr_dtypes if is_xdr else _native_dtypes
+
+        raw = np.fromfile(filename, dtype=header_t, count=1)
+        if raw.shape[0] != 1:
+            raise IOError('Unable to read Tipsy header from {0:s}'.format(filename))
+        raw = raw[0]
+
+        self.hdr = tipsy_c.header()
+        self.hdr.time = float(raw['time'])
+        self.hdr.nbodies = int(raw['nbodies'])
+        self.hdr.ndim = int(raw['ndim'])
+        self.hdr.ngas = int(raw['ngas'])
+        self.hdr.ndark = int(raw['ndark'])
+        self.hdr.nstar = int(raw['nstar'])
+        self._extend_counts(header_t.itemsize)
+
+        # Same offsets as used by tipsy_read_{gas,dark,star}_*
+        self._gas_offset = header_t.itemsize
+        self._dark_offset = self._gas_offset + self.hdr.ngas * self._gas_t.itemsize
+        self._star_offset = self._dark_offset + self.hdr.ndark * self._dark_t.itemsize
+
+        self.dark_particles = None
+        self.star_particles = None
+        self.gas_particles = None
+        self._index = None
+
+    def _extend_counts(self, header_size):
+        # Same as tipsy_extend_header: counts are stored modulo 2**32 on disk
+        expected = header_size + self.hdr.ngas * self._gas_t.itemsize + \
+                   self.hdr.ndark * self._dark_t.itemsize + self.hdr.nstar * self._star_t.itemsize
+        excess = os.path.getsize(self.filename) - expected
+        wrap = 2**32 * self._dark_t.itemsize
+        if excess > 0 and excess % wrap == 0:
+            self.hdr.ndark += excess // wrap * 2**32
+        nbodies = self.hdr.ngas + self.hdr.ndark + self.hdr.nstar
+        if nbodies % 2**32 == self.hdr.nbodies:
+            self.hdr.nbodies = nbodies
+
+    def _map(self, dtype, offset, size):
+        return family(np.memmap(self.filename, dtype=dtype, mode='r', offset=offset, shape=(size,)))
+
+    def close(self):
+        # The mappings stay valid for as long as any view into them is alive
+        self.dark_particles = None
+        self.star_particles = None
+        self.gas_particles = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False  # always re-raise exceptions
+
+    @property
+    def header(self):
+        return self.hdr
+
+    @property
+    def index(self):
+        """The spatial index written by tipsy_index.sort"""
+        if self._index is None:
+            self._index = tipsy_index.index(self.filename, self.hdr)
+        return self._index
+
+    def box(self, family, lo, hi):
+        """The particles of `family` ('gas', 'darkmatter', or 'stars') in the box [lo, hi], read using the spatial index"""
+        return tipsy_index.box(self, family, lo, hi)
+
+    def sphere(self, family, center, radius):
+        """The particles of `family` within `radius` of `center`, read using the spatial index"""
+        return tipsy_index.sphere(self, family, center, radius)
+
+    @property
+    def gas(self):
+        if self.hdr.ngas == 0:
+            return None
+
+        if self.gas_particles is None:
+            self.gas_particles = self._map(self._gas_t, self._gas_offset, self.hdr.ngas)
+        return self.gas_particles
+
+    def read_gas(self, start=None, stop=None):
+        start, stop = tipsy_c._range(start, stop, self.hdr.ngas)
+        return self._map(self._gas_t, self._gas_offset + start * self._gas_t.itemsize, stop - start)
+
+    @property
+    def darkmatter(self):
+        if self.hdr.ndark == 0:
+            return None
+
+        if self.dark_particles is None:
+            self.dark_particles = self._map(self._dark_t, self._dark_offset, self.hdr.ndark)
+        return self.dark_particles
+
+    def read_darkmatter(self, start=None, stop=None):
+        start, stop = tipsy_c._range(start, stop, self.hdr.ndark)
+        return self._map(self._dark_t, self._dark_offset + start * self._dark_t.itemsize, stop - start)
+
+    @property
+    def stars(self):
+        if self.hdr.nstar == 0:
+            return None
+
+        if self.star_particles is None:
+            self.star_particles = self._map(self._star_t, self._star_offset, self.hdr.nstar)
+        return self.star_particles
+
+    def read_stars(self, start=None, stop=None):
+        start, stop = tipsy_c._range(start, stop, self.hdr.nstar)
+        return self._map(self._star_t, self._star_offset + start * self._star_t.itemsize, stop - start)
@@ -0,0 +1,454 @@
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+#include "tipsy.h"
+#include "tipsy_py.h"
+#include "tipsyio_err.h"
+#include <limits.h>
+#include <stddef.h>
+#include <stdint.h>
+#include <string.h>
+
+/*
+ * The _tipsy extension module: one Python type over the XDR and native streams
+ *
+ * Particle columns are taken as buffer-protocol objects and handed to the C
+ * library as they are, and the GIL is released for the whole encode/decode.
+ * The Python-side conversion of arbitrary inputs to float32 lives in tipsy_c.py.
+ */
+
+typedef struct {
+	PyObject_HEAD
+	tipsy_py_ops const* ops;
+	void*               stream;
+	tipsy_header        header; /* as last read; gives the offsets of the families */
+	int                 busy;   /* the GIL is released while the stream is in use */
+} tipsy_py_stream;
+
+typedef enum { TIPSY_PY_GAS, TIPSY_PY_DARK, TIPSY_PY_STAR } tipsy_py_family;
+
+/* Where a column and its constant value live in tipsy_{gas,dark,star}_data */
+typedef struct {
+	char const* name;
+	size_t      column;
+	size_t      constant;
+	Py_ssize_t  ncomp;
+} __column_spec;
+
+#define __spec(type, name, constant, ncomp) {#name, offsetof(type, name), offsetof(type, constant), ncomp}
+#define __gas(name, constant, ncomp) __spec(tipsy_gas_data, name, constant, ncomp)
+#define __dark(name, constant, ncomp) __spec(tipsy_dark_data, name, constant, ncomp)
+#define __star(name, constant, ncomp) __spec(tipsy_star_data, name, constant, ncomp)
+
+/* In the order of the arguments of the read_X/write_X methods */
+static __column_spec const __gas_columns[] = {
+	__gas(mass, constant.mass, 1),       __gas(pos, constant.pos, 3),   __gas(vel, constant.vel, 3),
+	__gas(rho, constant.rho, 1),         __gas(temp, constant.temp, 1), __gas(hsmooth, constant.hsmooth, 1),
+	__gas(metals, constant.metals, 1),   __gas(phi, constant.phi, 1),
+};
+static __column_spec const __dark_columns[] = {
+	__dark(mass, constant.mass, 1),      __dark(pos, constant.pos, 3),  __dark(vel, constant.vel, 3),
+	__dark(soft, constant.softening, 1), __dark(phi, constant.phi, 1),
+};
+static __column_spec const __star_columns[] = {
+	__star(mass, constant.mass, 1),       __star(pos, constant.pos, 3),     __star(vel, constant.vel, 3),
+	__star(metals, constant.metals, 1),   __star(tform, constant.tform, 1), __star(soft, constant.softening, 1),
+	__star(phi, constant.phi, 1),
+};
+
+enum { TIPSY_PY_MAX_COLUMNS = 8 };
+
+typedef union {
+	tipsy_gas_data  gas;
+	tipsy_dark_data dark;
+	tipsy_star_data star;
+} __family_data;
+
+/*************************************************************************************************************/
+static PyObject* __error(int err) {
+	if (err >= TIPSY_READ_UNOPENED) {
+		PyErr_SetString(PyExc_OSError, tipsy_strerror((tipsy_error_t)err));
+	} else {
+		// A system error; OSError picks the matching subclass (e.g., FileNotFoundError)
+		PyObject* args = Py_BuildValue("(is)", err, tipsy_strerror((tipsy_error_t)err));
+		if (args) {
+			PyErr_SetObject(PyExc_OSError, args);
+			Py_DECREF(args);
+		}
+	}
+	return NULL;
+}
+
+/* Claim the stream for an operation that releases the GIL */
+static int __acquire(tipsy_py_stream* self) {
+	if (!self->stream) {
+		PyErr_SetString(PyExc_ValueError, "I/O operation on closed Tipsy file");
+		return -1;
+	}
+	if (self->busy) {
+		PyErr_SetString(PyExc_RuntimeError, "Tipsy file is in use by another thread");
+		return -1;
+	}
+	self->busy = 1;
+	return 0;
+}
+
+static int __size(PyObject* obj, size_t* size) {
+	*size = PyLong_AsSize_t(obj);
+	return (*size == (size_t)-1 && PyErr_Occurred()) ? -1 : 0;
+}
+
+/*
+ * Point a column at the buffer 'obj' or, when writing, set its constant from a number
+ *
+ * Buffers must be C-contiguous float32 (raw bytes are reinterpreted) with room for
+ * 'size' particles. Vector constants are three numbers or one to broadcast.
+ */
+static int __column(PyObject* obj, Py_buffer* view, __column_spec const* spec, void* data, size_t size, int writable) {
+	if (PyObject_CheckBuffer(obj)) {
+		const int flags = PyBUF_C_CONTIGUOUS | PyBUF_FORMAT | (writable ? PyBUF_WRITABLE : 0);
+		if (PyObject_GetBuffer(obj, view, flags) != 0) { return -1; }
+
+		char const* format = view->format ? view->format : "B";
+		if (*format == '@' || *format == '=' || *format == (PY_LITTLE_ENDIAN ? '<' : '>')) { ++format; }
+		const int is_float = strcmp(format, "f") == 0 && view->itemsize == sizeof(float);
+		const int is_bytes = (strcmp(format, "B") == 0 || strcmp(format, "b") == 0 || strcmp(format, "c") == 0);
+		if (!is_float && !is_bytes) {
+			PyErr_Format(PyExc_TypeError, "%s must be float32, not '%s'", spec->name, view->format);
+			return -1;
+		}
+		if ((uintptr_t)view->buf % sizeof(float) != 0) {
+			PyErr_Format(PyExc_ValueError, "%s is not aligned to a float32", spec->name);
+			return -1;
+		}
+		const size_t need = size * (size_t)spec->ncomp * sizeof(float);
+		if ((size_t)view->len < need) {
+			PyErr_Format(PyExc_ValueError, "%s has %zd particles, but %zu are needed", spec->name,
+				     view->len / (Py_ssize_t)(spec->ncomp * (Py_ssize_t)sizeof(float)), size);
+			return -1;
+		}
+		memcpy((char*)data + spec->column, &(view->buf), sizeof(void*));
+		return 0;
+	}
+	if (writable) {
+		PyErr_Format(PyExc_TypeError, "%s must be a writable float32 buffer", spec->name);
+		return -1;
+	}
+
+	// A constant; the NULL column tells the library to use it for every particle
+	float value[3];
+	if (spec->ncomp == 3 && PySequence_Check(obj) && !PyUnicode_Check(obj)) {
+		PyObject* seq = PySequence_Fast(obj, "");
+		if (!seq) { return -1; }
+		if (PySequence_Fast_GET_SIZE(seq) != 3) {
+			Py_DECREF(seq);
+			PyErr_Format(PyExc_ValueError, "constant %s must have 3 components", spec->name);
+			return -1;
+		}
+		for (Py_ssize_t i = 0; i < 3; ++i) {
+			value[i] = (float)PyFloat_AsDouble(PySequence_Fast_GET_ITEM(seq, i));
+		}
+		Py_DECREF(seq);
+	} else {
+		value[0] = value[1] = value[2] = (float)PyFloat_AsDouble(obj);
+	}
+	if (PyErr_Occurred()) {
+		PyErr_Format(PyExc_TypeError, "%s must be a float32 buffer or a number", spec->name);
+		return -1;
+	}
+	memset((char*)data + spec->column, 0, sizeof(void*));
+	memcpy((char*)data + spec->constant, value, (size_t)spec->ncomp * sizeof(float));
+	return 0;
+}
+
+/*
+ * Fill 'data' for the family 'f' from the column arguments
+ *
+ * args[0] is the first particle for reads, followed by the number of particles
+ * and the columns. The buffers in 'views' must be released by the caller.
+ */
+static int __family(tipsy_py_family f, PyObject* const* args, Py_ssize_t nargs, int reading, __family_data* data,
+		    size_t* first, Py_buffer* views) {
+	__column_spec const* specs;
+	Py_ssize_t           ncolumns;
+	size_t*              size;
+	char const*          method;
+	switch (f) {
+	case TIPSY_PY_GAS:
+		specs    = __gas_columns;
+		ncolumns = sizeof(__gas_columns) / sizeof(__gas_columns[0]);
+		size     = &(data->gas.size);
+		method   = reading ? "read_gas" : "write_gas";
+		break;
+	case TIPSY_PY_DARK:
+		specs    = __dark_columns;
+		ncolumns = sizeof(__dark_columns) / sizeof(__dark_columns[0]);
+		size     = &(data->dark.size);
+		method   = reading ? "read_dark" : "write_dark";
+		break;
+	default:
+		specs    = __star_columns;
+		ncolumns = sizeof(__star_columns) / sizeof(__star_columns[0]);
+		size     = &(data->star.size);
+		method   = reading ? "read_star" : "write_star";
+		break;
+	}
+
+	const Py_ssize_t nfixed = reading ? 2 : 1;
+	if (nargs != nfixed + ncolumns) {
+		PyErr_Format(PyExc_TypeError, "%s() takes %zd arguments (%zd given)", method, nfixed + ncolumns, nargs);
+		return -1;
+	}
+	*first = 0;
+	if (reading && __size(args[0], first) != 0) { return -1; }
+	if (__size(args[nfixed - 1], size) != 0) { return -1; }
+	for (Py_ssize_t i = 0; i < ncolumns; ++i) {
+		if (__column(args[nfixed + i], &views[i], &specs[i], data, *size, reading) != 0) { return -1; }
+	}
+	return 0;
+}
+
+static PyObject* __io(tipsy_py_stream* self, tipsy_py_family f, PyObject* const* args, Py_ssize_t nargs,
+		      int reading) {
+	__family_data data;
+	Py_buffer     views[TIPSY_PY_MAX_COLUMNS];
+	size_t        first;
+	memset(&data, 0, sizeof(data));
+	memset(views, 0, sizeof(views));
+
+	PyObject* result = NULL;
+	if (__family(f, args, nargs, reading, &data, &first, views) != 0) { goto done; }
+	if (__acquire(self) != 0) { goto done; }
+
+	int status = 0;
+	Py_BEGIN_ALLOW_THREADS
+	switch (f) {
+	case TIPSY_PY_GAS:
+		status = reading ? self->ops->read_gas(self->stream, &(self->header), first, &(data.gas))
+				 : self->ops->write_gas(self->stream, &(data.gas));
+		break;
+	case TIPSY_PY_DARK:
+		status = reading ? self->ops->read_dark(self->stream, &(self->header), first, &(data.dark))
+				 : self->ops->write_dark(self->stream, &(data.dark));
+		break;
+	default:
+		status = reading ? self->ops->read_star(self->stream, &(self->header), first, &(data.star))
+				 : self->ops->write_star(self->stream, &(data.star));
+		break;
+	}
+	Py_END_ALLOW_THREADS
+	self->busy = 0;
+
+	if (status != 0) {
+		__error(status);
+		goto done;
+	}
+	Py_INCREF(Py_None);
+	result = Py_None;
+
+done:
+	for (int i = 0; i < TIPSY_PY_MAX_COLUMNS; ++i) { PyBuffer_Release(&views[i]); }
+	return result;
+}
+
+/*************************************************************************************************************/
+static PyObject* __new(PyTypeObject* type, PyObject* args, PyObject* kwargs) {
+	static char* kwlist[] = {"filename", "mode", "write", "xdr", NULL};
+	PyObject*    filename = NULL;
+	char const*  mode;
+	int          write, xdr;
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O&spp", kwlist, PyUnicode_FSConverter, &filename, &mode,
+					 &write, &xdr)) {
+		return NULL;
+	}
+
+	tipsy_py_stream* self = (tipsy_py_stream*)type->tp_alloc(type, 0);
+	if (!self) {
+		Py_DECREF(filename);
+		return NULL;
+	}
+	self->ops = xdr ? &tipsy_py_xdr_ops : &tipsy_py_native_ops;
+
+	char const* name = PyBytes_AS_STRING(filename);
+	int         status;
+	Py_BEGIN_ALLOW_THREADS
+	status = self->ops->open(&(self->stream), name, mode, write);
+	Py_END_ALLOW_THREADS
+	Py_DECREF(filename);
+	if (status != 0) {
+		Py_DECREF(self);
+		return __error(status);
+	}
+	return (PyObject*)self;
+}
+
+static void __dealloc(tipsy_py_stream* self) {
+	if (self->stream) { self->ops->destroy(self->stream); }
+	Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static PyObject* __close(tipsy_py_stream* self, PyObject* Py_UNUSED(ignored)) {
+	if (!self->stream) { Py_RETURN_NONE; }
+	if (__acquire(self) != 0) { return NULL; }
+	Py_BEGIN_ALLOW_THREADS
+	self->ops->destroy(self->stream);
+	Py_END_ALLOW_THREADS
+	self->stream = NULL;
+	self->busy   = 0;
+	Py_RETURN_NONE;
+}
+
+static PyObject* __finish(tipsy_py_stream* self, PyObject* Py_UNUSED(ignored)) {
+	if (__acquire(self) != 0) { return NULL; }
+	int status;
+	Py_BEGIN_ALLOW_THREADS
+	status = self->ops->finish(self->stream);
+	Py_END_ALLOW_THREADS
+	self->busy = 0;
+	if (status != 0) { return __error(status); }
+	Py_RETURN_NONE;
+}
+
+static PyObject* __set_block_size(tipsy_py_stream* self, PyObject* arg) {
+	size_t block_records;
+	if (__size(arg, &block_records) != 0) { return NULL; }
+	if (__acquire(self) != 0) { return NULL; }
+	const int status = self->ops->set_block_size(self->stream, block_records);
+	self->busy       = 0;
+	if (status != 0) { return __error(status); }
+	Py_RETURN_NONE;
+}
+
+static PyObject* __set_option(tipsy_py_stream* self, PyObject* arg, int (*set)(void*, int), char const* what) {
+	if (!set) { return PyErr_Format(PyExc_ValueError, "%s files have no %s", self->ops->name, what); }
+	const long value = PyLong_AsLong(arg);
+	if (value == -1 && PyErr_Occurred()) { return NULL; }
+	if (value < INT_MIN || value > INT_MAX) {
+		return PyErr_Format(PyExc_OverflowError, "%ld is out of range for %s", value, what);
+	}
+	if (__acquire(self) != 0) { return NULL; }
+	const int status = set(self->stream, (int)value);
+	self->busy       = 0;
+	if (status != 0) { return __error(status); }
+	Py_RETURN_NONE;
+}
+static PyObject* __set_codec(tipsy_py_stream* self, PyObject* arg) {
+	return __set_option(self, arg, self->ops->set_codec, "codecs");
+}
+static PyObject* __set_threads(tipsy_py_stream* self, PyObject* arg) {
+	return __set_option(self, arg, self->ops->set_threads, "threaded I/O");
+}
+
+/*************************************************************************************************************/
+static PyObject* __read_header(tipsy_py_stream* self, PyObject* Py_UNUSED(ignored)) {
+	if (__acquire(self) != 0) { return NULL; }
+	int status;
+	Py_BEGIN_ALLOW_THREADS
+	status = self->ops->read_header(self->stream, &(self->header));
+	Py_END_ALLOW_THREADS
+	self->busy = 0;
+	if (status != 0) { return __error(status); }
+
+	tipsy_header const* h = &(self->header);
+	return Py_BuildValue("(dKiKKK)", h->time, (unsigned long long)h->nbodies, h->ndim,
+			     (unsigned long long)h->ngas, (unsigned long long)h->ndark, (unsigned long long)h->nstar);
+}
+
+static PyObject* __write_header(tipsy_py_stream* self, PyObject* args) {
+	tipsy_header       h;
+	unsigned long long nbodies, ngas, ndark, nstar;
+	if (!PyArg_ParseTuple(args, "dKiKKK:write_header", &(h.time), &nbodies, &(h.ndim), &ngas, &ndark, &nstar)) {
+		return NULL;
+	}
+	h.nbodies = nbodies;
+	h.ngas    = ngas;
+	h.ndark   = ndark;
+	h.nstar   = nstar;
+
+	if (__acquire(self) != 0) { return NULL; }
+	int status;
+	Py_BEGIN_ALLOW_THREADS
+	status = self->ops->write_header(self->stream, &h);
+	Py_END_ALLOW_THREADS
+	self->busy = 0;
+	if (status != 0) { return __error(status); }
+	Py_RETURN_NONE;
+}
+
+static PyObject* __read_gas(tipsy_py_stream* self, PyObject* const* args, Py_ssize_t nargs) {
+	return __io(self, TIPSY_PY_GAS, args, nargs, 1);
+}
+static PyObject* __read_dark(tipsy_py_stream* self, PyObject* const* args, Py_ssize_t nargs) {
+	return __io(self, TIPSY_PY_DARK, args, nargs, 1);
+}
+static PyObject* __read_star(tipsy_py_stream* self, PyObject* const* args, Py_ssize_t nargs) {
+	return __io(self, TIPSY_PY_STAR, args, nargs, 1);
+}
+static PyObject* __write_gas(tipsy_py_stream* self, PyObject* const* args, Py_ssize_t nargs) {
+	return __io(self, TIPSY_PY_GAS, args, nargs, 0);
+}
+static PyObject* __write_dark(tipsy_py_stream* self, PyObject* const* args, Py_ssize_t nargs) {
+	return __io(self, TIPSY_PY_DARK, args, nargs, 0);
+}
+static PyObject* __write_star(tipsy_py_stream* self, PyObject* const* args, Py_ssize_t nargs) {
+	return __io(self, TIPSY_PY_STAR, args, nargs, 0);
+}
+
+/*************************************************************************************************************/
+#define __fastcall(f) ((PyCFunction)(void (*)(void))(f))
+
+static PyMethodDef __stream_methods[] = {
+	{"close", (PyCFunction)__close, METH_NOARGS, "Close the file without finishing it"},
+	{"finish", (PyCFunction)__finish, METH_NOARGS, "Patch the header with the number of particles written"},
+	{"set_block_size", (PyCFunction)__set_block_size, METH_O, "Set the number of particles per read/write"},
+	{"set_codec", (PyCFunction)__set_codec, METH_O, "Set the XDR codec"},
+	{"set_threads", (PyCFunction)__set_threads, METH_O, "Set the number of XDR I/O threads"},
+	{"read_header", (PyCFunction)__read_header, METH_NOARGS,
+	 "read_header() -> (time, nbodies, ndim, ngas, ndark, nstar)"},
+	{"write_header", (PyCFunction)__write_header, METH_VARARGS,
+	 "write_header(time, nbodies, ndim, ngas, ndark, nstar)"},
+	{"read_gas", __fastcall(__read_gas), METH_FASTCALL,
+	 "read_gas(first, size, mass, pos, vel, rho, temp, hsmooth, metals, phi)"},
+	{"read_dark", __fastcall(__read_dark), METH_FASTCALL, "read_dark(first, size, mass, pos, vel, soft, phi)"},
+	{"read_star", __fastcall(__read_star), METH_FASTCALL,
+	 "read_star(first, size, mass, pos, vel, metals, tform, soft, phi)"},
+	{"write_gas", __fastcall(__write_gas), METH_FASTCALL,
+	 "write_gas(size, mass, pos, vel, rho, temp, hsmooth, metals, phi)"},
+	{"write_dark", __fastcall(__write_dark), METH_FASTCALL, "write_dark(size, mass, pos, vel, soft, phi)"},
+	{"write_star", __fastcall(__write_star), METH_FASTCALL,
+	 "write_star(size, mass, pos, vel, metals, tform, soft, phi)"},
+	{NULL, NULL, 0, NULL},
+};
+
+static PyTypeObject __stream_type = {
+	PyVarObject_HEAD_INIT(NULL, 0)
+	.tp_name      = "_tipsy.stream",
+	.tp_doc       = "stream(filename, mode, write, xdr)\n\n"
+			"An XDR or native Tipsy file. Columns are float32 buffers, or numbers\n"
+			"for constant columns when writing. The GIL is released during I/O.",
+	.tp_basicsize = sizeof(tipsy_py_stream),
+	.tp_flags     = Py_TPFLAGS_DEFAULT,
+	.tp_new       = __new,
+	.tp_dealloc   = (destructor)__dealloc,
+	.tp_methods   = __stream_methods,
+};
+
+static struct PyModuleDef __module = {
+	PyModuleDef_HEAD_INIT,
+	.m_name = "_tipsy",
+	.m_doc  = "Tipsy file I/O",
+	.m_size = -1,
+};
+
+PyMODINIT_FUNC PyInit__tipsy(void) {
+	if (PyType_Ready(&__stream_type) < 0) { return NULL; }
+	PyObject* module = PyModule_Create(&__module);
+	if (!module) { return NULL; }
+	Py_INCREF(&__stream_type);
+	if (PyModule_AddObject(module, "stream", (PyObject*)&__stream_type) < 0) {
+		Py_DECREF(&__stream_type);
+		Py_DECREF(module);
+		return NULL;
+	}
+	return module;
+}
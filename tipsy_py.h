@@ -0,0 +1,30 @@
+#pragma once
+
+#include "tipsy.h"
+
+/*
+ * The operations of one Tipsy file format, as used by the Python module
+ *
+ * Streams are opaque to the module so that both formats share one Python
+ * type. Operations a format doesn't have are NULL.
+ */
+typedef struct {
+	char const* name;
+	int  (*open)(void**, char const*, char const*, int);
+	void (*destroy)(void*);
+	int  (*set_block_size)(void*, size_t);
+	int  (*set_codec)(void*, int);
+	int  (*set_threads)(void*, int);
+	int  (*finish)(void*);
+	int  (*read_header)(void*, tipsy_header*);
+	int  (*read_gas)(void*, tipsy_header const*, size_t, tipsy_gas_data*);
+	int  (*read_dark)(void*, tipsy_header const*, size_t, tipsy_dark_data*);
+	int  (*read_star)(void*, tipsy_header const*, size_t, tipsy_star_data*);
+	int  (*write_header)(void*, tipsy_header const*);
+	int  (*write_gas)(void*, tipsy_gas_data const*);
+	int  (*write_dark)(void*, tipsy_dark_data const*);
+	int  (*write_star)(void*, tipsy_star_data const*);
+} tipsy_py_ops;
+
+extern tipsy_py_ops const tipsy_py_xdr_ops;
+extern tipsy_py_ops const tipsy_py_native_ops;
@@ -1,43 +1,79 @@
 #include "tipsy.h"
+#include "tipsy_py.h"
+#include "tipsyio_err.h"
 #include "tipsyio_native.h"
+#include <stdlib.h>
 
-static tipsy_native_stream stream;
-
-/****************************************************************************/
-int tipsy_py_init_reader_native(char const* filename) {
-	return tipsy_init_native(&stream, filename, "rb", TIPSY_NATIVE_DECODE);
+/*
+ * Each reader or writer owns its own stream, so any number of them
+ * can be open at once. The stream is opaque to the Python module.
+ */
+static int __open(void** stream, char const* filename, char const* mode, int write) {
+	tipsy_native_stream* s = calloc(1, sizeof(tipsy_native_stream));
+	if (!s) { return TIPSY_BAD_ALLOC; }
+	const int status = tipsy_init_native(s, filename, mode, write ? TIPSY_NATIVE_ENCODE : TIPSY_NATIVE_DECODE);
+	if (status != 0) {
+		tipsy_destroy_native(s);
+		free(s);
+		s = NULL;
+	}
+	*stream = s;
+	return status;
 }
-int tipsy_py_init_writer_native(char const* filename, const char* mode) {
-	return tipsy_init_native(&stream, filename, mode, TIPSY_NATIVE_ENCODE);
+static void __destroy(void* stream) {
+	tipsy_destroy_native(stream);
+	free(stream);
 }
-void tipsy_py_destroy_native() {
-	tipsy_destroy_native(&stream);
+static int __set_block_size(void* stream, size_t block_records) {
+	return tipsy_set_block_size_native(stream, block_records);
+}
+static int __finish(void* stream) {
+	return tipsy_finish_native(stream);
 }
 
 /****************************************************************************/
-int tipsy_py_read_header_native(tipsy_header* h) {
-	return tipsy_read_header_native(&stream, h);
+static int __read_header(void* stream, tipsy_header* h) {
+	return tipsy_read_header_native(stream, h);
 }
-int tipsy_py_read_gas_native(tipsy_header const* h, tipsy_gas_data* d) {
-	return tipsy_read_gas_native(&stream, h, d);
+static int __read_gas(void* stream, tipsy_header const* h, size_t first, tipsy_gas_data* d) {
+	return tipsy_read_gas_range_native(stream, h, first, d);
 }
-int tipsy_py_read_dark_native(tipsy_header const* h, tipsy_dark_data* d) {
-	return tipsy_read_dark_native(&stream, h, d);
+static int __read_dark(void* stream, tipsy_header const* h, size_t first, tipsy_dark_data* d) {
+	return tipsy_read_dark_range_native(stream, h, first, d);
 }
-int tipsy_py_read_star_native(tipsy_header const* h, tipsy_star_data* d) {
-	return tipsy_read_star_native(&stream, h, d);
+static int __read_star(void* stream, tipsy_header const* h, size_t first, tipsy_star_data* d) {
+	return tipsy_read_star_range_native(stream, h, first, d);
 }
 
 /****************************************************************************/
-int tipsy_py_write_header_native(tipsy_header* h) {
-	return tipsy_write_header_native(&stream, h);
+static int __write_header(void* stream, tipsy_header const* h) {
+	return tipsy_write_header_native(stream, h);
 }
-int tipsy_py_write_gas_native(tipsy_gas_data* d) {
-	return tipsy_write_gas_native(&stream, d);
+static int __write_gas(void* stream, tipsy_gas_data const* d) {
+	return tipsy_write_gas_native(stream, d);
 }
-int tipsy_py_write_dark_native(tipsy_dark_data* d) {
-	return tipsy_write_dark_native(&stream, d);
+static int __write_dark(void* stream, tipsy_dark_data const* d) {
+	return tipsy_write_dark_native(stream, d);
 }
-int tipsy_py_write_star_native(tipsy_star_data* d) {
-	return tipsy_write_star_native(&stream, d);
+static int __write_star(void* stream, tipsy_star_data const* d) {
+	return tipsy_write_star_native(stream, d);
 }
+
+/* Native files have a single codec and no threaded I/O */
+tipsy_py_ops const tipsy_py_native_ops = {
+	"native",
+	__open,
+	__destroy,
+	__set_block_size,
+	NULL,
+	NULL,
+	__finish,
+	__read_header,
+	__read_gas,
+	__read_dark,
+	__read_star,
+	__write_header,
+	__write_gas,
+	__write_dark,
+	__write_star,
+};
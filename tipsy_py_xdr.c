@@ -1,42 +1,84 @@
 #include "tipsy.h"
+#include "tipsy_py.h"
+#include "tipsyio_err.h"
 #include "tipsyio_xdr.h"
+#include <stdlib.h>
 
-static tipsy_xdr_stream xdr_stream;
-
-int tipsy_py_init_reader_xdr(char const* filename) {
-	return tipsy_init_xdr(&xdr_stream, filename, "rb", TIPSY_XDR_DECODE);
+/*
+ * Each reader or writer owns its own stream, so any number of them
+ * can be open at once. The stream is opaque to the Python module.
+ */
+static int __open(void** stream, char const* filename, char const* mode, int write) {
+	tipsy_xdr_stream* s = calloc(1, sizeof(tipsy_xdr_stream));
+	if (!s) { return TIPSY_BAD_ALLOC; }
+	const int status = tipsy_init_xdr(s, filename, mode, write ? TIPSY_XDR_ENCODE : TIPSY_XDR_DECODE);
+	if (status != 0) {
+		tipsy_destroy_xdr(s);
+		free(s);
+		s = NULL;
+	}
+	*stream = s;
+	return status;
+}
+static void __destroy(void* stream) {
+	tipsy_destroy_xdr(stream);
+	free(stream);
+}
+static int __set_block_size(void* stream, size_t block_records) {
+	return tipsy_set_block_size_xdr(stream, block_records);
 }
-int tipsy_py_init_writer_xdr(char const* filename, char const* mode) {
-	return tipsy_init_xdr(&xdr_stream, filename, mode, TIPSY_XDR_ENCODE);
+static int __set_codec(void* stream, int codec) {
+	return tipsy_set_codec_xdr(stream, (tipsy_xdr_codec)codec);
 }
-void tipsy_py_destroy_xdr() {
-	tipsy_destroy_xdr(&xdr_stream);
+static int __set_threads(void* stream, int nthreads) {
+	return tipsy_set_threads_xdr(stream, nthreads);
+}
+static int __finish(void* stream) {
+	return tipsy_finish_xdr(stream);
 }
 
 /****************************************************************************/
-int tipsy_py_read_header_xdr(tipsy_header* h) {
-	return tipsy_read_header_xdr(&xdr_stream, h);
+static int __read_header(void* stream, tipsy_header* h) {
+	return tipsy_read_header_xdr(stream, h);
 }
-int tipsy_py_read_gas_xdr(tipsy_header const* h, tipsy_gas_data* d) {
-	return tipsy_read_gas_xdr(&xdr_stream, h, d);
+static int __read_gas(void* stream, tipsy_header const* h, size_t first, tipsy_gas_data* d) {
+	return tipsy_read_gas_range_xdr(stream, h, first, d);
 }
-int tipsy_py_read_dark_xdr(tipsy_header const* h, tipsy_dark_data* d) {
-	return tipsy_read_dark_xdr(&xdr_stream, h, d);
+static int __read_dark(void* stream, tipsy_header const* h, size_t first, tipsy_dark_data* d) {
+	return tipsy_read_dark_range_xdr(stream, h, first, d);
 }
-int tipsy_py_read_star_xdr(tipsy_header const* h, tipsy_star_data* d) {
-	return tipsy_read_star_xdr(&xdr_stream, h, d);
+static int __read_star(void* stream, tipsy_header const* h, size_t first, tipsy_star_data* d) {
+	return tipsy_read_star_range_xdr(stream, h, first, d);
 }
 
 /****************************************************************************/
-int tipsy_py_write_header_xdr(tipsy_header* h) {
-	return tipsy_write_header_xdr(&xdr_stream, h);
+static int __write_header(void* stream, tipsy_header const* h) {
+	return tipsy_write_header_xdr(stream, h);
 }
-int tipsy_py_write_gas_xdr(tipsy_gas_data* d) {
-	return tipsy_write_gas_xdr(&xdr_stream, d);
+static int __write_gas(void* stream, tipsy_gas_data const* d) {
+	return tipsy_write_gas_xdr(stream, d);
 }
-int tipsy_py_write_dark_xdr(tipsy_dark_data* d) {
-	return tipsy_write_dark_xdr(&xdr_stream, d);
+static int __write_dark(void* stream, tipsy_dark_data const* d) {
+	return tipsy_write_dark_xdr(stream, d);
 }
-int tipsy_py_write_star_xdr(tipsy_star_data* d) {
-	return tipsy_write_star_xdr(&xdr_stream, d);
+static int __write_star(void* stream, tipsy_star_data const* d) {
+	return tipsy_write_star_xdr(stream, d);
 }
+
+tipsy_py_ops const tipsy_py_xdr_ops = {
+	"xdr",
+	__open,
+	__destroy,
+	__set_block_size,
+	__set_codec,
+	__set_threads,
+	__finish,
+	__read_header,
+	__read_gas,
+	__read_dark,
+	__read_star,
+	__write_header,
+	__write_gas,
+	__write_dark,
+	__write_star,
+};
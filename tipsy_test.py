@@ -1,4 +1,5 @@
 import tipsy
+import tipsy_c
 import numpy as np
 
 def check(x, true, msg):
@@ -36,30 +37,524 @@ def run_test(filename, is_xdr, ngas, ndark, nstar):
             star = generate_data(nstar, 7)
             f.stars(*star, nstar)
 
-    with tipsy.File(filename, is_xdr) as f:
-        hdr = f.header
-        check(hdr.time, time, 'hdr.time')
-        check(hdr.nbodies, ngas + ndark + nstar, 'hdr.nbodies')
-        check(hdr.ngas, ngas, 'hdr.ngas')
-        check(hdr.ndark, ndark, 'hdr.ndark')
-        check(hdr.nstar, nstar, 'hdr.nstar')
+    for use_mmap in [False, True]:
+        with tipsy.File(filename, is_xdr, mmap=use_mmap) as f:
+            hdr = f.header
+            check(hdr.time, time, 'hdr.time')
+            check(hdr.nbodies, ngas + ndark + nstar, 'hdr.nbodies')
+            check(hdr.ngas, ngas, 'hdr.ngas')
+            check(hdr.ndark, ndark, 'hdr.ndark')
+            check(hdr.nstar, nstar, 'hdr.nstar')
         
-        data = f.gas
-        if data:
-            attrs = ['mass', 'pos', 'vel', 'rho', 'temp', 'hsmooth', 'metals', 'phi']
-            for a in attrs:
-                check(getattr(data, a), gas[attrs.index(a)], 'gas({0:d},{1:d},{2:d}).{3:s}'.format(ngas, ndark, nstar, a))
-        data = f.darkmatter
-        if data:
-            attrs = ['mass', 'pos', 'vel', 'soft', 'phi']
-            for a in attrs:
-                check(getattr(data, a), dark[attrs.index(a)], 'dark({0:d},{1:d},{2:d}).{3:s}'.format(ngas, ndark, nstar, a))
+            data = f.gas
+            if data:
+                attrs = ['mass', 'pos', 'vel', 'rho', 'temp', 'hsmooth', 'metals', 'phi']
+                for a in attrs:
+                    check(getattr(data, a), gas[attrs.index(a)], 'gas({0:d},{1:d},{2:d}).{3:s}'.format(ngas, ndark, nstar, a))
+            data = f.darkmatter
+            if data:
+                attrs = ['mass', 'pos', 'vel', 'soft', 'phi']
+                for a in attrs:
+                    check(getattr(data, a), dark[attrs.index(a)], 'dark({0:d},{1:d},{2:d}).{3:s}'.format(ngas, ndark, nstar, a))
   
-        data = f.stars
-        if data:
-            attrs = ['mass', 'pos', 'vel', 'metals', 'tform', 'soft', 'phi']
-            for a in attrs:
-                check(getattr(data, a), star[attrs.index(a)], 'star({0:d},{1:d},{2:d}).{3:s}'.format(ngas, ndark, nstar, a))
+            data = f.stars
+            if data:
+                attrs = ['mass', 'pos', 'vel', 'metals', 'tform', 'soft', 'phi']
+                for a in attrs:
+                    check(getattr(data, a), star[attrs.index(a)], 'star({0:d},{1:d},{2:d}).{3:s}'.format(ngas, ndark, nstar, a))
+
+def run_codec_test(filename, ngas, ndark, nstar):
+    """The block and reference XDR codecs must write identical bytes and read each other's files"""
+    gas = generate_data(ngas, 8)
+    dark = generate_data(ndark, 5)
+    star = generate_data(nstar, 7)
+    
+    contents = {}
+    for codec in ['block', 'reference']:
+        with tipsy.streaming_writer(filename, xdr_codec=codec) as f:
+            f.header(1.0, ngas, ndark, nstar)
+            f.gas(*gas, ngas)
+            f.darkmatter(*dark, ndark)
+            f.stars(*star, nstar)
+        with open(filename, 'rb') as f:
+            contents[codec] = f.read()
+    
+    if contents['block'] != contents['reference']:
+        raise ValueError('block and reference codecs wrote different files ({0:d},{1:d},{2:d})'.format(ngas, ndark, nstar))
+    
+    for codec in ['block', 'reference']:
+        with tipsy.File(filename, xdr_codec=codec) as f:
+            check(f.gas.mass, gas[0], 'gas.mass({0:s})'.format(codec))
+            check(f.darkmatter.vel, dark[2], 'dark.vel({0:s})'.format(codec))
+            check(f.stars.phi, star[6], 'star.phi({0:s})'.format(codec))
+    
+    # Threaded writes and reads of the block codec, including ranges that end mid-block
+    with tipsy.streaming_writer(filename, block_size=1000, nthreads=4) as f:
+        f.header(1.0, ngas, ndark, nstar)
+        f.gas(*gas, ngas)
+        f.darkmatter(*dark, ndark)
+        f.stars(*star, nstar)
+    with open(filename, 'rb') as f:
+        if f.read() != contents['block']:
+            raise ValueError('threaded and serial block codecs wrote different files')
+    with tipsy.File(filename, block_size=999, nthreads=3) as f:
+        check(f.gas.metals, gas[6], 'gas.metals(threads)')
+        check(f.darkmatter.pos, dark[1], 'dark.pos(threads)')
+        check(f.stars.mass, star[0], 'star.mass(threads)')
+    
+    # Partial blocks for both formats
+    for is_xdr in [True, False]:
+        with tipsy.streaming_writer(filename, is_xdr=is_xdr, block_size=7) as f:
+            f.header(1.0, ngas, ndark, nstar)
+            f.gas(*gas, ngas)
+            f.darkmatter(*dark, ndark)
+            f.stars(*star, nstar)
+        with tipsy.File(filename, is_xdr=is_xdr, block_size=1000) as f:
+            check(f.gas.pos, gas[1], 'gas.pos(block_size)')
+            check(f.darkmatter.soft, dark[3], 'dark.soft(block_size)')
+            check(f.stars.tform, star[4], 'star.tform(block_size)')
+
+def run_buffer_test(filename, size):
+    """Float32 buffers are written without copies and constant columns are broadcast"""
+    mass, pos, vel = [x.astype(np.float32) for x in generate_data(size, 3)]
+    
+    for x, ndims in [(mass, 1), (memoryview(mass), 1), (memoryview(pos).cast('B'), 2), (pos[:size // 2], 2)]:
+        if not np.shares_memory(tipsy_c._convert_array(x, 'x', 1, ndims), x):
+            raise ValueError('buffer was copied')
+    try:
+        tipsy_c._convert_column('1.0', 'soft', size)
+    except TypeError:
+        pass
+    else:
+        raise ValueError('a string was accepted as a constant column')
+    
+    for is_xdr, codec in [(True, 'block'), (True, 'reference'), (False, 'block')]:
+        with tipsy.streaming_writer(filename, is_xdr=is_xdr, xdr_codec=codec) as f:
+            f.header(1.0, size, size, size)
+            f.gas(mass, pos, tipsy.constant((1, 2, 3)), 1.0, 2.0, 3.0, tipsy.constant(4.0), 5.0, size)
+            f.darkmatter(memoryview(mass), memoryview(pos).cast('B'), vel, 0.25, 0, size)
+            f.stars(mass, tipsy.constant(7), vel, mass, 0, np.float32(0.5), -1.0, size)
+        with tipsy.File(filename, is_xdr=is_xdr, xdr_codec=codec) as f:
+            check(f.darkmatter.pos, pos, 'buffer({0:s}).dark.pos'.format(codec))
+            check(f.darkmatter.soft, 0.25, 'buffer({0:s}).dark.soft'.format(codec))
+            check(f.darkmatter.phi, 0.0, 'buffer({0:s}).dark.phi'.format(codec))
+            check(f.stars.soft, 0.5, 'buffer({0:s}).star.soft'.format(codec))
+            check(f.stars.phi, -1.0, 'buffer({0:s}).star.phi'.format(codec))
+            check(f.stars.pos, 7.0, 'buffer({0:s}).star.pos'.format(codec))
+            check(f.stars.tform, 0.0, 'buffer({0:s}).star.tform'.format(codec))
+            check(f.gas.pos, pos, 'buffer({0:s}).gas.pos'.format(codec))
+            check(f.gas.vel, np.array([1, 2, 3]), 'buffer({0:s}).gas.vel'.format(codec))
+            check(f.gas.hsmooth, 3.0, 'buffer({0:s}).gas.hsmooth'.format(codec))
+            check(f.gas.metals, 4.0, 'buffer({0:s}).gas.metals'.format(codec))
+
+def run_header_test(filename, size):
+    """Writers patch the header with the number of particles actually written"""
+    gas = generate_data(size, 8)
+    star = generate_data(size, 7)
+    for is_xdr in [True, False]:
+        with tipsy.streaming_writer(filename, is_xdr=is_xdr) as f:
+            f.header(2.0)
+            f.gas(*gas, size)
+            f.gas(*gas, size)
+            f.stars(*star, size)
+        with tipsy.File(filename, is_xdr=is_xdr) as f:
+            check(f.header.time, 2.0, 'header.time')
+            check(f.header.ngas, 2 * size, 'header.ngas')
+            check(f.header.ndark, 0, 'header.ndark')
+            check(f.header.nbodies, 3 * size, 'header.nbodies')
+            check(f.stars.mass, star[0], 'header.stars.mass')
+        
+        # A truncated header is an error rather than a header of garbage
+        from os import truncate
+        truncate(filename, 10)
+        try:
+            tipsy.File(filename, is_xdr=is_xdr).close()
+        except IOError:
+            pass
+        else:
+            raise ValueError('a truncated header was read (xdr={0})'.format(is_xdr))
+
+def run_range_test(filename, size):
+    """Slices of a family read only the selected particles"""
+    gas = generate_data(size, 8)
+    dark = generate_data(size + 3, 5)
+    for is_xdr, mmap in [(True, False), (False, False), (True, True), (False, True)]:
+        with tipsy.streaming_writer(filename, is_xdr=is_xdr, block_size=7) as f:
+            f.header(0.0, size, size + 3, 0)
+            f.gas(*gas, size)
+            f.darkmatter(*dark, size + 3)
+        with tipsy.File(filename, is_xdr=is_xdr, mmap=mmap, block_size=7) as f:
+            name = 'range(xdr={0}, mmap={1})'.format(is_xdr, mmap)
+            check(f.gas.size, size, name + '.size')
+            check(f.gas[10:size - 5].rho, gas[3][10:size - 5], name + '.gas.rho')
+            check(f.gas[-20:].pos, gas[1][-20:], name + '.gas.pos')
+            check(f.read_darkmatter(size, size + 3).vel, dark[2][size:], name + '.dark.vel')
+            check(f.read_darkmatter(5, 6).mass, dark[0][5:6], name + '.dark.mass')
+            check(f.gas[size + 1:].size, 0, name + '.empty')
+            check(f.read_stars().size, 0, name + '.stars')
+            check(f.darkmatter.soft, dark[3], name + '.dark.soft')
+            for key in [3, slice(None, None, 2)]:
+                try:
+                    f.gas[key]
+                except IndexError:
+                    pass
+                else:
+                    raise ValueError(name + ' accepted the key ' + repr(key))
+
+def run_count_test(filename, size):
+    """More than 2**32 dark matter particles are recovered from the file size"""
+    from os import truncate, path
+    gas = generate_data(size, 8)
+    dark = generate_data(size, 5)
+    for is_xdr, mmap in [(True, False), (False, False), (True, True), (False, True)]:
+        with tipsy.streaming_writer(filename, is_xdr=is_xdr) as f:
+            try:
+                f.header(0.0, 2**32, 0, 0)
+            except IOError:
+                pass
+            else:
+                raise ValueError('2**32 gas particles were accepted')
+            f.header(0.0, size, size, 0)
+            f.gas(*gas, size)
+            f.darkmatter(*dark, size)
+        # A sparse file with 2**32 more (zeroed) dark matter particles of 9 floats
+        truncate(filename, path.getsize(filename) + 2**32 * 36)
+        with tipsy.File(filename, is_xdr=is_xdr, mmap=mmap) as f:
+            name = 'count(xdr={0}, mmap={1})'.format(is_xdr, mmap)
+            check(f.header.ndark, 2**32 + size, name + '.ndark')
+            check(f.header.nbodies, 2**32 + 2 * size, name + '.nbodies')
+            check(f.read_darkmatter(0, size).pos, dark[1], name + '.dark.pos')
+            check(f.read_darkmatter(-3).mass, 0.0, name + '.dark.mass')
+            check(f.read_gas(size - 3).rho, gas[3][-3:], name + '.gas.rho')
+    truncate(filename, 0)
+
+def run_module_test(filename, size):
+    """The C module takes buffers and constants directly"""
+    import _tipsy
+    from pathlib import Path
+    mass, pos = [x.astype(np.float32) for x in generate_data(size, 3)[:2]]
+    for xdr in [True, False]:
+        s = _tipsy.stream(Path(filename), 'wb', True, xdr)
+        s.write_header(1.0, size, 3, 0, size, 0)
+        s.write_dark(size, memoryview(mass), bytearray(pos.tobytes()), (1, 2, 3), 0.5, 0)
+        for bad, error in [(pos.astype(np.float64), TypeError), (mass[:size - 1], ValueError), ('x', TypeError)]:
+            try:
+                s.write_dark(size, mass, bad, 0, 0, 0)
+            except error:
+                pass
+            else:
+                raise ValueError('bad column was accepted')
+        s.close()
+        
+        s = _tipsy.stream(filename, 'rb', False, xdr)
+        check(s.read_header()[4], size, 'module.ndark')
+        out = [bytearray(4 * size), np.empty((size, 3), np.float32), np.empty((size, 3), np.float32),
+               np.empty(size, np.float32), np.empty(size, np.float32)]
+        s.read_dark(0, size, *out)
+        check(np.frombuffer(out[0], np.float32), mass, 'module.mass')
+        check(out[1], pos, 'module.pos')
+        check(out[2], np.array([1, 2, 3]), 'module.vel')
+        check(out[3], 0.5, 'module.soft')
+        s.close()
+        try:
+            s.read_header()
+        except ValueError:
+            pass
+        else:
+            raise ValueError('closed stream was read')
+
+def run_index_test(filename, size):
+    """Box and sphere queries of a spatially sorted file read only nearby particles"""
+    gas = generate_data(size, 8)
+    gas[1] = 2.0 * gas[1] - 1.0
+    star = generate_data(size, 7)
+    for is_xdr, mmap in [(True, False), (False, False), (True, True), (False, True)]:
+        with tipsy.streaming_writer(filename, is_xdr=is_xdr) as f:
+            f.header(0.0, size, 0, size)
+            f.gas(*gas, size)
+            f.stars(*star, size)
+        tipsy.spatial_sort(filename, is_xdr=is_xdr, block_size=16, chunk_size=200)
+        with tipsy.File(filename, is_xdr=is_xdr, mmap=mmap) as f:
+            name = 'index(xdr={0}, mmap={1})'.format(is_xdr, mmap)
+            check(np.sort(f.gas.mass), np.sort(gas[0]), name + '.sorted.mass')
+            
+            pos = gas[1].astype(np.float32)
+            inside = np.all((pos >= 0.1) & (pos <= 0.6), axis=1)
+            ranges = f.index.box('gas', 0.1, 0.6)
+            check(sum(stop - start for start, stop in ranges) < size // 4, True, name + '.box.read')
+            found = f.box('gas', 0.1, 0.6)
+            check(found.size, np.count_nonzero(inside), name + '.box.size')
+            check(np.sort(found.rho), np.sort(gas[3][inside]), name + '.box.rho')
+            
+            pos = star[1].astype(np.float32).astype(np.float64)
+            inside = np.sum((pos - 0.5) ** 2, axis=1) <= 0.04
+            found = f.sphere('stars', (0.5, 0.5, 0.5), 0.2)
+            check(found.size, np.count_nonzero(inside), name + '.sphere.size')
+            check(np.sort(found.tform), np.sort(star[4][inside]), name + '.sphere.tform')
+            check(f.box('darkmatter', 0.0, 1.0).size, 0, name + '.empty')
+    
+    with tipsy.streaming_writer(filename) as f:
+        f.header(0.0, 1, 0, 0)
+        f.gas(*gas, 1)
+    with tipsy.File(filename) as f:
+        try:
+            f.box('gas', 0.0, 1.0)
+        except IOError:
+            pass
+        else:
+            raise ValueError('an out-of-date index was used')
+    from os import unlink
+    unlink(filename + '.index')
+
+def run_aux_test(filename, size):
+    """Auxiliary arrays round-trip in both formats and follow their particles when the file is sorted"""
+    from os import unlink
+    aux = filename + '.iord'
+    ids = np.arange(2 * size, dtype=np.uint32)
+    for ascii in [False, True]:
+        name = 'aux(ascii={0})'.format(ascii)
+        with tipsy.aux_writer(aux, ids.shape[0], ids.dtype, ascii=ascii) as f:
+            f.write(ids[:size // 3])
+            f.write(ids[size // 3:])
+        with tipsy.aux_file(aux, ids.dtype, ascii=ascii) as f:
+            check(len(f), ids.shape[0], name + '.size')
+            check(f.read(), ids, name + '.ids')
+            check(np.concatenate(list(f.chunks(7, 3, size))), ids[3:size], name + '.chunks')
+        
+        rho = np.random.rand(size).astype(np.float32)
+        with tipsy.aux_writer(aux, size, ascii=ascii) as f:
+            f.write(rho)
+        with tipsy.aux_file(aux, ascii=ascii) as f:
+            check(f.read(), rho, name + '.rho')
+    
+    try:
+        with tipsy.aux_writer(aux, size) as f:
+            f.write(rho[:-1])
+    except IOError:
+        pass
+    else:
+        raise ValueError('a short auxiliary array was written')
+    
+    # Unsigned 32-bit IDs above 2**31 fit, and unsigned 64-bit IDs must be below 2**63
+    large = np.array([1, 2**31 + 5, 2**32 - 1], dtype=np.uint32)
+    with tipsy.aux_writer(aux, large.shape[0], large.dtype) as f:
+        f.write(large)
+    with tipsy.aux_file(aux, large.dtype) as f:
+        check(f.read(), large.astype(np.int64), 'aux.uint32')
+    try:
+        with tipsy.aux_writer(aux, 1, np.uint64) as f:
+            f.write(np.array([2**63], dtype=np.uint64))
+    except ValueError:
+        pass
+    else:
+        raise ValueError('an unsigned 64-bit ID of 2**63 was accepted')
+    
+    # The masses are the IDs, so each ID must stay with its particle
+    gas = generate_data(size, 8)
+    star = generate_data(size, 7)
+    gas[0], star[0] = ids[:size].astype(np.float64), ids[size:].astype(np.float64)
+    with tipsy.streaming_writer(filename) as f:
+        f.header(0.0, size, 0, size)
+        f.gas(*gas, size)
+        f.stars(*star, size)
+    with tipsy.aux_writer(aux, ids.shape[0], ids.dtype) as f:
+        f.write(ids)
+    tipsy.spatial_sort(filename, block_size=16, chunk_size=200, aux=['.iord'])
+    with tipsy.File(filename) as f, tipsy.aux_file(aux, ids.dtype) as a:
+        check(a.read(0, size), f.gas.mass, 'aux.sorted.gas')
+        check(a.read(size), f.stars.mass, 'aux.sorted.stars')
+        check(bool(np.any(a.read() != ids)), True, 'aux.sorted.order')
+    unlink(aux)
+    unlink(filename + '.index')
+
+def run_binning_test(filename, size):
+    """Streamed grids match np.histogram2d over the same limits"""
+    import binning
+    gas = generate_data(size, 8)
+    gas[1] = 4.0 * gas[1] - 2.0
+    with tipsy.streaming_writer(filename) as f:
+        f.header(0.0, size, 0, 0)
+        f.gas(*gas, size)
+    pos = gas[1].astype(np.float32)
+    inside = (np.abs(pos[:, 0]) <= 1.5) & (np.abs(pos[:, 1]) <= 1.0)
+    for chunk_size, nworkers in [(size, 1), (77, 1), (300, 3)]:
+        source = binning.tipsy_source(filename, 'gas')
+        grid = binning.bin_particles(source, {'mass': 'mass', 'temp': 'temp'}, (1.5, 1.0), 16, chunk_size, nworkers)
+        name = 'binning({0:d}, {1:d})'.format(chunk_size, nworkers)
+        for field, column in [('mass', gas[0]), ('temp', gas[4])]:
+            weights = column.astype(np.float32)[inside]
+            true = np.histogram2d(pos[inside, 0], pos[inside, 1], bins=16, range=[[-1.5, 1.5], [-1.0, 1.0]], weights=weights)[0]
+            check(grid[field], true, name + '.' + field)
+        check(grid['rho'], 0.0, name + '.missing')
+
+def run_cache_test(filename):
+    """Cached entries are keyed on the source and parameters, loaded lazily, and evicted oldest first"""
+    import cache
+    import os
+    import tempfile
+    filename += '.source'
+    with open(filename, 'wb') as f:
+        f.write(b'source')
+    with tempfile.TemporaryDirectory() as tmp:
+        c = cache.cache(tmp)
+        grid = np.arange(12.0).reshape(3, 4)
+        c.put(filename, {'nbins': 3}, {'grid': grid, 'time': 0.5, 'gas': None})
+        e = c.get(filename, {'nbins': 3})
+        check(isinstance(e.grid, np.memmap), True, 'cache.memmap')
+        check(e.grid, grid, 'cache.grid')
+        check(e.time, 0.5, 'cache.time')
+        check(e.gas is None, True, 'cache.none')
+        check(c.get(filename, {'nbins': 4}) is None, True, 'cache.params')
+        
+        # Entries are pickled without their arrays, which are mapped again when used
+        import pickle
+        e = pickle.loads(pickle.dumps(e))
+        check(e.grid, grid, 'cache.pickle')
+        
+        # A modified source misses the cache
+        st = os.stat(filename)
+        os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        check(c.get(filename, {'nbins': 3}) is None, True, 'cache.source')
+        
+        c.put(filename, {'nbins': 1}, {'grid': grid})
+        c.put(filename, {'nbins': 2}, {'grid': grid})
+        os.utime(os.path.join(tmp, c.key(filename, {'nbins': 1}), 'meta.json'), (0, 0))
+        c.max_bytes = c.size() - 1
+        c.evict()
+        check(c.get(filename, {'nbins': 1}) is None, True, 'cache.evicted')
+        check(c.get(filename, {'nbins': 2}).grid, grid, 'cache.kept')
+    os.unlink(filename)
+
+def run_constants_test():
+    """The unit constants match astropy, which isn't imported by tipsy, gadget, or ChaNGa"""
+    import constants
+    import subprocess
+    import sys
+    from os import path
+    code = 'import sys, tipsy, gadget, ChaNGa; print(*[m for m in ["astropy", "h5py"] if m in sys.modules])'
+    loaded = subprocess.run([sys.executable, '-c', code], cwd=path.dirname(path.abspath(__file__)), check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True).stdout.split()
+    if loaded:
+        raise ValueError('importing tipsy, gadget, and ChaNGa imports ' + ', '.join(loaded))
+    
+    import astropy.constants as apc
+    import astropy.units as apu
+    for name, true in [('k_B', apc.k_B.cgs.value), ('m_p', apc.m_p.cgs.value), ('G', apc.G.cgs.value),
+                       ('M_sun', apc.M_sun.cgs.value), ('kpc', apu.kpc.to(apu.cm)), ('km', apu.km.to(apu.cm))]:
+        check(getattr(constants, name) / true, 1.0, 'constants.' + name)
+
+def run_temperature_test(size):
+    """Gas temperatures are bit-for-bit those of the original, unblocked formula"""
+    import astropy.constants as apc
+    import astropy.units as apu
+    import gadget
+    
+    def original(gas, params):
+        if params is not None:
+            length = float(params['UnitLength_in_cm']) * apu.cm
+            mass = float(params['UnitMass_in_g']) * apu.g
+            velocity = float(params['UnitVelocity_in_cm_per_s']) * apu.cm / apu.s
+        else:
+            length, mass, velocity = (1.0 * apu.kpc).to(apu.cm), (1e10 * apu.Msun).to(apu.g), 1.0 * apu.km / apu.s
+        time = length / velocity
+        p = float(mass / length / time ** 2.0 / (apu.g / (apu.cm * apu.s ** 2.0)))
+        d = float(mass / length ** 3.0 / (apu.g / apu.cm ** 3.0))
+        mean_weight = 4.0 / (1.0 + 3.0 * 0.76)
+        if params is not None and float(params['InitGasTemp']) >= 1e4:
+            mean_weight = 4.0 / (8.0 - 5.0 * (1.0 - 0.76))
+        if gas.metals is not None:
+            X = gas.metals / gas.mass
+            mask = X > 0.0
+            Y = np.zeros(X.shape)
+            Y[mask] = (1.0 - X[mask]) / (4.0 * X[mask])
+            mean_weight = (1.0 + 4.0 * Y) / (1.0 + Y + gas.electron_density)
+        temp = ((5.0 / 3.0) - 1.0) / apc.k_B.cgs.value * (gas.internal_energy * p / d) * apc.m_p.cgs.value * mean_weight
+        if params is not None:
+            temp[temp < float(params['MinGasTemp'])] = float(params['MinGasTemp'])
+        return temp
+    
+    class gas():
+        mass = np.random.rand(size).astype(np.float32) + 0.5
+        internal_energy = np.random.rand(size).astype(np.float32) * 1000.0
+    params = {'UnitLength_in_cm': 3.085678e21, 'UnitMass_in_g': 1.989e43, 'UnitVelocity_in_cm_per_s': 1e5,
+              'InitGasTemp': 1e4, 'MinGasTemp': 20.0}
+    block = gadget._temperature_block
+    gadget._temperature_block = size // 3
+    try:
+        for metals in [False, True]:
+            gas.metals = (np.random.rand(size) * 0.02 * (np.arange(size) % 5 > 0)).astype(np.float32) if metals else None
+            gas.electron_density = np.random.rand(size).astype(np.float32) if metals else None
+            for p in [None, params]:
+                name = 'temperature(metals={0}, units={1})'.format(metals, p is not None)
+                check(bool(np.array_equal(gadget.convert_U_to_temperature(gas, p), original(gas, p))), True, name)
+    finally:
+        gadget._temperature_block = block
+
+def run_gadget_fields_test(filename, size):
+    """Snapshot chunks hold only the requested fields, whether read here or by workers"""
+    import gadget
+    import h5py
+    from os import unlink
+    filename += '.hdf5'
+    numpart = np.array([size, 0, 0, 0, 0, 0], dtype=np.uint32)
+    pos = np.random.rand(size, 3).astype(np.float32)
+    with h5py.File(filename, 'w') as f:
+        hdr = f.create_group('Header')
+        for name, value in [('NumPart_ThisFile', numpart), ('NumPart_Total', numpart),
+                            ('NumPart_Total_HighWord', np.zeros(6, dtype=np.uint32)), ('MassTable', np.zeros(6))]:
+            hdr.attrs[name] = value
+        for name in ['Time', 'Redshift', 'BoxSize', 'Omega0', 'OmegaLambda', 'HubbleParam']:
+            hdr.attrs[name] = 0.0
+        for name in ['NumFilesPerSnapshot', 'Flag_Sfr', 'Flag_Cooling', 'Flag_StellarAge', 'Flag_Metals',
+                     'Flag_Feedback', 'Flag_DoublePrecision']:
+            hdr.attrs[name] = 1 if name == 'NumFilesPerSnapshot' else 0
+        gas = f.create_group('PartType0')
+        gas['Coordinates'] = pos
+        gas['Masses'] = np.ones(size, dtype=np.float32)
+        gas['InternalEnergy'] = np.ones(size, dtype=np.float32)
+    for nworkers in [1, 2]:
+        name = 'gadget.fields(nworkers={0:d})'.format(nworkers)
+        with gadget.Snapshot(filename, nworkers, fields=['pos', 'mass']) as snap:
+            chunks = list(snap.chunks('gas', size // 3))
+        check(np.concatenate([c.pos for c in chunks]), pos, name + '.pos')
+        try:
+            chunks[0].internal_energy
+        except KeyError as e:
+            check('internal_energy' in str(e), True, name + '.message')
+        else:
+            raise ValueError(name + ' returned a field that was not requested')
+    unlink(filename)
+
+def run_concurrent_test(filename, nfiles, size):
+    """Several readers and writers must be usable at once, including from different threads"""
+    from concurrent.futures import ThreadPoolExecutor
+    names = ['{0:s}.{1:d}'.format(filename, i) for i in range(nfiles)]
+    data = [generate_data(size, 5) for _ in names]
+    
+    def write(i):
+        with tipsy.streaming_writer(names[i], is_xdr=(i % 2 == 0)) as f:
+            f.header(float(i), 0, size, 0)
+            f.darkmatter(*data[i], size)
+    
+    def read(i):
+        with tipsy.File(names[i], is_xdr=(i % 2 == 0)) as f:
+            return f.header.time, f.darkmatter.pos
+    
+    try:
+        with ThreadPoolExecutor(max_workers=nfiles) as pool:
+            list(pool.map(write, range(nfiles)))
+            for i, (time, pos) in enumerate(pool.map(read, range(nfiles))):
+                check(time, float(i), 'concurrent({0:d}).time'.format(i))
+                check(pos, data[i][1], 'concurrent({0:d}).pos'.format(i))
+        
+        # Interleaved access from two open files
+        with tipsy.File(names[0]) as a, tipsy.File(names[2]) as b:
+            check(a.darkmatter.mass, data[0][0], 'interleaved(0).mass')
+            check(b.darkmatter.mass, data[2][0], 'interleaved(2).mass')
+    finally:
+        from os import unlink
+        for n in names:
+            unlink(n)
 #----------------------------------------------------------------------------------------
 
 filename = 'test.tipsy'
@@ -89,6 +584,29 @@ for i in range(0, 201):
     else:
         print('Passed')
 
+try:
+    # Span several blocks of the block codec
+    run_codec_test(filename, 20000, 17001, 9)
+    run_concurrent_test(filename, 8, 10000)
+    run_buffer_test(filename, 10000)
+    run_header_test(filename, 1000)
+    run_range_test(filename, 1000)
+    run_count_test(filename, 100)
+    run_module_test(filename, 100)
+    run_index_test(filename, 2000)
+    run_binning_test(filename, 1000)
+    run_cache_test(filename)
+    run_constants_test()
+    run_temperature_test(1000)
+    run_gadget_fields_test(filename, 1000)
+    run_aux_test(filename, 1000)
+except ValueError as err:
+    print('codec/concurrency test failed')
+    import traceback
+    traceback.print_exc()
+else:
+    print('Passed')
+
 from os import unlink
 unlink(filename)
 
@@ -1,26 +1,35 @@
-import ctypes
+import _tipsy
 import tipsy_c
-import numpy.ctypeslib as npct
+import tipsy_index
+
+# The XDR codecs. 'block' byte-swaps whole blocks of particles and is the
+# default. 'reference' uses one XDR call per field and is kept for checking
+# that the two produce identical files.
+codecs = {'block': 0, 'reference': 1}
 
 class File():
     """A read-only Tipsy XDR (aka 'standard') file."""
-    def __init__(self, filename):
-        self.lib = _load_tipsy()
-
-        # fopen in tipsy_py_init_xdr fails without this here
-        print()
-        cfname = ctypes.c_char_p(bytes(filename, 'utf-8'))
-        self.lib.tipsy_py_init_reader_xdr(cfname)
+    def __init__(self, filename, codec='block', block_size=None, nthreads=1):
+        codec = _get_codec(codec)
+        self.stream = _tipsy.stream(filename, 'rb', False, True)
+        # Streams start with the block codec and one thread; skip the calls for those
+        if codec != codecs['block']:
+            self.stream.set_codec(codec)
+        if block_size is not None:
+            self.stream.set_block_size(block_size)
+        if nthreads != 1:
+            self.stream.set_threads(nthreads)
         
-        self.hdr = tipsy_c.header()
-        self.lib.tipsy_py_read_header_xdr(ctypes.byref(self.hdr.c_data))
+        self.hdr = tipsy_c.header(*self.stream.read_header())
+        self.filename = filename
         
         self.dark_particles = None
         self.star_particles = None
         self.gas_particles = None
+        self._index = None
 
     def close(self):
-        self.lib.tipsy_py_destroy_xdr()
+        self.stream.close()
 
     def __enter__(self):
         return self
@@ -33,27 +42,52 @@ class File():
     def header(self):
         return self.hdr
 
+    @property
+    def index(self):
+        """The spatial index written by tipsy_index.sort"""
+        if self._index is None:
+            self._index = tipsy_index.index(self.filename, self.hdr)
+        return self._index
+
+    def box(self, family, lo, hi):
+        """The particles of `family` ('gas', 'darkmatter', or 'stars') in the box [lo, hi], read using the spatial index"""
+        return tipsy_index.box(self, family, lo, hi)
+
+    def sphere(self, family, center, radius):
+        """The particles of `family` within `radius` of `center`, read using the spatial index"""
+        return tipsy_index.sphere(self, family, center, radius)
+
     @property
     def gas(self):
         if self.hdr.ngas == 0:
             return None
         
         if self.gas_particles is None:
-            self.gas_particles = tipsy_c.gas_data.from_size(self.hdr.ngas)
-            self.lib.tipsy_py_read_gas_xdr(ctypes.byref(self.hdr.c_data),
-                                           ctypes.byref(self.gas_particles.c_data))
+            self.gas_particles = tipsy_c.family(self.hdr.ngas, self.read_gas)
         return self.gas_particles
+    
+    def read_gas(self, start=None, stop=None):
+        """Read the gas particles [start, stop), with Python's slicing rules"""
+        start, stop = tipsy_c._range(start, stop, self.hdr.ngas)
+        data = tipsy_c.gas_data.from_size(stop - start)
+        self.stream.read_gas(start, data.size, *data.columns())
+        return data
 
     @property
     def darkmatter(self):
         if self.hdr.ndark == 0:
             return None
-
+        
         if self.dark_particles is None:
-            self.dark_particles = tipsy_c.dark_data.from_size(self.hdr.ndark)
-            self.lib.tipsy_py_read_dark_xdr(ctypes.byref(self.hdr.c_data),
-                                            ctypes.byref(self.dark_particles.c_data))
+            self.dark_particles = tipsy_c.family(self.hdr.ndark, self.read_darkmatter)
         return self.dark_particles
+    
+    def read_darkmatter(self, start=None, stop=None):
+        """Read the dark matter particles [start, stop)"""
+        start, stop = tipsy_c._range(start, stop, self.hdr.ndark)
+        data = tipsy_c.dark_data.from_size(stop - start)
+        self.stream.read_dark(start, data.size, *data.columns())
+        return data
 
     @property
     def stars(self):
@@ -61,40 +95,56 @@ class File():
             return None
         
         if self.star_particles is None:
-            self.star_particles = tipsy_c.star_data.from_size(self.hdr.nstar)
-            self.lib.tipsy_py_read_star_xdr(ctypes.byref(self.hdr.c_data),
-                                            ctypes.byref(self.star_particles.c_data))
+            self.star_particles = tipsy_c.family(self.hdr.nstar, self.read_stars)
         return self.star_particles
     
+    def read_stars(self, start=None, stop=None):
+        """Read the star particles [start, stop)"""
+        start, stop = tipsy_c._range(start, stop, self.hdr.nstar)
+        data = tipsy_c.star_data.from_size(stop - start)
+        self.stream.read_star(start, data.size, *data.columns())
+        return data
+    
 class streaming_writer():
     """A write-only Tipsy XDR (aka 'standard') file."""
-    def __init__(self, filename, mode):
-        self.lib = _load_tipsy()
-
-        # fopen in tipsy_py_init_xdr fails without this here
-        print()
-        cfname = ctypes.c_char_p(bytes(filename, 'utf-8'))
-        cmode = ctypes.c_char_p(bytes(mode, 'utf-8'))
-        self.lib.tipsy_py_init_writer_xdr(cfname, cmode)
+    def __init__(self, filename, mode, codec='block', block_size=None, nthreads=1):
+        codec = _get_codec(codec)
+        self.stream = _tipsy.stream(filename, mode, True, True)
+        # Streams start with the block codec and one thread; skip the calls for those
+        if codec != codecs['block']:
+            self.stream.set_codec(codec)
+        if block_size is not None:
+            self.stream.set_block_size(block_size)
+        if nthreads != 1:
+            self.stream.set_threads(nthreads)
     
-    def header(self, time, ngas, ndark, nstars):
-        tmp = tipsy_c.header.from_external(time, ngas, ndark, nstars)
-        self.lib.tipsy_py_write_header_xdr(ctypes.byref(tmp.c_data))
+    def header(self, time, ngas=0, ndark=0, nstars=0):
+        """Write the header. Counts that differ from the particles written are corrected on close."""
+        self.stream.write_header(*tipsy_c.header.from_external(time, ngas, ndark, nstars).astuple())
 
     def gas(self, mass, pos, vel, rho, temp, hsmooth, metals, phi, size):
         tmp = tipsy_c.gas_data.from_external(mass, pos, vel, rho, temp, hsmooth, metals, phi, size)
-        self.lib.tipsy_py_write_gas_xdr(ctypes.byref(tmp.c_data))
+        self.stream.write_gas(size, *tmp.columns())
 
     def darkmatter(self, mass, pos, vel, soft, phi, size):
         tmp = tipsy_c.dark_data.from_external(mass, pos, vel, soft, phi, size)
-        self.lib.tipsy_py_write_dark_xdr(ctypes.byref(tmp.c_data))
+        self.stream.write_dark(size, *tmp.columns())
     
     def stars(self, mass, pos, vel, metals, tform, soft, phi, size):
         tmp = tipsy_c.star_data.from_external(mass, pos, vel, metals, tform, soft, phi, size)
-        self.lib.tipsy_py_write_star_xdr(ctypes.byref(tmp.c_data))
+        self.stream.write_star(size, *tmp.columns())
 
     def close(self):
-        self.lib.tipsy_py_destroy_xdr()
+        if self.stream:
+            try:
+                self.stream.finish()
+            finally:
+                self.stream.close()
+                self.stream = None
+
+    def __del__(self):
+        if getattr(self, 'stream', None):
+            self.close()
 
     def __enter__(self):
         return self
@@ -103,58 +153,7 @@ class streaming_writer():
         self.close()
         return False  # always re-raise exceptions
 
-def _load_tipsy():
-    """Load the tipsy module. For internal use only """
-    if _load_tipsy.lib is not None:
-        return _load_tipsy.lib
-    
-    lib = npct.load_library("libtipsy", "")
-    
-    def decode_err(err):
-        if int(err) != 0:
-            raise IOError(lib.tipsy_strerror(err).decode('utf-8'))
-    
-    # Force parameter type-checking and return-value error checking
-    lib.tipsy_strerror.restype = ctypes.c_char_p
-    lib.tipsy_strerror.argtypes = [ctypes.c_int]
-    
-    lib.tipsy_py_init_reader_xdr.restype = decode_err
-    lib.tipsy_py_init_reader_xdr.argtypes = [ctypes.c_char_p]
-    
-    lib.tipsy_py_init_writer_xdr.restype = decode_err
-    lib.tipsy_py_init_writer_xdr.argtypes = [ctypes.c_char_p, ctypes.c_char_p]
-    
-    lib.tipsy_py_destroy_xdr.restype = None
-    lib.tipsy_py_destroy_xdr.argtypes = []
-    
-    lib.tipsy_py_read_header_xdr.restype = decode_err
-    lib.tipsy_py_read_header_xdr.argtypes = [ctypes.POINTER(tipsy_c.header.struct)]
-
-    lib.tipsy_py_read_gas_xdr.restype = decode_err
-    lib.tipsy_py_read_gas_xdr.argtypes = [ctypes.POINTER(tipsy_c.header.struct),
-                                          ctypes.POINTER(tipsy_c.gas_data.struct)]
-
-    lib.tipsy_py_read_dark_xdr.restype = decode_err
-    lib.tipsy_py_read_dark_xdr.argtypes = [ctypes.POINTER(tipsy_c.header.struct),
-                                           ctypes.POINTER(tipsy_c.dark_data.struct)]
-             
-    lib.tipsy_py_read_star_xdr.restype = decode_err
-    lib.tipsy_py_read_star_xdr.argtypes = [ctypes.POINTER(tipsy_c.header.struct),
-                                           ctypes.POINTER(tipsy_c.star_data.struct)]
-
-    lib.tipsy_py_write_header_xdr.restype = decode_err
-    lib.tipsy_py_write_header_xdr.argtypes = [ctypes.POINTER(tipsy_c.header.struct)]
-
-    lib.tipsy_py_write_gas_xdr.restype = decode_err
-    lib.tipsy_py_write_gas_xdr.argtypes = [ctypes.POINTER(tipsy_c.gas_data.struct)]
-
-    lib.tipsy_py_write_dark_xdr.restype = decode_err
-    lib.tipsy_py_write_dark_xdr.argtypes = [ctypes.POINTER(tipsy_c.dark_data.struct)]
-    
-    lib.tipsy_py_write_star_xdr.restype = decode_err
-    lib.tipsy_py_write_star_xdr.argtypes = [ctypes.POINTER(tipsy_c.star_data.struct)]
-     
-    _load_tipsy.lib = lib
-    return lib
-_load_tipsy.lib = None
-
+def _get_codec(name):
+    if name not in codecs:
+        raise ValueError("Unknown XDR codec '{0:s}'. Must be one of {1:s}".format(str(name), str(list(codecs.keys()))))
+    return codecs[name]
@@ -0,0 +1,319 @@
+#include "tipsyio_block.h"
+#include "tipsyio_err.h"
+#include <errno.h>
+#include <pthread.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+
+/*
+ * For XDR, the byte swap is done over the whole buffer at once so that the compiler
+ * can vectorize it, and the (un)packing of the particle columns is done separately.
+ * The bytes on disk are identical to those produced by the XDR reference codec.
+ */
+inline static uint32_t bswap32(uint32_t x) {
+#if defined(__GNUC__)
+	return __builtin_bswap32(x);
+#else
+	return ((x & 0x000000FFu) << 24) | ((x & 0x0000FF00u) << 8) | ((x & 0x00FF0000u) >> 8) |
+	       ((x & 0xFF000000u) >> 24);
+#endif
+}
+
+/* Convert between host and XDR byte order. This is its own inverse. */
+inline static void swap_block(float* buf, size_t n) {
+#if defined(__BYTE_ORDER__) && __BYTE_ORDER__ == __ORDER_BIG_ENDIAN__
+	(void)buf;
+	(void)n;
+#else
+	for (size_t i = 0; i < n; ++i) {
+		uint32_t u;
+		memcpy(&u, &buf[i], sizeof(u));
+		u = bswap32(u);
+		memcpy(&buf[i], &u, sizeof(u));
+	}
+#endif
+}
+
+/* Copy a column of 'n' particles between the SoA data and a buffer of records 'stride' floats wide */
+inline static void unpack_scalar(float* restrict dst, float const* restrict buf, size_t stride, size_t n) {
+	for (size_t i = 0; i < n; ++i) { dst[i] = buf[i * stride]; }
+}
+inline static void unpack_vector(float (*restrict dst)[3], float const* restrict buf, size_t stride, size_t n) {
+	for (size_t i = 0; i < n; ++i) {
+		dst[i][0] = buf[i * stride + 0];
+		dst[i][1] = buf[i * stride + 1];
+		dst[i][2] = buf[i * stride + 2];
+	}
+}
+inline static void pack_scalar(float* restrict buf, float const* restrict src, size_t stride, size_t n) {
+	for (size_t i = 0; i < n; ++i) { buf[i * stride] = src[i]; }
+}
+/* Like pack_{scalar,vector}, but a NULL 'src' broadcasts 'value' to every record */
+inline static void pack_scalar_or(float* buf, float const* src, float value, size_t first, size_t stride, size_t n) {
+	if (src) {
+		pack_scalar(buf, src + first, stride, n);
+		return;
+	}
+	for (size_t i = 0; i < n; ++i) { buf[i * stride] = value; }
+}
+inline static void pack_vector(float* restrict buf, float const (*restrict src)[3], size_t stride, size_t n) {
+	for (size_t i = 0; i < n; ++i) {
+		buf[i * stride + 0] = src[i][0];
+		buf[i * stride + 1] = src[i][1];
+		buf[i * stride + 2] = src[i][2];
+	}
+}
+inline static void pack_vector_or(float* buf, float (*src)[3], float const value[3], size_t first, size_t stride,
+				  size_t n) {
+	if (src) {
+		pack_vector(buf, (float const(*)[3])(src + first), stride, n);
+		return;
+	}
+	for (size_t i = 0; i < n; ++i) {
+		buf[i * stride + 0] = value[0];
+		buf[i * stride + 1] = value[1];
+		buf[i * stride + 2] = value[2];
+	}
+}
+
+/*
+ * Move 'size' records of 'record_size' bytes between 'fd' and 'data', 'block_records' at a time
+ *
+ * 'fn' unpacks (read) or packs (write) the particles [first, first+n) from or to the buffer.
+ * If 'swap' is set, the records are converted between host and XDR byte order. A short read
+ * or write returns 'err'.
+ */
+int tipsy_block_io(FILE* fd, void* data, size_t size, size_t record_size, size_t block_records, tipsy_block_fn fn,
+		   tipsy_block_op op, int swap, int err) {
+	const size_t nwords   = record_size / sizeof(float);
+	const size_t nrecords = (size < block_records) ? size : block_records;
+	if (size == 0) { return 0; }
+
+	float* buf = malloc(nrecords * record_size);
+	if (!buf) { return TIPSY_BAD_ALLOC; }
+
+	int status = 0;
+	for (size_t first = 0; first < size; first += nrecords) {
+		const size_t n = (size - first < nrecords) ? size - first : nrecords;
+		if (op == TIPSY_BLOCK_UNPACK) {
+			if (fread(buf, record_size, n, fd) != n) {
+				status = err;
+				break;
+			}
+			if (swap) { swap_block(buf, n * nwords); }
+			fn(buf, data, first, n, op);
+		} else {
+			fn(buf, data, first, n, op);
+			if (swap) { swap_block(buf, n * nwords); }
+			if (fwrite(buf, record_size, n, fd) != n) {
+				status = err;
+				break;
+			}
+		}
+	}
+	free(buf);
+	return status;
+}
+
+/*
+ * Parallel block I/O
+ *
+ * Records have a fixed size, so the offset of every particle in the file is known. The
+ * particles are split into contiguous ranges and each range is moved by its own thread
+ * with positional I/O on the underlying descriptor, so the threads never share a file
+ * position or a buffer.
+ */
+typedef struct {
+	pthread_t      thread;
+	int            started; /* on its own thread */
+	int            fd;
+	off_t          offset; /* of particle 'first' in the file */
+	void*          data;
+	size_t         first;
+	size_t         size;
+	size_t         record_size;
+	size_t         block_records;
+	tipsy_block_fn fn;
+	tipsy_block_op op;
+	int            swap;
+	int            err;
+	int            status;
+} __range;
+
+/* Read or write all 'n' bytes at 'offset', resuming after short transfers */
+static int __pio(int fd, char* buf, size_t n, off_t offset, tipsy_block_op op) {
+	while (n > 0) {
+		const ssize_t k = (op == TIPSY_BLOCK_UNPACK) ? pread(fd, buf, n, offset) : pwrite(fd, buf, n, offset);
+		if (k < 0 && errno == EINTR) { continue; }
+		if (k <= 0) { return -1; }
+		buf += k;
+		n -= (size_t)k;
+		offset += k;
+	}
+	return 0;
+}
+
+static void* __range_io(void* arg) {
+	__range*     r        = arg;
+	const size_t nwords   = r->record_size / sizeof(float);
+	const size_t nrecords = (r->size < r->block_records) ? r->size : r->block_records;
+
+	float* buf = malloc(nrecords * r->record_size);
+	if (!buf) {
+		r->status = TIPSY_BAD_ALLOC;
+		return NULL;
+	}
+
+	r->status = 0;
+	for (size_t i = 0; i < r->size; i += nrecords) {
+		const size_t n      = (r->size - i < nrecords) ? r->size - i : nrecords;
+		const off_t  offset = r->offset + (off_t)(i * r->record_size);
+		if (r->op == TIPSY_BLOCK_UNPACK) {
+			if (__pio(r->fd, (char*)buf, n * r->record_size, offset, r->op) != 0) {
+				r->status = r->err;
+				break;
+			}
+			if (r->swap) { swap_block(buf, n * nwords); }
+			r->fn(buf, r->data, r->first + i, n, r->op);
+		} else {
+			r->fn(buf, r->data, r->first + i, n, r->op);
+			if (r->swap) { swap_block(buf, n * nwords); }
+			if (__pio(r->fd, (char*)buf, n * r->record_size, offset, r->op) != 0) {
+				r->status = r->err;
+				break;
+			}
+		}
+	}
+	free(buf);
+	return NULL;
+}
+
+/*
+ * Like tipsy_block_io, but using up to 'nthreads' threads
+ *
+ * The records start at the current position of 'fd', which is left just past them. Files
+ * without a position (e.g., pipes) and families smaller than a block per thread are moved
+ * by tipsy_block_io.
+ */
+int tipsy_block_pio(FILE* fd, void* data, size_t size, size_t record_size, size_t block_records, int nthreads,
+		    tipsy_block_fn fn, tipsy_block_op op, int swap, int err) {
+	const size_t nblocks = (size + block_records - 1) / block_records;
+	size_t       nranges = (nthreads > 0 && (size_t)nthreads < nblocks) ? (size_t)nthreads : nblocks;
+	if (nranges <= 1) { return tipsy_block_io(fd, data, size, record_size, block_records, fn, op, swap, err); }
+
+	// Pending writes must reach the descriptor before the threads write after them
+	if (op == TIPSY_BLOCK_PACK && fflush(fd) != 0) { return errno; }
+	const off_t start = ftello(fd);
+	if (start < 0) { return tipsy_block_io(fd, data, size, record_size, block_records, fn, op, swap, err); }
+
+	const size_t per_range = (size + nranges - 1) / nranges;
+	nranges                = (size + per_range - 1) / per_range;
+
+	__range* ranges = calloc(nranges, sizeof(__range));
+	if (!ranges) { return TIPSY_BAD_ALLOC; }
+
+	for (size_t k = 0; k < nranges; ++k) {
+		__range* r       = &ranges[k];
+		r->fd            = fileno(fd);
+		r->first         = k * per_range;
+		r->size          = (size - r->first < per_range) ? size - r->first : per_range;
+		r->offset        = start + (off_t)(r->first * record_size);
+		r->data          = data;
+		r->record_size   = record_size;
+		r->block_records = block_records;
+		r->fn            = fn;
+		r->op            = op;
+		r->swap          = swap;
+		r->err           = err;
+	}
+
+	// The calling thread moves the first range itself
+	for (size_t k = 1; k < nranges; ++k) {
+		ranges[k].started = pthread_create(&ranges[k].thread, NULL, __range_io, &ranges[k]) == 0;
+	}
+	__range_io(&ranges[0]);
+
+	int status = ranges[0].status;
+	for (size_t k = 1; k < nranges; ++k) {
+		if (ranges[k].started) {
+			pthread_join(ranges[k].thread, NULL);
+		} else {
+			__range_io(&ranges[k]);
+		}
+		if (status == 0) { status = ranges[k].status; }
+	}
+	free(ranges);
+
+	if (fseeko(fd, start + (off_t)(size * record_size), SEEK_SET) != 0 && status == 0) { status = errno; }
+	return status;
+}
+
+/*
+ * The (un)packing kernels between the SoA data and a buffer of 'n' records laid out as in the file.
+ * Every field is a float, so a record is 'stride' floats wide.
+ */
+void tipsy_gas_block(float* buf, void* data, size_t first, size_t n, tipsy_block_op op) {
+	tipsy_gas_data* d      = data;
+	const size_t    stride = sizeof(tipsy_gas_particle) / sizeof(float);
+	if (op == TIPSY_BLOCK_UNPACK) {
+		unpack_scalar(d->mass + first, buf + 0, stride, n);
+		unpack_vector(d->pos + first, buf + 1, stride, n);
+		unpack_vector(d->vel + first, buf + 4, stride, n);
+		unpack_scalar(d->rho + first, buf + 7, stride, n);
+		unpack_scalar(d->temp + first, buf + 8, stride, n);
+		unpack_scalar(d->hsmooth + first, buf + 9, stride, n);
+		unpack_scalar(d->metals + first, buf + 10, stride, n);
+		unpack_scalar(d->phi + first, buf + 11, stride, n);
+	} else {
+		pack_scalar_or(buf + 0, d->mass, d->constant.mass, first, stride, n);
+		pack_vector_or(buf + 1, d->pos, d->constant.pos, first, stride, n);
+		pack_vector_or(buf + 4, d->vel, d->constant.vel, first, stride, n);
+		pack_scalar_or(buf + 7, d->rho, d->constant.rho, first, stride, n);
+		pack_scalar_or(buf + 8, d->temp, d->constant.temp, first, stride, n);
+		pack_scalar_or(buf + 9, d->hsmooth, d->constant.hsmooth, first, stride, n);
+		pack_scalar_or(buf + 10, d->metals, d->constant.metals, first, stride, n);
+		pack_scalar_or(buf + 11, d->phi, d->constant.phi, first, stride, n);
+	}
+}
+
+void tipsy_dark_block(float* buf, void* data, size_t first, size_t n, tipsy_block_op op) {
+	tipsy_dark_data* d      = data;
+	const size_t     stride = sizeof(tipsy_dark_particle) / sizeof(float);
+	if (op == TIPSY_BLOCK_UNPACK) {
+		unpack_scalar(d->mass + first, buf + 0, stride, n);
+		unpack_vector(d->pos + first, buf + 1, stride, n);
+		unpack_vector(d->vel + first, buf + 4, stride, n);
+		unpack_scalar(d->soft + first, buf + 7, stride, n);
+		unpack_scalar(d->phi + first, buf + 8, stride, n);
+	} else {
+		pack_scalar_or(buf + 0, d->mass, d->constant.mass, first, stride, n);
+		pack_vector_or(buf + 1, d->pos, d->constant.pos, first, stride, n);
+		pack_vector_or(buf + 4, d->vel, d->constant.vel, first, stride, n);
+		pack_scalar_or(buf + 7, d->soft, d->constant.softening, first, stride, n);
+		pack_scalar_or(buf + 8, d->phi, d->constant.phi, first, stride, n);
+	}
+}
+
+void tipsy_star_block(float* buf, void* data, size_t first, size_t n, tipsy_block_op op) {
+	tipsy_star_data* d      = data;
+	const size_t     stride = sizeof(tipsy_star_particle) / sizeof(float);
+	if (op == TIPSY_BLOCK_UNPACK) {
+		unpack_scalar(d->mass + first, buf + 0, stride, n);
+		unpack_vector(d->pos + first, buf + 1, stride, n);
+		unpack_vector(d->vel + first, buf + 4, stride, n);
+		unpack_scalar(d->metals + first, buf + 7, stride, n);
+		unpack_scalar(d->tform + first, buf + 8, stride, n);
+		unpack_scalar(d->soft + first, buf + 9, stride, n);
+		unpack_scalar(d->phi + first, buf + 10, stride, n);
+	} else {
+		pack_scalar_or(buf + 0, d->mass, d->constant.mass, first, stride, n);
+		pack_vector_or(buf + 1, d->pos, d->constant.pos, first, stride, n);
+		pack_vector_or(buf + 4, d->vel, d->constant.vel, first, stride, n);
+		pack_scalar_or(buf + 7, d->metals, d->constant.metals, first, stride, n);
+		pack_scalar_or(buf + 8, d->tform, d->constant.tform, first, stride, n);
+		pack_scalar_or(buf + 9, d->soft, d->constant.softening, first, stride, n);
+		pack_scalar_or(buf + 10, d->phi, d->constant.phi, first, stride, n);
+	}
+}
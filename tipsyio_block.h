@@ -0,0 +1,35 @@
+#pragma once
+
+#include "tipsy.h"
+#include <stdio.h>
+
+/*
+ * Block I/O shared by the XDR and native streams
+ *
+ * Particles are moved between the file and a buffer of records in blocks, one fread/fwrite
+ * per block, and transposed between the records (AoS) and the particle columns (SoA) in
+ * memory. XDR and native records have the same layout; only their byte order differs.
+ */
+
+typedef enum { TIPSY_BLOCK_UNPACK, TIPSY_BLOCK_PACK } tipsy_block_op;
+
+/* Default number of particles moved per fread/fwrite */
+enum { TIPSY_BLOCK_RECORDS = 8192 };
+
+/* Transpose the particles [first, first+n) between the SoA data and a buffer of 'n' records */
+typedef void (*tipsy_block_fn)(float*, void*, size_t, size_t, tipsy_block_op);
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+void tipsy_gas_block(float*, void*, size_t, size_t, tipsy_block_op);
+void tipsy_dark_block(float*, void*, size_t, size_t, tipsy_block_op);
+void tipsy_star_block(float*, void*, size_t, size_t, tipsy_block_op);
+
+int tipsy_block_io(FILE*, void*, size_t, size_t, size_t, tipsy_block_fn, tipsy_block_op, int, int);
+int tipsy_block_pio(FILE*, void*, size_t, size_t, size_t, int, tipsy_block_fn, tipsy_block_op, int, int);
+
+#ifdef __cplusplus
+}
+#endif
@@ -15,6 +15,22 @@ char const* tipsy_strerror(tipsy_error_t err) {
 		return "XDR write failed";
 	case TIPSY_BAD_NATIVE_DIR:
 		return "Invalid native direction flag";
+	case TIPSY_BAD_XDR_CODEC:
+		return "Invalid XDR codec";
+	case TIPSY_BAD_ALLOC:
+		return "Unable to allocate I/O buffer";
+	case TIPSY_BAD_NATIVE_READ:
+		return "Native read failed";
+	case TIPSY_BAD_NATIVE_WRITE:
+		return "Native write failed";
+	case TIPSY_BAD_BLOCK_SIZE:
+		return "Invalid I/O block size";
+	case TIPSY_BAD_THREAD_COUNT:
+		return "Invalid number of I/O threads";
+	case TIPSY_BAD_RANGE:
+		return "Particle range outside of the family";
+	case TIPSY_BAD_COUNT:
+		return "Particle count too large for a Tipsy header";
 	default:
 		// It's a system error
 		return strerror((int)err);
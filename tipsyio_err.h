@@ -5,12 +5,20 @@ extern "C" {
 #endif
 
 typedef enum {
-	TIPSY_READ_UNOPENED  = 0x10001, /* Read from unopened file */
-	TIPSY_WRITE_UNOPENED = 0x10002, /* Write to unopened file */
-	TIPSY_BAD_XDR_DIR    = 0x10003, /* Invalid XDR direction flag */
-	TIPSY_BAD_XDR_READ   = 0x10004, /* Bad read on XDR stream */
-	TIPSY_BAD_XDR_WRITE  = 0x10005, /* Bad write on XDR stream */
-	TIPSY_BAD_NATIVE_DIR = 0x10006  /* Invalid native direction flag */
+	TIPSY_READ_UNOPENED    = 0x10001, /* Read from unopened file */
+	TIPSY_WRITE_UNOPENED   = 0x10002, /* Write to unopened file */
+	TIPSY_BAD_XDR_DIR      = 0x10003, /* Invalid XDR direction flag */
+	TIPSY_BAD_XDR_READ     = 0x10004, /* Bad read on XDR stream */
+	TIPSY_BAD_XDR_WRITE    = 0x10005, /* Bad write on XDR stream */
+	TIPSY_BAD_NATIVE_DIR   = 0x10006, /* Invalid native direction flag */
+	TIPSY_BAD_XDR_CODEC    = 0x10007, /* Invalid XDR codec */
+	TIPSY_BAD_ALLOC        = 0x10008, /* Unable to allocate I/O buffer */
+	TIPSY_BAD_NATIVE_READ  = 0x10009, /* Bad read on native stream */
+	TIPSY_BAD_NATIVE_WRITE = 0x1000A, /* Bad write on native stream */
+	TIPSY_BAD_BLOCK_SIZE   = 0x1000B, /* Invalid I/O block size */
+	TIPSY_BAD_THREAD_COUNT = 0x1000C, /* Invalid number of I/O threads */
+	TIPSY_BAD_RANGE        = 0x1000D, /* Particle range outside of the family */
+	TIPSY_BAD_COUNT        = 0x1000E  /* Particle count too large for a Tipsy header */
 } tipsy_error_t;
 
 char const* tipsy_strerror(tipsy_error_t);
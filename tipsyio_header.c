@@ -0,0 +1,59 @@
+#include "tipsyio_header.h"
+#include "tipsyio_err.h"
+#include <errno.h>
+#include <limits.h>
+#include <string.h>
+#include <sys/stat.h>
+
+enum { TIPSY_COUNT_BITS = 32 };
+
+int tipsy_header_to_disk(tipsy_header const* h, tipsy_disk_header* disk) {
+	if (h->ngas > UINT_MAX || h->nstar > UINT_MAX) { return TIPSY_BAD_COUNT; }
+
+	// Clear the padding so that native files are reproducible
+	memset(disk, 0, sizeof(tipsy_disk_header));
+	disk->time    = h->time;
+	disk->nbodies = (unsigned int)h->nbodies;
+	disk->ndim    = h->ndim;
+	disk->ngas    = (unsigned int)h->ngas;
+	disk->ndark   = (unsigned int)h->ndark;
+	disk->nstar   = (unsigned int)h->nstar;
+	return 0;
+}
+
+void tipsy_header_from_disk(tipsy_disk_header const* disk, tipsy_header* h) {
+	h->time    = disk->time;
+	h->nbodies = disk->nbodies;
+	h->ndim    = disk->ndim;
+	h->ngas    = disk->ngas;
+	h->ndark   = disk->ndark;
+	h->nstar   = disk->nstar;
+}
+
+/*
+ * Recover the dark matter count of an extended-count file from its size
+ *
+ * 'header_size' and the record sizes give the layout of the file. Any excess
+ * that is a whole number of 2^32 dark matter records is attributed to ndark.
+ * Streams that aren't regular files (e.g., pipes) keep the counts in the header.
+ */
+int tipsy_extend_header(tipsy_header* h, FILE* fd, off_t header_size, size_t gas_size, size_t dark_size,
+			size_t star_size) {
+	struct stat st;
+	if (fstat(fileno(fd), &st) != 0) { return errno; }
+
+	if (S_ISREG(st.st_mode)) {
+		const uint64_t expected = (uint64_t)header_size + h->ngas * gas_size + h->ndark * dark_size +
+					  h->nstar * star_size;
+		const uint64_t actual = (uint64_t)st.st_size;
+		const uint64_t wrap   = ((uint64_t)1 << TIPSY_COUNT_BITS) * dark_size;
+		if (actual > expected && (actual - expected) % wrap == 0) {
+			h->ndark += ((actual - expected) / wrap) << TIPSY_COUNT_BITS;
+		}
+	}
+
+	// nbodies is stored modulo 2^32, too
+	const uint64_t nbodies = h->ngas + h->ndark + h->nstar;
+	if ((nbodies & UINT_MAX) == h->nbodies) { h->nbodies = nbodies; }
+	return 0;
+}
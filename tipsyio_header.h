@@ -0,0 +1,34 @@
+#pragma once
+
+#include "tipsy.h"
+#include <stdio.h>
+#include <sys/types.h>
+
+/*
+ * The Tipsy header as stored in the file
+ *
+ * Particle counts are 32-bit on disk, but 64-bit in a tipsy_header. Files with 2^32 or
+ * more dark matter particles use the extended-count convention: ndark and nbodies are
+ * stored modulo 2^32, and readers recover the full counts from the size of the file.
+ * The gas and star counts must fit in 32 bits.
+ */
+typedef struct {
+	double       time;
+	unsigned int nbodies;
+	int          ndim;
+	unsigned int ngas;
+	unsigned int ndark;
+	unsigned int nstar;
+} tipsy_disk_header;
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+int  tipsy_header_to_disk(tipsy_header const*, tipsy_disk_header*);
+void tipsy_header_from_disk(tipsy_disk_header const*, tipsy_header*);
+int  tipsy_extend_header(tipsy_header*, FILE*, off_t, size_t, size_t, size_t);
+
+#ifdef __cplusplus
+}
+#endif
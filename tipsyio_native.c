@@ -1,168 +1,131 @@
 #include "tipsyio_native.h"
+#include "tipsyio_block.h"
 #include "tipsyio_err.h"
+#include "tipsyio_header.h"
 #include <errno.h>
+#include <unistd.h>
 
-inline static void reset_fd(FILE* fd, size_t offset) {
-	int i = fseek(fd, (long)offset, SEEK_SET);
-	(void)i;
-}
+inline static int reset_fd(FILE* fd, off_t offset) { return fseeko(fd, offset, SEEK_SET); }
 
 /*************************************************************************************************************/
 int tipsy_init_native(tipsy_native_stream* stream, char const* filename, char const* mode, tipsy_native_dir dir) {
-	switch (dir) {
-	case TIPSY_NATIVE_ENCODE:
-		stream->fd = fopen(filename, mode);
-		if (errno != 0) { return errno; }
-		return 0;
-	case TIPSY_NATIVE_DECODE:
-		stream->fd = fopen(filename, mode);
-		if (errno != 0) { return errno; }
-		return 0;
-	default:
-		return TIPSY_BAD_NATIVE_DIR;
-	}
+	if (dir != TIPSY_NATIVE_ENCODE && dir != TIPSY_NATIVE_DECODE) { return TIPSY_BAD_NATIVE_DIR; }
+
+	// errno is only meaningful when fopen fails; it may be left over from anything before it
+	stream->fd = fopen(filename, mode);
+	if (!stream->fd) { return errno; }
+	stream->block_records = TIPSY_BLOCK_RECORDS;
+	return 0;
 }
 void tipsy_destroy_native(tipsy_native_stream* stream) {
 	if (stream->fd) fclose(stream->fd);
+	stream->fd = NULL;
+}
+int tipsy_set_block_size_native(tipsy_native_stream* stream, size_t block_records) {
+	if (block_records == 0) { return TIPSY_BAD_BLOCK_SIZE; }
+	stream->block_records = block_records;
+	return 0;
+}
+
+/* Rewrite the header in place if the number of particles written differs from it */
+int tipsy_finish_native(tipsy_native_stream* stream) {
+	if (!stream->fd) { return TIPSY_WRITE_UNOPENED; }
+	tipsy_header const* w = &(stream->written);
+	tipsy_header        h = stream->header;
+	if (w->ngas + w->ndark + w->nstar == 0) { return 0; }
+	if (w->ngas == h.ngas && w->ndark == h.ndark && w->nstar == h.nstar) { return 0; }
+
+	h.ngas    = w->ngas;
+	h.ndark   = w->ndark;
+	h.nstar   = w->nstar;
+	h.nbodies = h.ngas + h.ndark + h.nstar;
+
+	tipsy_disk_header disk;
+	const int         status = tipsy_header_to_disk(&h, &disk);
+	if (status != 0) { return status; }
+	if (fflush(stream->fd) != 0) { return errno; }
+	if (pwrite(fileno(stream->fd), &disk, sizeof(disk), 0) != (ssize_t)sizeof(disk)) { return errno; }
+	stream->header = h;
+	return 0;
 }
 
 /*************************************************************************************************************/
 int tipsy_read_header_native(tipsy_native_stream* stream, tipsy_header* h) {
 	if (!stream->fd) { return TIPSY_READ_UNOPENED; }
-	reset_fd(stream->fd, 0);
-	if (fread(h, sizeof(tipsy_header), 1, stream->fd) != 1) { return errno; }
-	return 0;
+	if (reset_fd(stream->fd, 0) != 0) { return errno; }
+	tipsy_disk_header disk;
+	if (fread(&disk, sizeof(tipsy_disk_header), 1, stream->fd) != 1) { return TIPSY_BAD_NATIVE_READ; }
+	tipsy_header_from_disk(&disk, h);
+	return tipsy_extend_header(h, stream->fd, sizeof(tipsy_disk_header), sizeof(tipsy_gas_particle),
+				   sizeof(tipsy_dark_particle), sizeof(tipsy_star_particle));
 }
 int tipsy_read_gas_native(tipsy_native_stream* stream, tipsy_header const* h, tipsy_gas_data* d) {
-	(void)h;
+	return tipsy_read_gas_range_native(stream, h, 0, d);
+}
+int tipsy_read_gas_range_native(tipsy_native_stream* stream, tipsy_header const* h, size_t first, tipsy_gas_data* d) {
 	if (!stream->fd) { return TIPSY_READ_UNOPENED; }
-	const size_t offset = sizeof(tipsy_header);
-	reset_fd(stream->fd, offset);
-	tipsy_gas_particle p;
-	const size_t       size = d->size;
-	for (size_t i = 0; i < size; ++i) {
-		if (fread(&p, sizeof(tipsy_gas_particle), 1, stream->fd) != 1) { return errno; }
-		d->mass[i]    = p.mass;
-		d->pos[i][0]  = p.pos[0];
-		d->pos[i][1]  = p.pos[1];
-		d->pos[i][2]  = p.pos[2];
-		d->vel[i][0]  = p.vel[0];
-		d->vel[i][1]  = p.vel[1];
-		d->vel[i][2]  = p.vel[2];
-		d->rho[i]     = p.rho;
-		d->temp[i]    = p.temp;
-		d->hsmooth[i] = p.hsmooth;
-		d->metals[i]  = p.metals;
-		d->phi[i]     = p.phi;
-	}
-	return 0;
+	if (first > h->ngas || d->size > h->ngas - first) { return TIPSY_BAD_RANGE; }
+	const off_t offset = (off_t)(sizeof(tipsy_disk_header) + first * sizeof(tipsy_gas_particle));
+	if (reset_fd(stream->fd, offset) != 0) { return errno; }
+	return tipsy_block_io(stream->fd, d, d->size, sizeof(tipsy_gas_particle), stream->block_records,
+			      tipsy_gas_block, TIPSY_BLOCK_UNPACK, 0, TIPSY_BAD_NATIVE_READ);
 }
 int tipsy_read_dark_native(tipsy_native_stream* stream, tipsy_header const* h, tipsy_dark_data* d) {
+	return tipsy_read_dark_range_native(stream, h, 0, d);
+}
+int tipsy_read_dark_range_native(tipsy_native_stream* stream, tipsy_header const* h, size_t first, tipsy_dark_data* d) {
 	if (!stream->fd) { return TIPSY_READ_UNOPENED; }
-	const size_t offset = sizeof(tipsy_header) + h->ngas * sizeof(tipsy_gas_particle);
-	reset_fd(stream->fd, offset);
-	const size_t	size = d->size;
-	tipsy_dark_particle p;
-	for (size_t i = 0; i < size; ++i) {
-		if (fread(&p, sizeof(tipsy_dark_particle), 1, stream->fd) != 1) { return errno; }
-		d->mass[i]   = p.mass;
-		d->pos[i][0] = p.pos[0];
-		d->pos[i][1] = p.pos[1];
-		d->pos[i][2] = p.pos[2];
-		d->vel[i][0] = p.vel[0];
-		d->vel[i][1] = p.vel[1];
-		d->vel[i][2] = p.vel[2];
-		d->soft[i]   = p.softening;
-		d->phi[i]    = p.phi;
-	}
-	return 0;
+	if (first > h->ndark || d->size > h->ndark - first) { return TIPSY_BAD_RANGE; }
+	const off_t offset = (off_t)(sizeof(tipsy_disk_header) + h->ngas * sizeof(tipsy_gas_particle) +
+				     first * sizeof(tipsy_dark_particle));
+	if (reset_fd(stream->fd, offset) != 0) { return errno; }
+	return tipsy_block_io(stream->fd, d, d->size, sizeof(tipsy_dark_particle), stream->block_records,
+			      tipsy_dark_block, TIPSY_BLOCK_UNPACK, 0, TIPSY_BAD_NATIVE_READ);
 }
 int tipsy_read_star_native(tipsy_native_stream* stream, tipsy_header const* h, tipsy_star_data* d) {
+	return tipsy_read_star_range_native(stream, h, 0, d);
+}
+int tipsy_read_star_range_native(tipsy_native_stream* stream, tipsy_header const* h, size_t first, tipsy_star_data* d) {
 	if (!stream->fd) { return TIPSY_READ_UNOPENED; }
-	const size_t offset = sizeof(tipsy_header) + h->ngas * sizeof(tipsy_gas_particle) +
-			      h->ndark * sizeof(tipsy_dark_particle);
-	reset_fd(stream->fd, offset);
-	tipsy_star_particle p;
-	const size_t	size = d->size;
-	for (size_t i = 0; i < size; ++i) {
-		if (fread(&p, sizeof(tipsy_star_particle), 1, stream->fd) != 1) { return errno; }
-		d->mass[i]   = p.mass;
-		d->pos[i][0] = p.pos[0];
-		d->pos[i][1] = p.pos[1];
-		d->pos[i][2] = p.pos[2];
-		d->vel[i][0] = p.vel[0];
-		d->vel[i][1] = p.vel[1];
-		d->vel[i][2] = p.vel[2];
-		d->metals[i] = p.metals;
-		d->tform[i]  = p.tform;
-		d->soft[i]   = p.softening;
-		d->phi[i]    = p.phi;
-	}
-	return 0;
+	if (first > h->nstar || d->size > h->nstar - first) { return TIPSY_BAD_RANGE; }
+	const off_t offset = (off_t)(sizeof(tipsy_disk_header) + h->ngas * sizeof(tipsy_gas_particle) +
+				     h->ndark * sizeof(tipsy_dark_particle) + first * sizeof(tipsy_star_particle));
+	if (reset_fd(stream->fd, offset) != 0) { return errno; }
+	return tipsy_block_io(stream->fd, d, d->size, sizeof(tipsy_star_particle), stream->block_records,
+			      tipsy_star_block, TIPSY_BLOCK_UNPACK, 0, TIPSY_BAD_NATIVE_READ);
 }
 
 /*************************************************************************************************************/
 int tipsy_write_header_native(tipsy_native_stream* stream, tipsy_header const* h) {
 	if (!stream->fd) { return TIPSY_WRITE_UNOPENED; }
-	if (fwrite(h, sizeof(tipsy_header), 1, stream->fd) != 1) { return errno; }
+	tipsy_disk_header disk;
+	const int         status = tipsy_header_to_disk(h, &disk);
+	if (status != 0) { return status; }
+	if (fwrite(&disk, sizeof(tipsy_disk_header), 1, stream->fd) != 1) { return TIPSY_BAD_NATIVE_WRITE; }
+	stream->header = *h;
 	return 0;
 }
 int tipsy_write_gas_native(tipsy_native_stream* stream, tipsy_gas_data const* d) {
 	if (!stream->fd) { return TIPSY_WRITE_UNOPENED; }
-	tipsy_gas_particle p;
-	const size_t       size = d->size;
-	for (size_t i = 0; i < size; ++i) {
-		p.mass    = d->mass[i];
-		p.pos[0]  = d->pos[i][0];
-		p.pos[1]  = d->pos[i][1];
-		p.pos[2]  = d->pos[i][2];
-		p.vel[0]  = d->vel[i][0];
-		p.vel[1]  = d->vel[i][1];
-		p.vel[2]  = d->vel[i][2];
-		p.rho     = d->rho[i];
-		p.temp    = d->temp[i];
-		p.hsmooth = d->hsmooth[i];
-		p.metals  = d->metals[i];
-		p.phi     = d->phi[i];
-		if (fwrite(&p, sizeof(tipsy_gas_particle), 1, stream->fd) != 1) { return errno; }
-	}
-	return 0;
+	const int status = tipsy_block_io(stream->fd, (tipsy_gas_data*)d, d->size, sizeof(tipsy_gas_particle),
+					  stream->block_records, tipsy_gas_block, TIPSY_BLOCK_PACK, 0,
+					  TIPSY_BAD_NATIVE_WRITE);
+	if (status == 0) { stream->written.ngas += d->size; }
+	return status;
 }
 int tipsy_write_dark_native(tipsy_native_stream* stream, tipsy_dark_data const* d) {
 	if (!stream->fd) { return TIPSY_WRITE_UNOPENED; }
-	tipsy_dark_particle p;
-	const size_t	size = d->size;
-	for (size_t i = 0; i < size; ++i) {
-		p.mass      = d->mass[i];
-		p.pos[0]    = d->pos[i][0];
-		p.pos[1]    = d->pos[i][1];
-		p.pos[2]    = d->pos[i][2];
-		p.vel[0]    = d->vel[i][0];
-		p.vel[1]    = d->vel[i][1];
-		p.vel[2]    = d->vel[i][2];
-		p.softening = d->soft[i];
-		p.phi       = d->phi[i];
-		if (fwrite(&p, sizeof(tipsy_dark_particle), 1, stream->fd) != 1) { return errno; }
-	}
-	return 0;
+	const int status = tipsy_block_io(stream->fd, (tipsy_dark_data*)d, d->size, sizeof(tipsy_dark_particle),
+					  stream->block_records, tipsy_dark_block, TIPSY_BLOCK_PACK, 0,
+					  TIPSY_BAD_NATIVE_WRITE);
+	if (status == 0) { stream->written.ndark += d->size; }
+	return status;
 }
 int tipsy_write_star_native(tipsy_native_stream* stream, tipsy_star_data const* d) {
 	if (!stream->fd) { return TIPSY_WRITE_UNOPENED; }
-	tipsy_star_particle p;
-	const size_t	size = d->size;
-	for (size_t i = 0; i < size; ++i) {
-		p.mass      = d->mass[i];
-		p.pos[0]    = d->pos[i][0];
-		p.pos[1]    = d->pos[i][1];
-		p.pos[2]    = d->pos[i][2];
-		p.vel[0]    = d->vel[i][0];
-		p.vel[1]    = d->vel[i][1];
-		p.vel[2]    = d->vel[i][2];
-		p.metals    = d->metals[i];
-		p.tform     = d->tform[i];
-		p.softening = d->soft[i];
-		p.phi       = d->phi[i];
-		if (fwrite(&p, sizeof(tipsy_star_particle), 1, stream->fd) != 1) { return errno; }
-	}
-	return 0;
+	const int status = tipsy_block_io(stream->fd, (tipsy_star_data*)d, d->size, sizeof(tipsy_star_particle),
+					  stream->block_records, tipsy_star_block, TIPSY_BLOCK_PACK, 0,
+					  TIPSY_BAD_NATIVE_WRITE);
+	if (status == 0) { stream->written.nstar += d->size; }
+	return status;
 }
@@ -3,7 +3,12 @@
 #include "tipsy.h"
 #include <stdio.h>
 
-typedef struct { FILE* fd; } tipsy_native_stream;
+typedef struct {
+	FILE*        fd;
+	size_t       block_records; /* particles per fread/fwrite */
+	tipsy_header header;        /* as last written */
+	tipsy_header written;       /* particle counts actually written */
+} tipsy_native_stream;
 
 typedef enum { TIPSY_NATIVE_ENCODE, TIPSY_NATIVE_DECODE } tipsy_native_dir;
 
@@ -13,11 +18,16 @@ extern "C" {
 
 int  tipsy_init_native(tipsy_native_stream*, char const*, char const*,tipsy_native_dir);
 void tipsy_destroy_native(tipsy_native_stream*);
+int  tipsy_set_block_size_native(tipsy_native_stream*, size_t);
+int  tipsy_finish_native(tipsy_native_stream*);
 
 int tipsy_read_header_native(tipsy_native_stream*, tipsy_header*);
 int tipsy_read_gas_native(tipsy_native_stream*, tipsy_header const*, tipsy_gas_data*);
+int tipsy_read_gas_range_native(tipsy_native_stream*, tipsy_header const*, size_t, tipsy_gas_data*);
 int tipsy_read_dark_native(tipsy_native_stream*, tipsy_header const*, tipsy_dark_data*);
+int tipsy_read_dark_range_native(tipsy_native_stream*, tipsy_header const*, size_t, tipsy_dark_data*);
 int tipsy_read_star_native(tipsy_native_stream*, tipsy_header const*, tipsy_star_data*);
+int tipsy_read_star_range_native(tipsy_native_stream*, tipsy_header const*, size_t, tipsy_star_data*);
 
 int tipsy_write_header_native(tipsy_native_stream*, tipsy_header const*);
 int tipsy_write_gas_native(tipsy_native_stream*, tipsy_gas_data const*);
@@ -1,7 +1,10 @@
 #include "tipsy.h"
+#include "tipsyio_block.h"
 #include "tipsyio_err.h"
+#include "tipsyio_header.h"
 #include "tipsyio_xdr.h"
 #include <errno.h>
+#include <unistd.h>
 
 /* All XDR routines return one on success and zero, otherwise. */
 enum { TIPSY_XDR_FAILURE = 0, TIPSY_XDR_SUCCESS = 1 };
@@ -18,65 +21,113 @@ enum{
 	TIPSY_XDR_STAR_SIZE = 11 * sizeof(float)
 };
 
-inline static void reset_fd(FILE* fd, size_t offset) {
-	int i = fseek(fd, (long)offset, SEEK_SET);
-	(void)i;
-}
+inline static int reset_fd(FILE* fd, off_t offset) { return fseeko(fd, offset, SEEK_SET); }
 
-inline static int __tipsy_header(XDR*, tipsy_header*);
+inline static int __block(tipsy_xdr_stream*, void*, size_t, size_t, tipsy_block_fn, tipsy_block_op);
+inline static int __tipsy_header(XDR*, tipsy_disk_header*);
 inline static int __tipsy_gas(XDR*, tipsy_gas_data*);
 inline static int __tipsy_dark(XDR*, tipsy_dark_data*);
 inline static int __tipsy_star(XDR*, tipsy_star_data*);
 
 /*************************************************************************************************************/
 int tipsy_init_xdr(tipsy_xdr_stream* xdr_stream, char const* filename, char const* mode, tipsy_xdr_dir dir) {
+	enum xdr_op op;
 	switch (dir) {
-	case TIPSY_XDR_ENCODE:
-		xdr_stream->fd = fopen(filename, mode);
-		if (errno != 0) { return errno; }
-		xdrstdio_create(&(xdr_stream->xdr), xdr_stream->fd, XDR_ENCODE);
-		return 0;
-	case TIPSY_XDR_DECODE:
-		xdr_stream->fd = fopen(filename, mode);
-		if (errno != 0) { return errno; }
-		xdrstdio_create(&(xdr_stream->xdr), xdr_stream->fd, XDR_DECODE);
-		return 0;
-	default:
-		return TIPSY_BAD_XDR_DIR;
+	case TIPSY_XDR_ENCODE: op = XDR_ENCODE; break;
+	case TIPSY_XDR_DECODE: op = XDR_DECODE; break;
+	default: return TIPSY_BAD_XDR_DIR;
 	}
+
+	// errno is only meaningful when fopen fails; it may be left over from anything before it
+	xdr_stream->fd = fopen(filename, mode);
+	if (!xdr_stream->fd) { return errno; }
+	xdrstdio_create(&(xdr_stream->xdr), xdr_stream->fd, op);
+	xdr_stream->codec         = TIPSY_XDR_CODEC_BLOCK;
+	xdr_stream->block_records = TIPSY_BLOCK_RECORDS;
+	xdr_stream->nthreads      = 1;
+	return 0;
 }
 void tipsy_destroy_xdr(tipsy_xdr_stream* xdr_stream) {
-	if (xdr_stream->fd) fclose(xdr_stream->fd);
+	// The XDR stream is only created with the file, and flushes it when destroyed
+	if (!xdr_stream->fd) return;
 	xdr_destroy(&(xdr_stream->xdr));
+	fclose(xdr_stream->fd);
+	xdr_stream->fd = NULL;
+}
+int tipsy_set_codec_xdr(tipsy_xdr_stream* xdr_stream, tipsy_xdr_codec codec) {
+	switch (codec) {
+	case TIPSY_XDR_CODEC_BLOCK:
+	case TIPSY_XDR_CODEC_REFERENCE:
+		xdr_stream->codec = codec;
+		return 0;
+	default:
+		return TIPSY_BAD_XDR_CODEC;
+	}
+}
+
+int tipsy_set_block_size_xdr(tipsy_xdr_stream* xdr_stream, size_t block_records) {
+	if (block_records == 0) { return TIPSY_BAD_BLOCK_SIZE; }
+	xdr_stream->block_records = block_records;
+	return 0;
+}
+
+int tipsy_set_threads_xdr(tipsy_xdr_stream* xdr_stream, int nthreads) {
+	if (nthreads < 1) { return TIPSY_BAD_THREAD_COUNT; }
+	xdr_stream->nthreads = nthreads;
+	return 0;
 }
 
 /*************************************************************************************************************/
 int tipsy_read_header_xdr(tipsy_xdr_stream* xdr_stream, tipsy_header* h) {
 	if (!xdr_stream->fd) { return TIPSY_READ_UNOPENED; }
-	reset_fd(xdr_stream->fd, 0);
-	const int status = __tipsy_header(&(xdr_stream->xdr), h);
-	return (status == TIPSY_XDR_FAILURE) ? TIPSY_BAD_XDR_READ : 0;
+	if (reset_fd(xdr_stream->fd, 0) != 0) { return errno; }
+	tipsy_disk_header disk;
+	if (__tipsy_header(&(xdr_stream->xdr), &disk) == TIPSY_XDR_FAILURE) { return TIPSY_BAD_XDR_READ; }
+	tipsy_header_from_disk(&disk, h);
+	return tipsy_extend_header(h, xdr_stream->fd, TIPSY_XDR_HEADER_SIZE + TIPSY_XDR_HEADER_PAD, TIPSY_XDR_GAS_SIZE,
+				   TIPSY_XDR_DARK_SIZE, TIPSY_XDR_STAR_SIZE);
 }
 int tipsy_read_gas_xdr(tipsy_xdr_stream* xdr_stream, tipsy_header const* h, tipsy_gas_data* d) {
-	(void)h;
+	return tipsy_read_gas_range_xdr(xdr_stream, h, 0, d);
+}
+int tipsy_read_gas_range_xdr(tipsy_xdr_stream* xdr_stream, tipsy_header const* h, size_t first, tipsy_gas_data* d) {
 	if (!xdr_stream->fd) { return TIPSY_READ_UNOPENED; }
-	const size_t offset = TIPSY_XDR_HEADER_SIZE + TIPSY_XDR_HEADER_PAD;
-	reset_fd(xdr_stream->fd, offset);
+	if (first > h->ngas || d->size > h->ngas - first) { return TIPSY_BAD_RANGE; }
+	const off_t offset = (off_t)(TIPSY_XDR_HEADER_SIZE + TIPSY_XDR_HEADER_PAD + first * TIPSY_XDR_GAS_SIZE);
+	if (reset_fd(xdr_stream->fd, offset) != 0) { return errno; }
+	if (xdr_stream->codec == TIPSY_XDR_CODEC_BLOCK) {
+		return __block(xdr_stream, d, d->size, TIPSY_XDR_GAS_SIZE, tipsy_gas_block, TIPSY_BLOCK_UNPACK);
+	}
 	const int status = __tipsy_gas(&(xdr_stream->xdr), d);
 	return (status == TIPSY_XDR_FAILURE) ? TIPSY_BAD_XDR_READ : 0;
 }
 int tipsy_read_dark_xdr(tipsy_xdr_stream* xdr_stream, tipsy_header const* h, tipsy_dark_data* d) {
+	return tipsy_read_dark_range_xdr(xdr_stream, h, 0, d);
+}
+int tipsy_read_dark_range_xdr(tipsy_xdr_stream* xdr_stream, tipsy_header const* h, size_t first, tipsy_dark_data* d) {
 	if (!xdr_stream->fd) { return TIPSY_READ_UNOPENED; }
-	const size_t offset = TIPSY_XDR_HEADER_SIZE + TIPSY_XDR_HEADER_PAD + h->ngas * TIPSY_XDR_GAS_SIZE;
-	reset_fd(xdr_stream->fd, offset);
+	if (first > h->ndark || d->size > h->ndark - first) { return TIPSY_BAD_RANGE; }
+	const off_t offset = (off_t)(TIPSY_XDR_HEADER_SIZE + TIPSY_XDR_HEADER_PAD + h->ngas * TIPSY_XDR_GAS_SIZE +
+				     first * TIPSY_XDR_DARK_SIZE);
+	if (reset_fd(xdr_stream->fd, offset) != 0) { return errno; }
+	if (xdr_stream->codec == TIPSY_XDR_CODEC_BLOCK) {
+		return __block(xdr_stream, d, d->size, TIPSY_XDR_DARK_SIZE, tipsy_dark_block, TIPSY_BLOCK_UNPACK);
+	}
 	const int status = __tipsy_dark(&(xdr_stream->xdr), d);
 	return (status == TIPSY_XDR_FAILURE) ? TIPSY_BAD_XDR_READ : 0;
 }
 int tipsy_read_star_xdr(tipsy_xdr_stream* xdr_stream, tipsy_header const* h, tipsy_star_data* d) {
+	return tipsy_read_star_range_xdr(xdr_stream, h, 0, d);
+}
+int tipsy_read_star_range_xdr(tipsy_xdr_stream* xdr_stream, tipsy_header const* h, size_t first, tipsy_star_data* d) {
 	if (!xdr_stream->fd) { return TIPSY_READ_UNOPENED; }
-	const size_t offset = TIPSY_XDR_HEADER_SIZE + TIPSY_XDR_HEADER_PAD + h->ngas * TIPSY_XDR_GAS_SIZE +
-			      h->ndark * TIPSY_XDR_DARK_SIZE;
-	reset_fd(xdr_stream->fd, offset);
+	if (first > h->nstar || d->size > h->nstar - first) { return TIPSY_BAD_RANGE; }
+	const off_t offset = (off_t)(TIPSY_XDR_HEADER_SIZE + TIPSY_XDR_HEADER_PAD + h->ngas * TIPSY_XDR_GAS_SIZE +
+				     h->ndark * TIPSY_XDR_DARK_SIZE + first * TIPSY_XDR_STAR_SIZE);
+	if (reset_fd(xdr_stream->fd, offset) != 0) { return errno; }
+	if (xdr_stream->codec == TIPSY_XDR_CODEC_BLOCK) {
+		return __block(xdr_stream, d, d->size, TIPSY_XDR_STAR_SIZE, tipsy_star_block, TIPSY_BLOCK_UNPACK);
+	}
 	const int status = __tipsy_star(&(xdr_stream->xdr), d);
 	return (status == TIPSY_XDR_FAILURE) ? TIPSY_BAD_XDR_READ : 0;
 }
@@ -84,27 +135,105 @@ int tipsy_read_star_xdr(tipsy_xdr_stream* xdr_stream, tipsy_header const* h, tip
 /*************************************************************************************************************/
 int tipsy_write_header_xdr(tipsy_xdr_stream* xdr_stream, tipsy_header const* h) {
 	if (!xdr_stream->fd) { return TIPSY_WRITE_UNOPENED; }
-	const int status = __tipsy_header(&(xdr_stream->xdr), (tipsy_header*)h);
-	return (status == TIPSY_XDR_FAILURE) ? TIPSY_BAD_XDR_WRITE : 0;
+	tipsy_disk_header disk;
+	const int         status = tipsy_header_to_disk(h, &disk);
+	if (status != 0) { return status; }
+	if (__tipsy_header(&(xdr_stream->xdr), &disk) == TIPSY_XDR_FAILURE) { return TIPSY_BAD_XDR_WRITE; }
+	xdr_stream->header = *h;
+	return 0;
 }
 int tipsy_write_gas_xdr(tipsy_xdr_stream* xdr_stream, tipsy_gas_data const* d) {
 	if (!xdr_stream->fd) { return TIPSY_WRITE_UNOPENED; }
-	const int status = __tipsy_gas(&(xdr_stream->xdr), (tipsy_gas_data*)d);
-	return (status == TIPSY_XDR_FAILURE) ? TIPSY_BAD_XDR_WRITE : 0;
+	int status = 0;
+	if (xdr_stream->codec == TIPSY_XDR_CODEC_BLOCK) {
+		status = __block(xdr_stream, (tipsy_gas_data*)d, d->size, TIPSY_XDR_GAS_SIZE, tipsy_gas_block,
+				 TIPSY_BLOCK_PACK);
+	} else if (__tipsy_gas(&(xdr_stream->xdr), (tipsy_gas_data*)d) == TIPSY_XDR_FAILURE) {
+		status = TIPSY_BAD_XDR_WRITE;
+	}
+	if (status == 0) { xdr_stream->written.ngas += d->size; }
+	return status;
 }
 int tipsy_write_dark_xdr(tipsy_xdr_stream* xdr_stream, tipsy_dark_data const* d) {
 	if (!xdr_stream->fd) { return TIPSY_WRITE_UNOPENED; }
-	const int status = __tipsy_dark(&(xdr_stream->xdr), (tipsy_dark_data*)d);
-	return (status == TIPSY_XDR_FAILURE) ? TIPSY_BAD_XDR_WRITE : 0;
+	int status = 0;
+	if (xdr_stream->codec == TIPSY_XDR_CODEC_BLOCK) {
+		status = __block(xdr_stream, (tipsy_dark_data*)d, d->size, TIPSY_XDR_DARK_SIZE, tipsy_dark_block,
+				 TIPSY_BLOCK_PACK);
+	} else if (__tipsy_dark(&(xdr_stream->xdr), (tipsy_dark_data*)d) == TIPSY_XDR_FAILURE) {
+		status = TIPSY_BAD_XDR_WRITE;
+	}
+	if (status == 0) { xdr_stream->written.ndark += d->size; }
+	return status;
 }
 int tipsy_write_star_xdr(tipsy_xdr_stream* xdr_stream, tipsy_star_data const* d) {
 	if (!xdr_stream->fd) { return TIPSY_WRITE_UNOPENED; }
-	const int status = __tipsy_star(&(xdr_stream->xdr), (tipsy_star_data*)d);
-	return (status == TIPSY_XDR_FAILURE) ? TIPSY_BAD_XDR_WRITE : 0;
+	int status = 0;
+	if (xdr_stream->codec == TIPSY_XDR_CODEC_BLOCK) {
+		status = __block(xdr_stream, (tipsy_star_data*)d, d->size, TIPSY_XDR_STAR_SIZE, tipsy_star_block,
+				 TIPSY_BLOCK_PACK);
+	} else if (__tipsy_star(&(xdr_stream->xdr), (tipsy_star_data*)d) == TIPSY_XDR_FAILURE) {
+		status = TIPSY_BAD_XDR_WRITE;
+	}
+	if (status == 0) { xdr_stream->written.nstar += d->size; }
+	return status;
+}
+
+/*
+ * Rewrite the header in place if the number of particles written differs from it
+ *
+ * The header is only touched when needed, so writers that knew their counts
+ * up front also work on files that can't be rewritten (e.g., pipes).
+ */
+int tipsy_finish_xdr(tipsy_xdr_stream* xdr_stream) {
+	if (!xdr_stream->fd) { return TIPSY_WRITE_UNOPENED; }
+	tipsy_header const* w = &(xdr_stream->written);
+	tipsy_header        h = xdr_stream->header;
+	if (w->ngas + w->ndark + w->nstar == 0) { return 0; }
+	if (w->ngas == h.ngas && w->ndark == h.ndark && w->nstar == h.nstar) { return 0; }
+
+	h.ngas    = w->ngas;
+	h.ndark   = w->ndark;
+	h.nstar   = w->nstar;
+	h.nbodies = h.ngas + h.ndark + h.nstar;
+
+	tipsy_disk_header disk;
+	const int         status = tipsy_header_to_disk(&h, &disk);
+	if (status != 0) { return status; }
+
+	char buf[TIPSY_XDR_HEADER_SIZE + TIPSY_XDR_HEADER_PAD];
+	XDR  xdr;
+	xdrmem_create(&xdr, buf, sizeof(buf), XDR_ENCODE);
+	const int encoded = __tipsy_header(&xdr, &disk);
+	xdr_destroy(&xdr);
+	if (encoded == TIPSY_XDR_FAILURE) { return TIPSY_BAD_XDR_WRITE; }
+
+	if (fflush(xdr_stream->fd) != 0) { return errno; }
+	if (pwrite(fileno(xdr_stream->fd), buf, sizeof(buf), 0) != (ssize_t)sizeof(buf)) { return errno; }
+	xdr_stream->header = h;
+	return 0;
 }
 
 /*************************************************************************************************************/
-static int __tipsy_header(XDR* xdr, tipsy_header* h) {
+/* Move a family through the block codec, split across the stream's threads */
+static int __block(tipsy_xdr_stream* xdr_stream, void* data, size_t size, size_t record_size, tipsy_block_fn fn,
+		   tipsy_block_op op) {
+	const int err = (op == TIPSY_BLOCK_UNPACK) ? TIPSY_BAD_XDR_READ : TIPSY_BAD_XDR_WRITE;
+	if (xdr_stream->nthreads > 1) {
+		return tipsy_block_pio(xdr_stream->fd, data, size, record_size, xdr_stream->block_records,
+				       xdr_stream->nthreads, fn, op, 1, err);
+	}
+	return tipsy_block_io(xdr_stream->fd, data, size, record_size, xdr_stream->block_records, fn, op, 1, err);
+}
+
+inline static int __xdr_vector3(XDR* xdr, float* v) {
+	return xdr_vector(xdr, (char*)v, 3, sizeof(float), (xdrproc_t)xdr_float);
+}
+
+/* The address of element 'i' of a column or, when encoding a NULL column, of its constant value */
+#define __column(col, i, value) ((col) ? &((col)[i]) : &(value))
+
+static int __tipsy_header(XDR* xdr, tipsy_disk_header* h) {
 	int status = TIPSY_XDR_SUCCESS;
 	int pad = 0;
 	status &= xdr_double(xdr, &(h->time));
@@ -121,14 +250,14 @@ static int __tipsy_gas(XDR* xdr, tipsy_gas_data* d) {
 	const size_t size   = d->size;
 	int	  status = TIPSY_XDR_SUCCESS;
 	for (size_t i = 0; i < size; ++i) {
-		status &= xdr_float(xdr, &(d->mass[i]));
-		status &= xdr_vector(xdr, (char*)(&(d->pos[i])), 3, sizeof(float), (xdrproc_t)xdr_float);
-		status &= xdr_vector(xdr, (char*)(&(d->vel[i])), 3, sizeof(float), (xdrproc_t)xdr_float);
-		status &= xdr_float(xdr, &(d->rho[i]));
-		status &= xdr_float(xdr, &(d->temp[i]));
-		status &= xdr_float(xdr, &(d->hsmooth[i]));
-		status &= xdr_float(xdr, &(d->metals[i]));
-		status &= xdr_float(xdr, &(d->phi[i]));
+		status &= xdr_float(xdr, __column(d->mass, i, d->constant.mass));
+		status &= __xdr_vector3(xdr, *__column(d->pos, i, d->constant.pos));
+		status &= __xdr_vector3(xdr, *__column(d->vel, i, d->constant.vel));
+		status &= xdr_float(xdr, __column(d->rho, i, d->constant.rho));
+		status &= xdr_float(xdr, __column(d->temp, i, d->constant.temp));
+		status &= xdr_float(xdr, __column(d->hsmooth, i, d->constant.hsmooth));
+		status &= xdr_float(xdr, __column(d->metals, i, d->constant.metals));
+		status &= xdr_float(xdr, __column(d->phi, i, d->constant.phi));
 		if (status == TIPSY_XDR_FAILURE) break;
 	}
 	return status;
@@ -138,11 +267,11 @@ static int __tipsy_dark(XDR* xdr, tipsy_dark_data* d) {
 	const size_t size   = d->size;
 	int	  status = TIPSY_XDR_SUCCESS;
 	for (size_t i = 0; i < size; ++i) {
-		status &= xdr_float(xdr, &(d->mass[i]));
-		status &= xdr_vector(xdr, (char*)(&(d->pos[i])), 3, sizeof(float), (xdrproc_t)xdr_float);
-		status &= xdr_vector(xdr, (char*)(&(d->vel[i])), 3, sizeof(float), (xdrproc_t)xdr_float);
-		status &= xdr_float(xdr, &(d->soft[i]));
-		status &= xdr_float(xdr, &(d->phi[i]));
+		status &= xdr_float(xdr, __column(d->mass, i, d->constant.mass));
+		status &= __xdr_vector3(xdr, *__column(d->pos, i, d->constant.pos));
+		status &= __xdr_vector3(xdr, *__column(d->vel, i, d->constant.vel));
+		status &= xdr_float(xdr, __column(d->soft, i, d->constant.softening));
+		status &= xdr_float(xdr, __column(d->phi, i, d->constant.phi));
 		if (status == TIPSY_XDR_FAILURE) break;
 	}
 	return status;
@@ -152,13 +281,13 @@ static int __tipsy_star(XDR* xdr, tipsy_star_data* d) {
 	const size_t size   = d->size;
 	int	  status = TIPSY_XDR_SUCCESS;
 	for (size_t i = 0; i < size; ++i) {
-		status &= xdr_float(xdr, &(d->mass[i]));
-		status &= xdr_vector(xdr, (char*)(&(d->pos[i])), 3, sizeof(float), (xdrproc_t)xdr_float);
-		status &= xdr_vector(xdr, (char*)(&(d->vel[i])), 3, sizeof(float), (xdrproc_t)xdr_float);
-		status &= xdr_float(xdr, &(d->metals[i]));
-		status &= xdr_float(xdr, &(d->tform[i]));
-		status &= xdr_float(xdr, &(d->soft[i]));
-		status &= xdr_float(xdr, &(d->phi[i]));
+		status &= xdr_float(xdr, __column(d->mass, i, d->constant.mass));
+		status &= __xdr_vector3(xdr, *__column(d->pos, i, d->constant.pos));
+		status &= __xdr_vector3(xdr, *__column(d->vel, i, d->constant.vel));
+		status &= xdr_float(xdr, __column(d->metals, i, d->constant.metals));
+		status &= xdr_float(xdr, __column(d->tform, i, d->constant.tform));
+		status &= xdr_float(xdr, __column(d->soft, i, d->constant.softening));
+		status &= xdr_float(xdr, __column(d->phi, i, d->constant.phi));
 		if (status == TIPSY_XDR_FAILURE) break;
 	}
 	return status;
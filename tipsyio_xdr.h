@@ -5,9 +5,21 @@
 
 typedef enum { TIPSY_XDR_ENCODE, TIPSY_XDR_DECODE } tipsy_xdr_dir;
 
+/*
+ * BLOCK moves whole blocks of records through a buffer and byte-swaps them in bulk.
+ * REFERENCE issues one xdr_float per field and is kept for regression checks.
+ * Both produce bit-for-bit identical files.
+ */
+typedef enum { TIPSY_XDR_CODEC_BLOCK, TIPSY_XDR_CODEC_REFERENCE } tipsy_xdr_codec;
+
 typedef struct {
-	XDR   xdr;
-	FILE* fd;
+	XDR             xdr;
+	FILE*           fd;
+	tipsy_xdr_codec codec;
+	size_t          block_records; /* particles per fread/fwrite in the block codec */
+	int             nthreads;      /* used by the block codec */
+	tipsy_header    header;        /* as last written */
+	tipsy_header    written;       /* particle counts actually written */
 } tipsy_xdr_stream;
 
 #ifdef __cplusplus
@@ -16,11 +28,18 @@ extern "C" {
 
 int  tipsy_init_xdr(tipsy_xdr_stream*, char const*, char const*, tipsy_xdr_dir);
 void tipsy_destroy_xdr(tipsy_xdr_stream*);
+int  tipsy_set_codec_xdr(tipsy_xdr_stream*, tipsy_xdr_codec);
+int  tipsy_set_block_size_xdr(tipsy_xdr_stream*, size_t);
+int  tipsy_set_threads_xdr(tipsy_xdr_stream*, int);
+int  tipsy_finish_xdr(tipsy_xdr_stream*);
 
 int tipsy_read_header_xdr(tipsy_xdr_stream*, tipsy_header*);
 int tipsy_read_gas_xdr(tipsy_xdr_stream*, tipsy_header const*, tipsy_gas_data*);
+int tipsy_read_gas_range_xdr(tipsy_xdr_stream*, tipsy_header const*, size_t, tipsy_gas_data*);
 int tipsy_read_dark_xdr(tipsy_xdr_stream*, tipsy_header const*, tipsy_dark_data*);
+int tipsy_read_dark_range_xdr(tipsy_xdr_stream*, tipsy_header const*, size_t, tipsy_dark_data*);
 int tipsy_read_star_xdr(tipsy_xdr_stream*, tipsy_header const*, tipsy_star_data*);
+int tipsy_read_star_range_xdr(tipsy_xdr_stream*, tipsy_header const*, size_t, tipsy_star_data*);
 
 int tipsy_write_header_xdr(tipsy_xdr_stream*, tipsy_header const* h);
 int tipsy_write_gas_xdr(tipsy_xdr_stream*, tipsy_gas_data const*);